@@ -0,0 +1,77 @@
+"""
+Async database access for WireGuard VPN Admin
+
+database.py is synchronous sqlite3. Route handlers await run_read() and
+run_write(), which run a database function on a bounded thread pool so a
+slow report never blocks the event loop. Reads and writes use separate
+lanes: several readers run side by side (WAL lets them proceed during a
+write), while writes queue on their own lane instead of fighting over the
+SQLite write lock or starving reads.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+# Worker threads per lane; each keeps its own SQLite connection
+READ_WORKERS = int(os.environ.get("WGVPN_DB_READ_WORKERS", "4"))
+WRITE_WORKERS = int(os.environ.get("WGVPN_DB_WRITE_WORKERS", "1"))
+
+
+class _Lane:
+    """A bounded executor that counts queued and running calls"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.pending = 0
+        self.completed = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"db-{name}")
+
+    def _call(self, func: Callable):
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+
+    async def run(self, func: Callable, *args, **kwargs):
+        with self._lock:
+            self.pending += 1
+        try:
+            future = self._executor.submit(self._call, functools.partial(func, *args, **kwargs))
+        except RuntimeError:
+            # Lane already shut down; the call never ran
+            with self._lock:
+                self.pending -= 1
+            raise
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'workers': self.workers, 'pending': self.pending, 'completed': self.completed}
+
+
+_read_lane = _Lane('read', READ_WORKERS)
+_write_lane = _Lane('write', WRITE_WORKERS)
+
+
+async def run_read(func: Callable, *args, **kwargs):
+    """Run a read-only database function on the read lane"""
+    return await _read_lane.run(func, *args, **kwargs)
+
+
+async def run_write(func: Callable, *args, **kwargs):
+    """Run a database function that writes on the write lane"""
+    return await _write_lane.run(func, *args, **kwargs)
+
+
+def get_lane_stats() -> Dict:
+    """Worker count, pending (queued + running) and completed calls per lane"""
+    return {'read': _read_lane.stats(), 'write': _write_lane.stats()}
+
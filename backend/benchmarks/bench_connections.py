@@ -0,0 +1,73 @@
+"""
+Per-call connection overhead benchmark
+
+Compares opening a fresh sqlite3 connection per call (the old behaviour)
+with borrowing the thread's persistent connection from db_connection().
+
+Usage:
+    python backend/benchmarks/bench_connections.py [--calls 5000]
+"""
+
+import argparse
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import database
+
+
+def fresh_connection_lookup(user_id: int):
+    """Old pattern: connect, query, close on every call"""
+    conn = sqlite3.connect(str(database.DATABASE_PATH))
+    conn.row_factory = sqlite3.Row
+    row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def pooled_lookup(user_id: int):
+    """New pattern: reuse the thread's connection"""
+    with database.db_connection() as conn:
+        row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def time_calls(func, calls: int) -> float:
+    start = time.perf_counter()
+    for i in range(calls):
+        func(1 + i % 100)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE_PATH = Path(tmp) / "bench.db"
+        database.init_db()
+        with database.db_connection() as conn:
+            conn.executemany(
+                "INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)",
+                [(f"user{i}", f"user{i}@example.com", "x") for i in range(100)]
+            )
+
+        results = {}
+        for name, func in [('fresh connection', fresh_connection_lookup), ('db_connection()', pooled_lookup)]:
+            func(1)  # warm up
+            elapsed = time_calls(func, args.calls)
+            results[name] = elapsed / args.calls * 1e6
+            print(f"{name:18} {results[name]:8.1f} us/call  ({args.calls} calls in {elapsed:.3f}s)")
+
+        print(f"speedup            {results['fresh connection'] / results['db_connection()']:8.1f}x")
+        print(f"pool stats         {database.get_pool_stats()}")
+        database.close_thread_connection()
+
+
+if __name__ == "__main__":
+    main()
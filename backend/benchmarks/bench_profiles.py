@@ -0,0 +1,128 @@
+"""
+SQLite storage profile tuning benchmark
+
+Runs a mixed workload against a fresh database for each profile in
+database.STORAGE_PROFILES: writer threads ingest traffic batches like the
+collector does while reader threads run report-style aggregations.
+Reports write/read throughput, worst write latency and lock errors.
+
+Usage:
+    python backend/benchmarks/bench_profiles.py [--duration 5] [--writers 2] [--readers 4]
+"""
+
+import argparse
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import database
+
+PEERS = 50
+_stats_lock = threading.Lock()
+
+
+def record(stats, key: str, amount=1):
+    with _stats_lock:
+        stats[key] += amount
+
+
+def seed(rows: int):
+    """Create users and some traffic history so reads have work to do"""
+    with database.db_connection() as conn:
+        conn.executemany(
+            "INSERT INTO users (username, email, password_hash, public_key) VALUES (?, ?, ?, ?)",
+            [(f"user{i}", f"user{i}@example.com", "x", f"peer{i}") for i in range(PEERS)]
+        )
+    counters = [0] * PEERS
+    for offset in range(0, rows, PEERS * 20):
+        batch = []
+        for _ in range(20):
+            for i in range(PEERS):
+                counters[i] += 1000
+                batch.append((i + 1, f"peer{i}", counters[i], counters[i] // 10, 1000, 100))
+        database.log_traffic_batch(batch)
+    return counters
+
+
+def writer(stop: threading.Event, counters, stats):
+    counters = list(counters)
+    while not stop.is_set():
+        batch = []
+        for i in range(PEERS):
+            counters[i] += 1000
+            batch.append((i + 1, f"peer{i}", counters[i], counters[i] // 10, 1000, 100))
+        started = time.perf_counter()
+        try:
+            database.log_traffic_batch(batch)
+            record(stats, 'writes')
+        except sqlite3.OperationalError:
+            record(stats, 'write_errors')
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with _stats_lock:
+            stats['max_write_ms'] = max(stats['max_write_ms'], elapsed_ms)
+    database.close_thread_connection()
+
+
+def reader(stop: threading.Event, stats):
+    while not stop.is_set():
+        try:
+            with database.db_connection() as conn:
+                conn.execute("""
+                    SELECT user_id, COUNT(*), SUM(delta_received), SUM(delta_sent)
+                    FROM traffic_logs GROUP BY user_id
+                """).fetchall()
+            database.get_recent_traffic_logs(100)
+            record(stats, 'reads')
+        except sqlite3.OperationalError:
+            record(stats, 'read_errors')
+    database.close_thread_connection()
+
+
+def run_profile(profile: str, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE_PATH = Path(tmp) / "bench.db"
+        database.DB_PROFILE = profile
+        database.init_db()
+        counters = seed(args.seed_rows)
+
+        stats = {'writes': 0, 'reads': 0, 'write_errors': 0, 'read_errors': 0, 'max_write_ms': 0.0}
+        stop = threading.Event()
+        threads = [threading.Thread(target=writer, args=(stop, counters, stats)) for _ in range(args.writers)]
+        threads += [threading.Thread(target=reader, args=(stop, stats)) for _ in range(args.readers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        database.close_thread_connection()
+
+    stats['writes_per_sec'] = round(stats['writes'] / args.duration, 1)
+    stats['reads_per_sec'] = round(stats['reads'] / args.duration, 1)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seed-rows', type=int, default=50000)
+    parser.add_argument('--profiles', nargs='*', default=list(database.STORAGE_PROFILES))
+    args = parser.parse_args()
+
+    print(f"{'profile':12} {'writes/s':>9} {'reads/s':>9} {'max write ms':>13} {'errors':>7}")
+    for profile in args.profiles:
+        stats = run_profile(profile, args)
+        errors = stats['write_errors'] + stats['read_errors']
+        print(f"{profile:12} {stats['writes_per_sec']:9.1f} {stats['reads_per_sec']:9.1f} "
+              f"{stats['max_write_ms']:13.1f} {errors:7d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Query and API benchmark suite
+
+Times the read queries of database.py and the main API routes against a
+dataset made by generate_data.py, and writes the results as JSON. Pass a
+previous result file with --compare to see the change per benchmark; the
+exit status is 1 when any median got slower than --threshold allows
+(and by at least --min-delta-ms).
+Write paths are covered by bench_profiles.py; nothing here modifies the
+dataset, so runs on different commits see the same data.
+
+Usage:
+    python backend/benchmarks/bench_suite.py --db /tmp/wgvpn-bench.db --output before.json
+    python backend/benchmarks/bench_suite.py --db /tmp/wgvpn-bench.db --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import platform
+import re
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import database
+
+COUNTED_TABLES = ('users', 'traffic_logs', 'audit_logs', 'connection_logs', 'login_history',
+                  'system_events', 'alerts')
+
+
+def dataset_context():
+    """Counts and date windows taken from the dataset, so ranges always hit data"""
+    with database.db_connection() as conn:
+        counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in COUNTED_TABLES}
+        latest = conn.execute("SELECT MAX(snapshot_time) FROM traffic_logs").fetchone()[0]
+        user = conn.execute("SELECT id, username, public_key FROM users ORDER BY id LIMIT 1 OFFSET 1").fetchone()
+    if not latest or not user:
+        raise SystemExit("Dataset has no traffic or users; create one with generate_data.py")
+    end = datetime.strptime(latest[:10], '%Y-%m-%d') + timedelta(days=1)
+    return {
+        'counts': counts,
+        'end': end.strftime('%Y-%m-%d'),
+        'week_start': (end - timedelta(days=7)).strftime('%Y-%m-%d'),
+        'month_start': (end - timedelta(days=30)).strftime('%Y-%m-%d'),
+        'user_id': user['id'],
+        'username': user['username'],
+        'public_key': user['public_key'],
+    }
+
+
+def query_benchmarks(ctx):
+    """(name, callable) for every read query in database.py"""
+    user_id, end, week, month = ctx['user_id'], ctx['end'], ctx['week_start'], ctx['month_start']
+    return [
+        ('get_users', lambda: database.get_users()),
+        ('get_users(search)', lambda: database.get_users(search=ctx['username'])),
+        ('get_user_by_id', lambda: database.get_user_by_id(user_id)),
+        ('get_user_by_username', lambda: database.get_user_by_username(ctx['username'])),
+        ('get_user_by_public_key', lambda: database.get_user_by_public_key(ctx['public_key'])),
+        ('get_peer_user_map', lambda: database.get_peer_user_map()),
+        ('get_latest_traffic_counters', lambda: database.get_latest_traffic_counters()),
+        ('get_recent_traffic_logs', lambda: database.get_recent_traffic_logs(100)),
+        ('get_traffic_history(user, week)', lambda: database.get_traffic_history(user_id, week, end)),
+        ('get_traffic_history(all)', lambda: database.get_traffic_history()),
+        ('get_daily_traffic_summary', lambda: database.get_daily_traffic_summary()),
+        ('get_daily_traffic_summary(user)', lambda: database.get_daily_traffic_summary(user_id)),
+        ('get_hourly_traffic_summary', lambda: database.get_hourly_traffic_summary()),
+        ('get_traffic_series(hour, week)', lambda: database.get_traffic_series(week, end, 3600)),
+        ('get_traffic_series(day, month)', lambda: database.get_traffic_series(month, end, 86400)),
+        ('get_alerts', lambda: database.get_alerts()),
+        ('get_unresolved_alerts', lambda: database.get_unresolved_alerts()),
+        ('get_connection_logs', lambda: database.get_connection_logs()),
+        ('get_connection_logs(user, month)', lambda: database.get_connection_logs(user_id, month, end)),
+        ('get_active_connections', lambda: database.get_active_connections()),
+        ('count_active_connections', lambda: database.count_active_connections()),
+        ('search_logs', lambda: database.search_logs()),
+        ('search_logs(keyword)', lambda: database.search_logs(keyword=ctx['username'])),
+        ('search_logs(keyword, relevance)', lambda: database.search_logs(keyword='config', sort='relevance')),
+        ('search_logs(audit, week)', lambda: database.search_logs(log_type='audit', start_date=week, end_date=end)),
+        ('iter_logs_for_export(audit, week)',
+         lambda: sum(1 for _ in database.iter_logs_for_export(log_type='audit', start_date=week, end_date=end)[1])),
+        ('get_audit_logs', lambda: database.get_audit_logs()),
+        ('get_audit_logs(action, month)', lambda: database.get_audit_logs(action='LOGIN', start_date=month, end_date=end)),
+        ('get_distinct_audit_actions', lambda: database.get_distinct_audit_actions()),
+        ('get_login_history(failed)', lambda: database.get_login_history(success=False)),
+        ('get_system_events', lambda: database.get_system_events()),
+        ('get_distinct_event_types', lambda: database.get_distinct_event_types()),
+        ('get_compliance_reports', lambda: database.get_compliance_reports()),
+        ('get_scheduled_reports', lambda: database.get_scheduled_reports()),
+        ('get_report_templates', lambda: database.get_report_templates()),
+        ('get_generated_reports', lambda: database.get_generated_reports()),
+        ('get_user_statistics', lambda: database.get_user_statistics()),
+        ('get_user_statistics(month)', lambda: database.get_user_statistics(month, end)),
+        ('generate_traffic_report_data(month)', lambda: database.generate_traffic_report_data(month, end)),
+        ('generate_compliance_report_data(week)',
+         lambda: database.generate_compliance_report_data('custom', week, end)),
+    ]
+
+
+def api_benchmarks(ctx):
+    """(name, path) for the main read routes"""
+    user_id, end, week, month = ctx['user_id'], ctx['end'], ctx['week_start'], ctx['month_start']
+    return [
+        (f"GET {path}", path)
+        for path in [
+            '/api/users',
+            f'/api/users/{user_id}',
+            '/api/traffic/history?limit=100',
+            '/api/traffic/daily',
+            '/api/traffic/hourly',
+            f'/api/traffic/series?start={week}&end={end}&bucket_seconds=3600',
+            '/api/alerts',
+            '/api/logs/connections',
+            '/api/logs/connections/active',
+            '/api/logs/search',
+            f"/api/logs/search?keyword={ctx['username']}",
+            '/api/audit/operations',
+            '/api/audit/login-history',
+            '/api/audit/system-events',
+            f'/api/reports/traffic?start_date={month}&end_date={end}',
+            f'/api/reports/user-stats?start_date={month}&end_date={end}',
+        ]
+    ]
+
+
+def measure(func, repeat: int, warmup: int):
+    for _ in range(warmup):
+        func()
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        runs.append((time.perf_counter() - started) * 1000)
+    return {
+        'runs': repeat,
+        'min_ms': round(min(runs), 3),
+        'median_ms': round(statistics.median(runs), 3),
+        'mean_ms': round(statistics.fmean(runs), 3),
+        'max_ms': round(max(runs), 3),
+    }
+
+
+def run_api(ctx, args, selected):
+    # No lifespan: the collector and maintenance jobs would write to the dataset
+    from fastapi.testclient import TestClient
+    import main as app_main
+
+    client = TestClient(app_main.app)
+    headers = {'Authorization': f"Bearer {app_main.generate_jwt_token(1, 'admin')}"}
+    results = {}
+    for name, path in api_benchmarks(ctx):
+        if not selected(name):
+            continue
+
+        def call():
+            response = client.get(path, headers=headers)
+            if response.status_code != 200:
+                raise RuntimeError(f"{path} returned {response.status_code}: {response.text[:200]}")
+
+        results[name] = measure(call, args.repeat, args.warmup)
+        print(f"{name:60} {results[name]['median_ms']:10.2f} ms")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path: Path, threshold: float, min_delta_ms: float) -> int:
+    """Print median changes against a previous result file; returns the number of regressions"""
+    baseline = json.loads(baseline_path.read_text())['results']
+    regressions = 0
+    print(f"\n{'benchmark':60} {'before':>10} {'after':>10} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['median_ms'], result['median_ms']
+        ratio = after / before if before else float('inf')
+        flag = ''
+        # Sub-millisecond queries jitter by more than any sensible ratio
+        if ratio > threshold and after - before >= min_delta_ms:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{name:60} {before:10.2f} {after:10.2f} {ratio:7.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', type=Path, required=True, help="dataset made by generate_data.py")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--only', help="regex; run the benchmarks whose name matches")
+    parser.add_argument('--skip-api', action='store_true')
+    parser.add_argument('--output', type=Path, help="write the results to this JSON file")
+    parser.add_argument('--compare', type=Path, help="previous JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=1.2, help="slowdown ratio counted as a regression")
+    parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                        help="ignore slowdowns smaller than this many milliseconds")
+    args = parser.parse_args()
+
+    if not args.db.exists():
+        parser.error(f"{args.db} does not exist; create it with generate_data.py")
+    database.DATABASE_PATH = args.db
+    # The suite measures queries itself; skip the EXPLAIN of the slow query log
+    database.SLOW_QUERY_MS = 0
+    pattern = re.compile(args.only) if args.only else None
+
+    def selected(name):
+        return pattern is None or pattern.search(name) is not None
+
+    ctx = dataset_context()
+    print(f"Dataset {args.db}: {ctx['counts']}")
+
+    results = {}
+    for name, func in query_benchmarks(ctx):
+        if selected(name):
+            results[name] = measure(func, args.repeat, args.warmup)
+            print(f"{name:60} {results[name]['median_ms']:10.2f} ms")
+    if not args.skip_api:
+        results.update(run_api(ctx, args, selected))
+    database.close_thread_connection()
+
+    if args.output:
+        args.output.write_text(json.dumps({
+            'meta': {
+                'commit': git_commit(),
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'dataset': str(args.db),
+                'counts': ctx['counts'],
+                'repeat': args.repeat,
+                'warmup': args.warmup,
+            },
+            'results': results,
+        }, indent=2) + '\n')
+        print(f"\nResults written to {args.output}")
+
+    if args.compare and compare(results, args.compare, args.threshold, args.min_delta_ms):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
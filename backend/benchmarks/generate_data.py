@@ -0,0 +1,310 @@
+"""
+Synthetic dataset generator for the benchmark suite
+
+Builds a database with users, traffic snapshots and log history at a chosen
+scale. Rows are deterministic for a given --seed, so two commits can be
+benchmarked against identical data. Loading drops the indexes and search
+triggers of the bulk tables, inserts with journaling off, then rebuilds the
+indexes, the traffic rollup tiers and the log search index.
+
+The dataset contains an 'admin' account with the password 'admin123'.
+
+Usage:
+    python backend/benchmarks/generate_data.py --scale small --db /tmp/wgvpn-bench.db
+    python backend/benchmarks/generate_data.py --scale large --traffic 20000000 --db /data/bench.db
+"""
+
+import argparse
+import hashlib
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import database
+
+# Row counts per table
+PRESETS = {
+    'small': {'users': 200, 'traffic': 200_000, 'audit': 50_000, 'connections': 20_000,
+              'logins': 20_000, 'events': 10_000, 'alerts': 2_000},
+    'medium': {'users': 2_000, 'traffic': 5_000_000, 'audit': 500_000, 'connections': 200_000,
+               'logins': 200_000, 'events': 100_000, 'alerts': 20_000},
+    'large': {'users': 10_000, 'traffic': 100_000_000, 'audit': 5_000_000, 'connections': 1_000_000,
+              'logins': 1_000_000, 'events': 500_000, 'alerts': 100_000},
+}
+
+# Tables whose indexes and triggers are dropped during the load
+BULK_TABLES = ('traffic_logs', 'audit_logs', 'connection_logs', 'login_history', 'system_events', 'alerts')
+
+# Share of the peers that report in each collector tick
+ACTIVE_PEERS = 0.25
+
+# Number of low user ids acting as administrators in the audit log
+ADMINS = 20
+
+CHUNK_ROWS = 50_000
+
+AUDIT_ACTIONS = ['LOGIN', 'LOGOUT', 'CREATE_USER', 'UPDATE_USER', 'DELETE_USER', 'TOGGLE_USER',
+                 'GENERATE_CONFIG', 'CHANGE_PASSWORD', 'EXPORT_LOGS', 'GENERATE_REPORT']
+EVENT_TYPES = [('report_generated', 'info'), ('retention_completed', 'info'), ('report_scheduled', 'info'),
+               ('template_created', 'info'), ('interface_restarted', 'warning'), ('disk_usage_high', 'warning'),
+               ('collector_failed', 'error')]
+USER_AGENTS = ['Mozilla/5.0 (Windows NT 10.0; Win64; x64)', 'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_2)',
+               'Mozilla/5.0 (X11; Linux x86_64)', 'curl/8.4.0']
+
+# Bucket expressions matching database.TRAFFIC_TIERS, by tier resolution
+ROLLUP_BUCKETS = {
+    60: "substr(snapshot_time, 1, 16)",
+    3600: "substr(snapshot_time, 1, 13) || ':00'",
+    86400: "substr(snapshot_time, 1, 10)",
+}
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _spread(rng: random.Random, count: int, start: datetime, span: timedelta):
+    """count ascending timestamps spread over [start, start + span)"""
+    step = span.total_seconds() / max(count, 1)
+    for i in range(count):
+        yield (start + timedelta(seconds=(i + rng.random()) * step)).strftime(TIME_FORMAT)
+
+
+def _ip(rng: random.Random) -> str:
+    return f"203.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+
+
+def public_key(user_id: int) -> str:
+    return f"bench{user_id:06d}" + 'A' * 37 + '='
+
+
+def user_rows(count: int):
+    admin_hash = hashlib.sha256(b'admin123').hexdigest()
+    yield ('admin', 'admin@example.com', admin_hash, public_key(1), '10.0.0.2/32')
+    for user_id in range(2, count + 1):
+        yield (f"user{user_id:05d}", f"user{user_id:05d}@example.com", 'x' * 64,
+               public_key(user_id), f"10.{user_id // 65536}.{user_id // 256 % 256}.{user_id % 256}/32")
+
+
+def traffic_rows(rng: random.Random, count: int, users: int, start: datetime, span: timedelta):
+    """Collector-style snapshots: each tick logs a rotating block of the peers"""
+    per_tick = max(1, int(users * ACTIVE_PEERS))
+    ticks = -(-count // per_tick)
+    counters = [[0, 0] for _ in range(users + 1)]
+    written = 0
+    for tick, snapshot_time in enumerate(_spread(rng, ticks, start, span)):
+        first = tick * per_tick
+        for offset in range(min(per_tick, count - written)):
+            user_id = (first + offset) % users + 1
+            # Heavy-tailed per-sample traffic, downloads larger than uploads
+            delta_received = int(rng.expovariate(1 / 4_000_000))
+            delta_sent = int(rng.expovariate(1 / 1_000_000))
+            counter = counters[user_id]
+            counter[0] += delta_received
+            counter[1] += delta_sent
+            yield (user_id, public_key(user_id), counter[0], counter[1], delta_received, delta_sent, snapshot_time)
+        written += min(per_tick, count - written)
+
+
+def audit_rows(rng: random.Random, count: int, users: int, start: datetime, span: timedelta):
+    for created_at in _spread(rng, count, start, span):
+        action = rng.choice(AUDIT_ACTIONS)
+        target = rng.randint(1, users)
+        yield (rng.randint(1, min(users, ADMINS)), action, f"{action.lower()} user{target:05d} from admin console",
+               _ip(rng), created_at)
+
+
+def connection_rows(rng: random.Random, count: int, users: int, start: datetime, span: timedelta):
+    open_from = int(count * 0.99)
+    for i, connected_at in enumerate(_spread(rng, count, start, span)):
+        user_id = rng.randint(1, users)
+        if i >= open_from:
+            disconnected_at, received, sent = None, 0, 0
+        else:
+            duration = timedelta(seconds=rng.randint(60, 8 * 3600))
+            disconnected_at = (datetime.strptime(connected_at, TIME_FORMAT) + duration).strftime(TIME_FORMAT)
+            received, sent = rng.randint(0, 2_000_000_000), rng.randint(0, 500_000_000)
+        yield (user_id, f"10.0.{user_id // 256 % 256}.{user_id % 256}", connected_at, disconnected_at,
+               received, sent)
+
+
+def login_rows(rng: random.Random, count: int, users: int, start: datetime, span: timedelta):
+    for created_at in _spread(rng, count, start, span):
+        user_id = rng.randint(1, min(users, ADMINS))
+        success = rng.random() < 0.9
+        yield (user_id, 'admin' if user_id == 1 else f"user{user_id:05d}", _ip(rng), rng.choice(USER_AGENTS),
+               success, None if success else 'Invalid password', created_at)
+
+
+def event_rows(rng: random.Random, count: int, users: int, start: datetime, span: timedelta):
+    for created_at in _spread(rng, count, start, span):
+        event_type, severity = rng.choice(EVENT_TYPES)
+        yield (event_type, severity, event_type.replace('_', ' ').capitalize(),
+               f"Synthetic event #{rng.randint(1, 10**6)}", rng.choice(['api', 'scheduler', 'maintenance']),
+               created_at)
+
+
+def alert_rows(rng: random.Random, count: int, users: int, start: datetime, span: timedelta):
+    for created_at in _spread(rng, count, start, span):
+        alert_type = rng.choice(['high_bandwidth', 'traffic_spike'])
+        threshold = 10 * 1024 ** 3 if alert_type == 'high_bandwidth' else 3.0
+        resolved = rng.random() < 0.8
+        resolved_at = None
+        if resolved:
+            resolved_at = (datetime.strptime(created_at, TIME_FORMAT) + timedelta(hours=2)).strftime(TIME_FORMAT)
+        yield (rng.randint(1, users), alert_type, rng.choice(['warning', 'critical']),
+               f"{alert_type.replace('_', ' ')} detected", threshold, threshold * (1 + rng.random()),
+               resolved, created_at, resolved_at)
+
+
+LOADS = [
+    # (count key, table, columns, row generator)
+    ('traffic', 'traffic_logs',
+     'user_id, peer_public_key, bytes_received, bytes_sent, delta_received, delta_sent, snapshot_time', traffic_rows),
+    ('audit', 'audit_logs', 'user_id, action, details, ip_address, created_at', audit_rows),
+    ('connections', 'connection_logs',
+     'user_id, peer_ip, connected_at, disconnected_at, bytes_received, bytes_sent', connection_rows),
+    ('logins', 'login_history',
+     'user_id, username, ip_address, user_agent, success, failure_reason, created_at', login_rows),
+    ('events', 'system_events', 'event_type, severity, message, details, source, created_at', event_rows),
+    ('alerts', 'alerts',
+     'user_id, alert_type, severity, message, threshold_value, actual_value, is_resolved, created_at, resolved_at',
+     alert_rows),
+]
+
+
+def insert_rows(conn, table: str, columns: str, rows) -> int:
+    """executemany in chunks so memory stays flat at any scale"""
+    placeholders = ', '.join('?' * len(columns.split(',')))
+    sql = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
+    inserted = 0
+    while True:
+        chunk = list(islice(rows, CHUNK_ROWS))
+        if not chunk:
+            return inserted
+        conn.executemany(sql, chunk)
+        inserted += len(chunk)
+
+
+def rebuild_rollups(conn, now: datetime):
+    """Fill the traffic rollup tiers from traffic_logs in SQL, within each tier's retention"""
+    for table, column, resolution, bucket_of, retention in database.TRAFFIC_TIERS:
+        where = ''
+        params = ()
+        if retention is not None:
+            where = "WHERE snapshot_time >= ?"
+            params = ((now - retention).strftime(TIME_FORMAT),)
+        conn.execute(f"DELETE FROM {table}")
+        conn.execute(
+            f"""INSERT INTO {table} (user_id, {column}, bytes_received, bytes_sent, samples)
+                SELECT user_id, {ROLLUP_BUCKETS[resolution]}, SUM(COALESCE(delta_received, 0)),
+                       SUM(COALESCE(delta_sent, 0)), COUNT(*)
+                FROM traffic_logs {where} GROUP BY 1, 2""",
+            params
+        )
+
+
+def generate(path: Path, counts: dict, days: int, seed: int):
+    database.DATABASE_PATH = path
+    # Rebuilding the indexes is slow by design; keep it out of the slow query log
+    database.SLOW_QUERY_MS = 0
+    database.init_db()
+    rng = random.Random(seed)
+    # End at the current hour so "last 24 hours" style queries find data
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    span = timedelta(days=days)
+    start = now - span
+    timings = {}
+
+    conn = sqlite3.connect(str(path), isolation_level=None)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -262144")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+    # Indexes and FTS triggers are rebuilt once after the load instead of per row
+    deferred = conn.execute(
+        f"""SELECT type, name, sql FROM sqlite_master
+            WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+              AND tbl_name IN ({', '.join('?' * len(BULK_TABLES))})""",
+        BULK_TABLES
+    ).fetchall()
+    for kind, name, _ in deferred:
+        conn.execute(f"DROP {kind.upper()} {name}")
+
+    started = time.perf_counter()
+    conn.execute("BEGIN")
+    insert_rows(conn, 'users', 'username, email, password_hash, public_key, allowed_ips', user_rows(counts['users']))
+    conn.execute("COMMIT")
+    timings['users'] = time.perf_counter() - started
+
+    for key, table, columns, rows in LOADS:
+        started = time.perf_counter()
+        conn.execute("BEGIN")
+        inserted = insert_rows(conn, table, columns, rows(rng, counts[key], counts['users'], start, span))
+        conn.execute("COMMIT")
+        timings[table] = time.perf_counter() - started
+        print(f"  {table:16} {inserted:>12,} rows  {inserted / max(timings[table], 1e-9):>12,.0f} rows/s")
+
+    started = time.perf_counter()
+    for _, _, sql in deferred:
+        conn.execute(sql)
+    timings['indexes'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    conn.execute("BEGIN")
+    rebuild_rollups(conn, datetime.utcnow())
+    conn.execute("COMMIT")
+    timings['rollups'] = time.perf_counter() - started
+
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+
+    started = time.perf_counter()
+    try:
+        database.rebuild_log_search_index()
+    except RuntimeError as e:
+        print(f"  search index skipped: {e}")
+    timings['search_index'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with database.db_connection() as conn:
+        conn.execute("ANALYZE")
+    database.close_thread_connection()
+    timings['analyze'] = time.perf_counter() - started
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', type=Path, required=True, help="database file to create")
+    parser.add_argument('--scale', choices=list(PRESETS), default='small')
+    for key in PRESETS['small']:
+        parser.add_argument(f'--{key}', type=int, help=f"override the preset's {key} row count")
+    parser.add_argument('--days', type=int, default=90, help="history the rows are spread over")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--force', action='store_true', help="replace an existing database file")
+    args = parser.parse_args()
+
+    if args.db.exists():
+        if not args.force:
+            parser.error(f"{args.db} exists; pass --force to replace it")
+        for suffix in ('', '-wal', '-shm'):
+            Path(f"{args.db}{suffix}").unlink(missing_ok=True)
+
+    counts = {key: getattr(args, key) if getattr(args, key) is not None else value
+              for key, value in PRESETS[args.scale].items()}
+    print(f"Generating {args.scale} dataset into {args.db}: {counts}")
+    started = time.perf_counter()
+    timings = generate(args.db, counts, args.days, args.seed)
+    for step in ('indexes', 'rollups', 'search_index', 'analyze'):
+        print(f"  {step:16} {timings[step]:>8.1f}s")
+    print(f"Done in {time.perf_counter() - started:.1f}s, {args.db.stat().st_size / 1024 ** 2:,.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Background WireGuard traffic collector for WireGuard VPN Admin
+
+A single sampler task owns the WireGuard read and the traffic_logs write.
+HTTP handlers only read the latest in-memory snapshot.
+"""
+
+import asyncio
+import os
+import signal
+import subprocess
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import database
+
+# Seconds between two WireGuard samples
+COLLECT_INTERVAL = float(os.environ.get("WGVPN_COLLECT_INTERVAL", "5"))
+
+# ============== WireGuard Dump Parser ==============
+
+def parse_wg_dump(lines: Iterable[str]) -> List[Dict]:
+    """
+    Parse 'wg show all dump' output line by line.
+
+    Interface lines have 5 tab-separated fields, peer lines have 9:
+    interface, public-key, preshared-key, endpoint, allowed-ips,
+    latest-handshake, transfer-rx, transfer-tx, persistent-keepalive.
+    Counters are exact integers; interface lines are skipped.
+    """
+    peers = []
+    append = peers.append
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != 9:
+            continue
+        interface, public_key, _, endpoint, allowed_ips, handshake, rx, tx, _ = fields
+        append({
+            'interface': interface,
+            'public_key': public_key,
+            'endpoint': None if endpoint == '(none)' else endpoint,
+            'allowed_ips': [] if allowed_ips == '(none)' else allowed_ips.split(','),
+            'latest_handshake': int(handshake),
+            'bytes_received': int(rx),
+            'bytes_sent': int(tx),
+        })
+    return peers
+
+
+def read_wg_dump(timeout: float = 10) -> List[Dict]:
+    """
+    Run 'wg show all dump' and parse its output straight from the pipe.
+    The whole call is bounded by `timeout`: a watchdog kills a hung wg.
+    Raises FileNotFoundError when wg is missing, subprocess.TimeoutExpired
+    when it hangs and RuntimeError when it fails.
+    """
+    proc = subprocess.Popen(
+        ["wg", "show", "all", "dump"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        start_new_session=True
+    )
+    timed_out = threading.Event()
+
+    def expire():
+        # Killing the process group closes the pipe, which ends the read below
+        timed_out.set()
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    watchdog = threading.Timer(timeout, expire)
+    watchdog.start()
+    try:
+        try:
+            peers = parse_wg_dump(proc.stdout)
+            returncode = proc.wait()
+        except ValueError:
+            if timed_out.is_set():
+                peers, returncode = None, None  # a line cut short by the kill
+            else:
+                raise
+    finally:
+        watchdog.cancel()
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(proc.args, timeout)
+    if returncode != 0:
+        raise RuntimeError(f"wg show all dump exited with {returncode}")
+    return peers
+
+# ============== Collector ==============
+
+
+class TrafficCollector:
+    """
+    Periodically samples WireGuard peers and keeps the latest snapshot in memory.
+    `reader` returns a list of dicts with public_key, bytes_received, bytes_sent
+    and, when available, interface, endpoint, allowed_ips and latest_handshake.
+    """
+
+    def __init__(self, reader: Callable[[], List[Dict]], interval: float = COLLECT_INTERVAL):
+        self.reader = reader
+        self.interval = interval
+        # (snapshot, monotonic collection time), swapped as one reference
+        self._latest: Optional[Tuple[Dict, float]] = None
+        # Last cumulative (rx, tx) per peer, seeded from traffic_logs on first run
+        self._counters: Optional[Dict[str, Tuple[int, int]]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def collect_once(self) -> Dict:
+        """Read WireGuard once, log the snapshot and publish it (blocking)"""
+        if self._counters is None:
+            self._counters = database.get_latest_traffic_counters()
+
+        peers = self.reader()
+        user_map = database.get_peer_user_map()
+
+        result = []
+        batch = []
+        counters = {}
+        resets = 0
+        for peer in peers:
+            user = user_map.get(peer.get('public_key'))
+
+            traffic_entry = {
+                'public_key': peer.get('public_key', 'unknown'),
+                'bytes_received': peer.get('bytes_received', 0),
+                'bytes_sent': peer.get('bytes_sent', 0),
+                'formatted_received': database.format_bytes(peer.get('bytes_received', 0)),
+                'formatted_sent': database.format_bytes(peer.get('bytes_sent', 0)),
+                'interface': peer.get('interface'),
+                'endpoint': peer.get('endpoint'),
+                'allowed_ips': peer.get('allowed_ips', []),
+                'latest_handshake': peer.get('latest_handshake'),
+            }
+
+            if user:
+                traffic_entry['user_id'] = user['id']
+                traffic_entry['username'] = user['username']
+
+                public_key = traffic_entry['public_key']
+                received, sent = traffic_entry['bytes_received'], traffic_entry['bytes_sent']
+                previous = self._counters.get(public_key)
+                delta_received, delta_sent, is_reset = database.compute_counter_delta(previous, received, sent)
+                counters[public_key] = (received, sent)
+                resets += is_reset
+
+                # Idle peers add no rows; the first sample is kept as a baseline
+                if previous is None or delta_received or delta_sent:
+                    batch.append((user['id'], public_key, received, sent, delta_received, delta_sent))
+
+            result.append(traffic_entry)
+
+        # Write the whole poll cycle in one transaction
+        # Advance the baselines only once the batch is stored, or the failed deltas are lost
+        ingest = None
+        if batch:
+            try:
+                ingest = database.log_traffic_batch(batch)
+                ingest['counter_resets'] = resets
+                self._counters.update(counters)
+            except Exception as e:
+                print(f"Failed to log traffic: {e}")
+                ingest = {'error': str(e)}
+        else:
+            self._counters.update(counters)
+
+        snapshot = {
+            'timestamp': datetime.now().isoformat(),
+            'peers': result,
+            'total_received': sum(p['bytes_received'] for p in result),
+            'total_sent': sum(p['bytes_sent'] for p in result),
+            'ingest': ingest
+        }
+
+        # Publish by swapping one reference so readers never see a partial snapshot
+        self._latest = (snapshot, time.monotonic())
+        return snapshot
+
+    def latest(self) -> Dict:
+        """Return the latest snapshot with its age in seconds"""
+        latest = self._latest
+        if latest is None:
+            return {
+                'timestamp': None,
+                'peers': [],
+                'total_received': 0,
+                'total_sent': 0,
+                'ingest': None,
+                'age_seconds': None,
+                'interval': self.interval
+            }
+        snapshot, collected_at = latest
+        return {
+            **snapshot,
+            'age_seconds': round(time.monotonic() - collected_at, 3),
+            'interval': self.interval
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.collect_once)
+            except Exception as e:
+                print(f"Traffic collection failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Start the sampler task on the running event loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Cancel the sampler task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
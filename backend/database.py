@@ -2,20 +2,336 @@
 Database setup for WireGuard VPN Admin
 """
 
+import base64
+import heapq
+import json
+import os
+import re
 import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from itertools import chain, islice
 from pathlib import Path
 from datetime import datetime, date, timedelta
 
 DATABASE_PATH = Path(__file__).parent / "wgvpn.db"
 
-def get_db_connection():
-    """Get database connection"""
-    conn = sqlite3.connect(str(DATABASE_PATH))
+# Retention of the fine-grained traffic rollup tiers (the daily tier is kept forever)
+MINUTE_ROLLUP_RETENTION_HOURS = int(os.environ.get("WGVPN_MINUTE_ROLLUP_RETENTION_HOURS", "48"))
+HOURLY_ROLLUP_RETENTION_DAYS = int(os.environ.get("WGVPN_HOURLY_ROLLUP_RETENTION_DAYS", "90"))
+
+# Log table retention: table -> (timestamp column, days to keep, extra condition)
+# Override with WGVPN_RETENTION_<TABLE>_DAYS; 0 keeps rows forever
+RETENTION_POLICIES = {
+    table: (column, int(os.environ.get(f"WGVPN_RETENTION_{table.upper()}_DAYS", default_days)), condition)
+    for table, column, default_days, condition in [
+        ('traffic_logs', 'snapshot_time', '30', None),
+        ('connection_logs', 'connected_at', '180', 'disconnected_at IS NOT NULL'),
+        ('audit_logs', 'created_at', '365', None),
+        ('login_history', 'created_at', '180', None),
+        ('system_events', 'created_at', '90', None),
+        ('health_samples', 'sampled_at', '7', None),
+    ]
+}
+
+# SQLite storage profiles applied to every new connection. Pick one with
+# WGVPN_DB_PROFILE and override single settings with WGVPN_DB_<SETTING>,
+# e.g. WGVPN_DB_SYNCHRONOUS=FULL. See benchmarks/bench_profiles.py.
+STORAGE_PROFILES = {
+    # SQLite defaults: rollback journal, writers block readers
+    'rollback': {
+        'journal_mode': 'DELETE', 'synchronous': 'FULL', 'busy_timeout': 5000,
+        'cache_size': -2000, 'mmap_size': 0, 'temp_store': 'DEFAULT',
+    },
+    # WAL: readers never block the writer; NORMAL may lose the last commits on power loss
+    'wal': {
+        'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 5000,
+        'cache_size': -16000, 'mmap_size': 268435456, 'temp_store': 'MEMORY',
+    },
+    # WAL with an fsync per commit
+    'wal-durable': {
+        'journal_mode': 'WAL', 'synchronous': 'FULL', 'busy_timeout': 5000,
+        'cache_size': -16000, 'mmap_size': 268435456, 'temp_store': 'MEMORY',
+    },
+}
+DB_PROFILE = os.environ.get("WGVPN_DB_PROFILE", "wal")
+
+_PRAGMA_CHOICES = {
+    'journal_mode': {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'},
+    'synchronous': {'OFF', 'NORMAL', 'FULL', 'EXTRA'},
+    'temp_store': {'DEFAULT', 'FILE', 'MEMORY'},
+}
+
+def get_storage_settings(profile: str = None):
+    """Resolve a storage profile plus WGVPN_DB_<SETTING> overrides"""
+    profile = profile or DB_PROFILE
+    if profile not in STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage profile '{profile}', expected one of {', '.join(STORAGE_PROFILES)}")
+
+    settings = dict(STORAGE_PROFILES[profile])
+    for name, value in settings.items():
+        override = os.environ.get(f"WGVPN_DB_{name.upper()}")
+        if override is None:
+            continue
+        if name in _PRAGMA_CHOICES:
+            override = override.upper()
+            if override not in _PRAGMA_CHOICES[name]:
+                raise ValueError(f"Invalid WGVPN_DB_{name.upper()}: {override}")
+            settings[name] = override
+        else:
+            settings[name] = int(override)
+    return settings
+
+# ============== Connection Management ==============
+# Each thread keeps one persistent connection, opened and configured on
+# first use. The thread pools that run database work are bounded, so the
+# number of open connections is bounded too.
+
+_local = threading.local()
+_pool_lock = threading.Lock()
+_pool_stats = {'opened': 0, 'closed': 0, 'checkouts': 0}
+
+class _ManagedConnection(sqlite3.Connection):
+    """
+    sqlite3 connection that counts its own close() for the pool stats
+    Statements run through _TimedCursor, so every one of them is timed.
+    """
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or _TimedCursor)
+
+    # The C implementations would bypass the cursor subclass
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        # close() may be called again on a closed connection; count it once
+        if not getattr(self, '_closed', False):
+            self._closed = True
+            with _pool_lock:
+                _pool_stats['closed'] += 1
+        super().close()
+
+def _configure_connection(conn, settings):
+    """Apply per-connection settings once, right after connecting"""
     conn.row_factory = sqlite3.Row
+    # Set the busy timeout first so switching the journal mode waits for locks too
+    conn.execute(f"PRAGMA busy_timeout = {int(settings['busy_timeout'])}")
+    conn.execute(f"PRAGMA journal_mode = {settings['journal_mode']}")
+    conn.execute(f"PRAGMA synchronous = {settings['synchronous']}")
+    conn.execute(f"PRAGMA cache_size = {int(settings['cache_size'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(settings['mmap_size'])}")
+    conn.execute(f"PRAGMA temp_store = {settings['temp_store']}")
+
+def get_db_connection(profile: str = None, check_same_thread: bool = True):
+    """
+    Open a new dedicated database connection (caller closes it)
+    check_same_thread=False allows handing it between threads, one at a time
+    """
+    settings = get_storage_settings(profile)
+    conn = sqlite3.connect(
+        str(DATABASE_PATH),
+        timeout=settings['busy_timeout'] / 1000,
+        check_same_thread=check_same_thread,
+        factory=_ManagedConnection
+    )
+    _configure_connection(conn, settings)
+    with _pool_lock:
+        _pool_stats['opened'] += 1
     return conn
 
+@contextmanager
+def db_connection():
+    """
+    Borrow this thread's persistent connection
+    Commits when the outermost block exits cleanly and rolls back on error;
+    nested blocks share the outer transaction.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != DATABASE_PATH:
+        if conn is not None:
+            conn.close()
+        conn = get_db_connection()
+        _local.conn = conn
+        _local.path = DATABASE_PATH
+        _local.depth = 0
+
+    with _pool_lock:
+        _pool_stats['checkouts'] += 1
+    _local.depth += 1
+    try:
+        yield conn
+    except BaseException:
+        if _local.depth == 1:
+            conn.rollback()
+        raise
+    else:
+        if _local.depth == 1:
+            conn.commit()
+    finally:
+        _local.depth -= 1
+
+def close_thread_connection():
+    """Close the calling thread's persistent connection, if any"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+def get_pool_stats():
+    """Connection manager counters: opened, closed, open, checkouts"""
+    with _pool_lock:
+        stats = dict(_pool_stats)
+    stats['open'] = stats['opened'] - stats['closed']
+    return stats
+
+# ============== Statement Timing ==============
+# Every statement is timed until its first row is ready (aggregates and sorts
+# finish there; fetching the rows is not included). Totals are kept per SQL
+# text; statements slower than SLOW_QUERY_MS also go to a ring buffer with
+# the shape of their parameters (types, never values) and their query plan.
+
+# Statements at or above this many milliseconds are logged; 0 disables the log
+SLOW_QUERY_MS = float(os.environ.get("WGVPN_SLOW_QUERY_MS", "100"))
+
+# Slow statements kept in memory for the diagnostics endpoint
+SLOW_QUERY_LOG_SIZE = int(os.environ.get("WGVPN_SLOW_QUERY_LOG_SIZE", "100"))
+
+# Distinct SQL texts tracked; further ones are counted under '(other)'
+STATEMENT_STATS_LIMIT = 500
+
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+_timing_lock = threading.Lock()
+# normalized sql -> [calls, total seconds, max seconds]
+_statement_stats = {}
+_slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+class _TimedCursor(sqlite3.Cursor):
+    """Cursor that reports the duration of execute() and executemany()"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_statement(self.connection, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        # Peek the first row (for the shape and the plan) and count rows as
+        # sqlite3 pulls them, so generators keep streaming
+        rows = iter(seq_of_parameters)
+        first = next(rows, None)
+        count = [0]
+
+        def counted():
+            for parameters in chain((first,) if first is not None else (), rows):
+                count[0] += 1
+                yield parameters
+
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, counted())
+        finally:
+            _record_statement(self.connection, sql, first if first is not None else (),
+                              time.perf_counter() - started, rows=count[0])
+
+def _normalize_sql(sql):
+    return ' '.join(sql.split())
+
+def parameter_shape(parameters):
+    """Type names of bound parameters, e.g. '(int, str, None)' or '{start: str}'"""
+    def type_name(value):
+        return 'None' if value is None else type(value).__name__
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f"{key}: {type_name(value)}" for key, value in parameters.items()) + '}'
+    return '(' + ', '.join(type_name(value) for value in parameters) + ')'
+
+def _explain(conn, sql, parameters):
+    """EXPLAIN QUERY PLAN rows as indented lines, or None if the statement has no plan"""
+    if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+        return None
+    try:
+        # A plain cursor, so the EXPLAIN itself is not timed
+        rows = sqlite3.Cursor(conn).execute(f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+    except sqlite3.Error as e:
+        return [f"(EXPLAIN failed: {e})"]
+    depth = {0: -1}
+    plan = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        plan.append('  ' * depth[node_id] + detail)
+    return plan
+
+def _record_statement(conn, sql, parameters, seconds, rows=None):
+    key = _normalize_sql(sql)
+    with _timing_lock:
+        stats = _statement_stats.get(key)
+        if stats is None:
+            if len(_statement_stats) >= STATEMENT_STATS_LIMIT:
+                key = '(other)'
+            stats = _statement_stats.setdefault(key, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+    if SLOW_QUERY_MS <= 0 or seconds * 1000 < SLOW_QUERY_MS:
+        return
+    entry = {
+        'at': datetime.now().isoformat(),
+        'duration_ms': round(seconds * 1000, 2),
+        'sql': _normalize_sql(sql),
+        'params': parameter_shape(parameters),
+        'rows': rows,
+        'thread': threading.current_thread().name,
+        'plan': _explain(conn, sql, parameters),
+    }
+    with _timing_lock:
+        _slow_queries.append(entry)
+    print(f"Slow query ({entry['duration_ms']} ms, params {entry['params']}): {entry['sql'][:200]}")
+
+def get_statement_stats(limit: int = 50):
+    """Statements with the most total time: calls, total_ms, avg_ms, max_ms"""
+    with _timing_lock:
+        items = [(sql, list(stats)) for sql, stats in _statement_stats.items()]
+    items.sort(key=lambda item: item[1][1], reverse=True)
+    return [
+        {
+            'sql': sql,
+            'calls': calls,
+            'total_ms': round(total * 1000, 2),
+            'avg_ms': round(total * 1000 / calls, 3),
+            'max_ms': round(maximum * 1000, 2)
+        }
+        for sql, (calls, total, maximum) in items[:limit]
+    ]
+
+def get_slow_queries():
+    """Logged slow statements, newest first"""
+    with _timing_lock:
+        return list(reversed(_slow_queries))
+
+def reset_statement_timing():
+    """Clear the statement totals and the slow query log"""
+    with _timing_lock:
+        _statement_stats.clear()
+        _slow_queries.clear()
+
 def init_db():
-    """Initialize database with schema"""
+    """Initialize database with schema and upgrade it to the latest version"""
+    if not os.path.exists(DATABASE_PATH) or os.path.getsize(DATABASE_PATH) == 0:
+        # auto_vacuum only takes effect on a brand-new file, before the journal
+        # mode switch writes the header (existing files: enable_incremental_vacuum())
+        conn = sqlite3.connect(str(DATABASE_PATH))
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.close()
+
     conn = get_db_connection()
     schema_path = Path(__file__).parent.parent / "schema.sql"
     
@@ -24,63 +340,696 @@ def init_db():
     
     conn.executescript(schema)
     conn.commit()
+    migrate_db(conn)
     conn.close()
     print(f"Database initialized at {DATABASE_PATH}")
 
+# ============== Date Range Filters ==============
+# Timestamps are stored as 'YYYY-MM-DD HH:MM:SS' text, so a bare date compares
+# lower than every timestamp of that day. Comparing the raw column (instead of
+# DATE(column)) keeps the predicate sargable and lets indexes serve the range.
+
+class InvalidFilter(ValueError):
+    """Raised when a query filter from the API cannot be used"""
+
+class InvalidDateRange(InvalidFilter):
+    """Raised when a date filter is not a YYYY-MM-DD date"""
+
+def date_bounds(start_date: str = None, end_date: str = None):
+    """
+    Convert inclusive YYYY-MM-DD dates into half-open bounds
+    Returns (start, end) for column >= start AND column < end, where end is
+    the day after end_date; missing dates give None
+    Raises InvalidDateRange for malformed dates
+    """
+    def parse(value, name):
+        # A full timestamp is accepted and cut to its day; anything else is rejected whole
+        text = str(value)
+        try:
+            return date.fromisoformat(text)
+        except ValueError:
+            pass
+        try:
+            return datetime.fromisoformat(text).date()
+        except ValueError:
+            raise InvalidDateRange(f"Invalid {name} '{value}', expected YYYY-MM-DD") from None
+
+    start = parse(start_date, 'start_date').isoformat() if start_date else None
+    end = (parse(end_date, 'end_date') + timedelta(days=1)).isoformat() if end_date else None
+    return start, end
+
+def date_range_filter(column: str, start_date: str = None, end_date: str = None):
+    """
+    Build an ' AND ...' range condition on a timestamp column
+    Returns (sql, params); sql is empty when neither date is given
+    """
+    start, end = date_bounds(start_date, end_date)
+    sql, params = '', []
+    if start:
+        sql += f" AND {column} >= ?"
+        params.append(start)
+    if end:
+        sql += f" AND {column} < ?"
+        params.append(end)
+    return sql, params
+
+# ============== Keyset Pagination ==============
+# Log listings are ordered newest first by (timestamp, id). A cursor holds the
+# last row of a page; the next page continues right after it through an index
+# range instead of skipping OFFSET rows, so every page costs the same.
+
+class InvalidCursor(InvalidFilter):
+    """Raised when a pagination cursor cannot be decoded"""
+
+def encode_cursor(*key) -> str:
+    """Encode the sort key of a row, e.g. (timestamp, id), as an opaque cursor"""
+    raw = json.dumps(list(key), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str, shape=(str, int)):
+    """Decode a cursor from encode_cursor() back to a tuple of the given types"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        key = json.loads(raw)
+        if (isinstance(key, list) and len(key) == len(shape)
+                and all(type(value) is kind for value, kind in zip(key, shape))):
+            return tuple(key)
+    except (ValueError, TypeError):
+        pass
+    raise InvalidCursor(f"Invalid cursor '{cursor}'")
+
+def _fetch_log_page(conn, select_sql: str, count_sql: str, where_sql: str, params: list,
+                    time_column: str, limit: int, offset: int, after: str, include_total: bool):
+    """
+    Fetch one page of a log listing, newest first
+    With `after` (a cursor from a previous page) the page starts right after
+    that row and offset is ignored. The COUNT(*) only runs when include_total.
+    Returns (rows, total or None, next_cursor or None)
+    """
+    id_column = time_column.rpartition('.')[0] + '.id' if '.' in time_column else 'id'
+    page_sql, page_params = where_sql, list(params)
+    if after:
+        after_time, after_id = decode_cursor(after)
+        page_sql += f" AND {time_column} <= ? AND ({time_column} < ? OR {id_column} < ?)"
+        page_params += [after_time, after_time, after_id]
+        offset = 0
+
+    # One extra row tells whether another page exists
+    rows = conn.execute(
+        f"{select_sql}{page_sql} ORDER BY {time_column} DESC, {id_column} DESC LIMIT ? OFFSET ?",
+        page_params + [limit + 1, offset]
+    ).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][time_column.rpartition('.')[2]], rows[-1]['id'])
+
+    total = None
+    if include_total:
+        total = conn.execute(f"{count_sql}{where_sql}", params).fetchone()[0]
+    return [dict(row) for row in rows], total, next_cursor
+
+# ============== Schema Migrations ==============
+# Each migration must be idempotent: fresh databases already get the latest
+# tables from schema.sql and still run every migration once.
+
+def _column_exists(conn, table: str, column: str) -> bool:
+    """Check whether a table has a column"""
+    return any(row['name'] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+def _migration_traffic_deltas(conn):
+    """Add per-sample delta columns to traffic_logs"""
+    for column in ('delta_received', 'delta_sent'):
+        if not _column_exists(conn, 'traffic_logs', column):
+            conn.execute(f"ALTER TABLE traffic_logs ADD COLUMN {column} INTEGER")
+
+def _migration_traffic_records_unique(conn):
+    """Make traffic_records unique per (user_id, date)"""
+    # Fold any duplicate daily rows into the oldest one before adding the key
+    conn.execute(
+        """UPDATE traffic_records SET
+               bytes_received = (SELECT SUM(t.bytes_received) FROM traffic_records t
+                                 WHERE t.user_id = traffic_records.user_id AND t.date = traffic_records.date),
+               bytes_sent = (SELECT SUM(t.bytes_sent) FROM traffic_records t
+                             WHERE t.user_id = traffic_records.user_id AND t.date = traffic_records.date)
+           WHERE id IN (SELECT MIN(id) FROM traffic_records GROUP BY user_id, date HAVING COUNT(*) > 1)"""
+    )
+    conn.execute(
+        """DELETE FROM traffic_records
+           WHERE id NOT IN (SELECT MIN(id) FROM traffic_records GROUP BY user_id, date)"""
+    )
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_traffic_records_user_date ON traffic_records(user_id, date)")
+
+def _migration_traffic_tiers(conn):
+    """Add minute/hour traffic rollup tiers and daily sample counts"""
+    if not _column_exists(conn, 'traffic_records', 'samples'):
+        conn.execute("ALTER TABLE traffic_records ADD COLUMN samples INTEGER DEFAULT 0")
+    for table in ('traffic_rollup_minute', 'traffic_rollup_hour'):
+        conn.execute(
+            f"""CREATE TABLE IF NOT EXISTS {table} (
+                    bucket TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    bytes_received INTEGER DEFAULT 0,
+                    bytes_sent INTEGER DEFAULT 0,
+                    samples INTEGER DEFAULT 0,
+                    PRIMARY KEY (bucket, user_id)
+                ) WITHOUT ROWID"""
+        )
+
+# Secondary indexes, shaped after the WHERE / ORDER BY of the query helpers:
+# equality columns first, then the column the results are ordered by
+HOT_FILTER_INDEXES = {
+    'idx_traffic_logs_user_time': 'traffic_logs (user_id, snapshot_time)',
+    'idx_traffic_logs_time': 'traffic_logs (snapshot_time)',
+    'idx_traffic_logs_peer_id': 'traffic_logs (peer_public_key, id)',
+    'idx_connection_logs_user_time': 'connection_logs (user_id, connected_at)',
+    'idx_connection_logs_time': 'connection_logs (connected_at)',
+    'idx_connection_logs_open': 'connection_logs (connected_at) WHERE disconnected_at IS NULL',
+    'idx_audit_logs_time': 'audit_logs (created_at)',
+    'idx_audit_logs_user_time': 'audit_logs (user_id, created_at)',
+    'idx_audit_logs_action_time': 'audit_logs (action, created_at)',
+    'idx_login_history_time': 'login_history (created_at)',
+    'idx_login_history_user_time': 'login_history (user_id, created_at)',
+    'idx_system_events_time': 'system_events (created_at)',
+    'idx_system_events_type_time': 'system_events (event_type, created_at)',
+    'idx_alerts_resolved_time': 'alerts (is_resolved, created_at)',
+    'idx_alerts_user_time': 'alerts (user_id, created_at)',
+    'idx_users_public_key': 'users (public_key)',
+}
+
+def _migration_hot_filter_indexes(conn):
+    """Add indexes for the hot log and lookup filters"""
+    for name, definition in HOT_FILTER_INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+    # Give the planner statistics for the new indexes right away
+    conn.execute("ANALYZE")
+
+def _fts5_available(conn) -> bool:
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(content)")
+        conn.execute("DROP TABLE temp.fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def _create_log_search_index(conn) -> bool:
+    """Create the FTS5 log search table and its sync triggers (False without FTS5)"""
+    if not _fts5_available(conn):
+        return False
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS log_search_fts USING fts5(content, prefix='2 3')"
+    )
+    for rank, (source, _, _, _, text) in enumerate(LOG_SEARCH_SOURCES.values()):
+        table = source.split()[0]
+        conn.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN
+                    INSERT INTO log_search_fts (rowid, content)
+                    VALUES (NEW.id * {LOG_SEARCH_SLOTS} + {rank}, {text.format(row='NEW')});
+                END"""
+        )
+        conn.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN
+                    DELETE FROM log_search_fts WHERE rowid = OLD.id * {LOG_SEARCH_SLOTS} + {rank};
+                END"""
+        )
+        # Only updates of the indexed columns touch the index (not disconnected_at etc.)
+        columns = ', '.join(dict.fromkeys(re.findall(r'\{row\}\.(\w+)', text)))
+        conn.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF {columns} ON {table} BEGIN
+                    DELETE FROM log_search_fts WHERE rowid = OLD.id * {LOG_SEARCH_SLOTS} + {rank};
+                    INSERT INTO log_search_fts (rowid, content)
+                    VALUES (NEW.id * {LOG_SEARCH_SLOTS} + {rank}, {text.format(row='NEW')});
+                END"""
+        )
+
+    # Connection and traffic rows are indexed with their user's name
+    reindex = []
+    for rank, (source, _, _, _, text) in enumerate(LOG_SEARCH_SOURCES.values()):
+        table = source.split()[0]
+        if 'FROM users' in text:
+            reindex.append(
+                f"""DELETE FROM log_search_fts WHERE rowid IN
+                        (SELECT id * {LOG_SEARCH_SLOTS} + {rank} FROM {table} WHERE user_id = NEW.id);
+                    INSERT INTO log_search_fts (rowid, content)
+                        SELECT id * {LOG_SEARCH_SLOTS} + {rank}, {text.format(row=table)}
+                        FROM {table} WHERE user_id = NEW.id;"""
+            )
+    conn.execute(
+        f"""CREATE TRIGGER IF NOT EXISTS users_search_rename AFTER UPDATE OF username ON users
+                WHEN OLD.username IS NOT NEW.username BEGIN
+                {''.join(reindex)}
+            END"""
+    )
+    return True
+
+def _populate_log_search_index(conn) -> int:
+    """Re-index every existing log row; returns the number of rows indexed"""
+    conn.execute("DELETE FROM log_search_fts")
+    indexed = 0
+    for rank, (source, _, _, _, text) in enumerate(LOG_SEARCH_SOURCES.values()):
+        table = source.split()[0]
+        cursor = conn.execute(
+            f"""INSERT INTO log_search_fts (rowid, content)
+                SELECT id * {LOG_SEARCH_SLOTS} + {rank}, {text.format(row=table)} FROM {table}"""
+        )
+        indexed += cursor.rowcount
+    conn.execute("INSERT INTO log_search_fts (log_search_fts) VALUES ('optimize')")
+    return indexed
+
+def rebuild_log_search_index():
+    """Create the log search index if needed and re-index all log rows"""
+    with db_connection() as conn:
+        if not _create_log_search_index(conn):
+            raise RuntimeError("SQLite was built without FTS5")
+        return _populate_log_search_index(conn)
+
+def _migration_log_search_index(conn):
+    """Add the FTS5 log search index"""
+    if _create_log_search_index(conn):
+        _populate_log_search_index(conn)
+    else:
+        print("SQLite was built without FTS5; log search keeps using LIKE")
+
+# Columns tracking queued report generation, added to both report tables
+REPORT_JOB_COLUMNS = {
+    'compliance_reports': [('progress', 'REAL DEFAULT 0'), ('error', 'TEXT'), ('started_at', 'TIMESTAMP')],
+    'generated_reports': [('status', "TEXT DEFAULT 'completed'"), ('progress', 'REAL DEFAULT 0'),
+                          ('error', 'TEXT'), ('started_at', 'TIMESTAMP'), ('completed_at', 'TIMESTAMP')],
+}
+
+def _migration_report_job_columns(conn):
+    """Add status and progress columns for queued report generation"""
+    for table, columns in REPORT_JOB_COLUMNS.items():
+        for column, definition in columns:
+            if not _column_exists(conn, table, column):
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _migration_peer_counter_index(conn):
+    """Index traffic_logs by peer for the collector's last counters"""
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_traffic_logs_peer_id ON {HOT_FILTER_INDEXES['idx_traffic_logs_peer_id']}")
+
+def _migration_log_search_update_triggers(conn):
+    """Keep the log search index in sync when log rows or usernames change"""
+    # Re-indexing also fixes rows that went stale before the triggers existed
+    if _create_log_search_index(conn):
+        _populate_log_search_index(conn)
+
+MIGRATIONS = [
+    (1, _migration_traffic_deltas),
+    (2, _migration_traffic_records_unique),
+    (3, _migration_traffic_tiers),
+    (4, _migration_hot_filter_indexes),
+    (5, _migration_log_search_index),
+    (6, _migration_report_job_columns),
+    (7, _migration_peer_counter_index),
+    (8, _migration_log_search_update_triggers),
+]
+
+def migrate_db(conn):
+    """Apply pending migrations, tracked with PRAGMA user_version"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migration in MIGRATIONS:
+        if version < target:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+            print(f"Database migrated to version {target} ({migration.__doc__})")
+
 def log_traffic(user_id: int, peer_public_key: str, bytes_received: int, bytes_sent: int):
     """Log traffic snapshot for a user"""
+    with db_connection() as conn:
+        conn.execute(
+            """INSERT INTO traffic_logs (user_id, peer_public_key, bytes_received, bytes_sent)
+               VALUES (?, ?, ?, ?)""",
+            (user_id, peer_public_key, bytes_received, bytes_sent)
+        )
+
+def log_traffic_batch(rows, snapshot_time: str = None):
+    """
+    Log a whole poll cycle of traffic snapshots in a single transaction
+    rows: iterable of (user_id, peer_public_key, bytes_received, bytes_sent,
+          delta_received, delta_sent)
+    snapshot_time: shared UTC timestamp 'YYYY-MM-DD HH:MM:SS' (defaults to now)
+    Returns ingest stats: rows, elapsed_ms, rows_per_sec
+    """
+    if snapshot_time is None:
+        snapshot_time = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    params = [(*row, snapshot_time) for row in rows]
+
+    started = time.perf_counter()
+    with db_connection() as conn:
+        conn.executemany(
+            """INSERT INTO traffic_logs
+               (user_id, peer_public_key, bytes_received, bytes_sent, delta_received, delta_sent, snapshot_time)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            params
+        )
+        _rollup_traffic(conn, ((row[0], row[4], row[5], row[6]) for row in params))
+    elapsed = time.perf_counter() - started
+
+    return {
+        'rows': len(params),
+        'elapsed_ms': round(elapsed * 1000, 3),
+        'rows_per_sec': round(len(params) / elapsed, 1) if elapsed > 0 else None
+    }
+
+# ============== Traffic Rollup Tiers ==============
+# (table, bucket column, resolution in seconds, bucket key from a
+#  'YYYY-MM-DD HH:MM:SS' timestamp, retention), finest first
+
+TRAFFIC_TIERS = [
+    ('traffic_rollup_minute', 'bucket', 60, lambda ts: ts[:16],
+     timedelta(hours=MINUTE_ROLLUP_RETENTION_HOURS)),
+    ('traffic_rollup_hour', 'bucket', 3600, lambda ts: ts[:13] + ':00',
+     timedelta(days=HOURLY_ROLLUP_RETENTION_DAYS)),
+    ('traffic_records', 'date', 86400, lambda ts: ts[:10], None),
+]
+
+def _rollup_traffic(conn, samples, since: dict = None):
+    """
+    Accumulate traffic deltas into every rollup tier (minute, hour, day)
+    samples: iterable of (user_id, delta_received, delta_sent, snapshot_time)
+    since: optional {table: timestamp}; older samples skip that tier
+    Runs inside the caller's transaction.
+    """
+    totals = {table: {} for table, *_ in TRAFFIC_TIERS}
+    for user_id, delta_received, delta_sent, snapshot_time in samples:
+        delta_received = delta_received or 0
+        delta_sent = delta_sent or 0
+        for table, _, _, bucket_of, _ in TRAFFIC_TIERS:
+            if since and snapshot_time < since[table]:
+                continue
+            key = (user_id, bucket_of(snapshot_time))
+            received, sent, count = totals[table].get(key, (0, 0, 0))
+            totals[table][key] = (received + delta_received, sent + delta_sent, count + 1)
+
+    for table, column, _, _, _ in TRAFFIC_TIERS:
+        if not totals[table]:
+            continue
+        conflict = "user_id, date" if table == 'traffic_records' else "bucket, user_id"
+        conn.executemany(
+            f"""INSERT INTO {table} (user_id, {column}, bytes_received, bytes_sent, samples)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT({conflict}) DO UPDATE SET
+                    bytes_received = bytes_received + excluded.bytes_received,
+                    bytes_sent = bytes_sent + excluded.bytes_sent,
+                    samples = samples + excluded.samples""",
+            [(user_id, bucket, received, sent, count)
+             for (user_id, bucket), (received, sent, count) in totals[table].items()]
+        )
+
+def prune_traffic_rollups():
+    """Drop minute/hour rollup buckets older than their retention. Returns rows removed per table."""
+    now = datetime.utcnow()
+    removed = {}
+    with db_connection() as conn:
+        for table, column, _, bucket_of, retention in TRAFFIC_TIERS:
+            if retention is None:
+                continue
+            cutoff = bucket_of((now - retention).strftime('%Y-%m-%d %H:%M:%S'))
+            removed[table] = conn.execute(f"DELETE FROM {table} WHERE {column} < ?", (cutoff,)).rowcount
+    return removed
+
+# ============== Retention ==============
+
+def prune_table(table: str, column: str, older_than: datetime, condition: str = None,
+                batch_size: int = 1000, pause: float = 0.05):
+    """
+    Delete rows whose column is older than older_than (UTC) in small
+    rowid-bounded batches, each in its own short transaction, pausing between
+    batches so the traffic collector can take the write lock. Returns rows removed.
+    """
+    cutoff = older_than.strftime('%Y-%m-%d %H:%M:%S')
+    where = f"{column} < ?" + (f" AND {condition}" if condition else "")
+    removed = 0
+    last_id = 0
+    while True:
+        with db_connection() as conn:
+            ids = conn.execute(
+                f"SELECT id FROM {table} WHERE id > ? AND {where} ORDER BY id LIMIT ?",
+                (last_id, cutoff, batch_size)
+            ).fetchall()
+            if not ids:
+                break
+            removed += conn.execute(
+                f"DELETE FROM {table} WHERE id >= ? AND id <= ? AND {where}",
+                (ids[0]['id'], ids[-1]['id'], cutoff)
+            ).rowcount
+        last_id = ids[-1]['id']
+        if len(ids) < batch_size:
+            break
+        time.sleep(pause)
+    return removed
+
+def run_retention(batch_size: int = 1000):
+    """
+    Enforce RETENTION_POLICIES and the rollup tier retention, then reclaim
+    free pages and refresh planner statistics.
+    Returns a report with rows removed per table and seconds spent.
+    """
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    removed = {}
+    for table, (column, days, condition) in RETENTION_POLICIES.items():
+        if days > 0:
+            removed[table] = prune_table(table, column, now - timedelta(days=days), condition, batch_size)
+    removed.update(prune_traffic_rollups())
+
+    with db_connection() as conn:
+        # No-op unless the database uses auto_vacuum = INCREMENTAL
+        conn.execute("PRAGMA incremental_vacuum(2000)").fetchall()
+        conn.execute("PRAGMA optimize")
+    with db_connection() as conn:
+        # Fold the WAL back into the database file (no-op in rollback mode)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    return {
+        'removed': removed,
+        'total_removed': sum(removed.values()),
+        'elapsed_seconds': round(time.perf_counter() - started, 3)
+    }
+
+def enable_incremental_vacuum():
+    """Switch an existing database to auto_vacuum = INCREMENTAL (rewrites the whole file)"""
     conn = get_db_connection()
-    conn.execute(
-        """INSERT INTO traffic_logs (user_id, peer_public_key, bytes_received, bytes_sent)
-           VALUES (?, ?, ?, ?)""",
-        (user_id, peer_public_key, bytes_received, bytes_sent)
-    )
-    conn.commit()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
     conn.close()
+    return mode
+
+def _pick_traffic_tier(start: datetime, bucket_seconds: int):
+    """
+    Pick the coarsest tier whose resolution divides bucket_seconds and whose
+    retention still covers start; falls back to the finest covering tier
+    """
+    now = datetime.utcnow()
+    covering = [tier for tier in TRAFFIC_TIERS if tier[4] is None or start >= now - tier[4]]
+    fitting = [tier for tier in covering if bucket_seconds % tier[2] == 0]
+    return fitting[-1] if fitting else covering[0]
+
+def get_traffic_series(start: str, end: str = None, bucket_seconds: int = 3600, user_id: int = None):
+    """
+    Get traffic totals per time bucket from the rollup tiers
+    start/end: UTC 'YYYY-MM-DD[ HH:MM:SS]', end exclusive (defaults to now)
+    Buckets are aligned to multiples of bucket_seconds since the epoch.
+    """
+    start_dt = datetime.fromisoformat(start)
+    end_dt = datetime.fromisoformat(end) if end else datetime.utcnow()
+    table, column, resolution, bucket_of, _ = _pick_traffic_tier(start_dt, bucket_seconds)
+    # A bucket can't be finer than the tier that serves it
+    bucket_seconds = max(resolution, bucket_seconds - bucket_seconds % resolution)
+
+    query = f"""SELECT 
+                   datetime(CAST(strftime('%s', {column}) AS INTEGER) / ? * ?, 'unixepoch') as bucket,
+                   SUM(bytes_received) as total_received,
+                   SUM(bytes_sent) as total_sent,
+                   SUM(samples) as snapshot_count
+                FROM {table}
+                WHERE {column} >= ? AND {column} <= ?"""
+    params = [bucket_seconds, bucket_seconds,
+              bucket_of(start_dt.strftime('%Y-%m-%d %H:%M:%S')),
+              bucket_of((end_dt - timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S'))]
+
+    if user_id:
+        query += " AND user_id = ?"
+        params.append(user_id)
+
+    query += " GROUP BY 1 ORDER BY 1"
+
+    with db_connection() as conn:
+        cursor = conn.execute(query, params)
+        rows = cursor.fetchall()
+    return {
+        'tier': table,
+        'bucket_seconds': bucket_seconds,
+        'series': [dict(row) for row in rows]
+    }
+
+def _rebuild_start(oldest: str, resolution: int, retention: timedelta, now: datetime) -> str:
+    """First bucket boundary a tier can be rebuilt from, as a timestamp"""
+    step = timedelta(seconds=resolution)
+    start = datetime.strptime(oldest[:19], '%Y-%m-%d %H:%M:%S')
+    # The bucket holding the oldest raw sample may have lost rows to retention
+    boundary = datetime.min + (start - datetime.min) // step * step
+    if boundary < start:
+        boundary += step
+    if retention is not None:
+        boundary = max(boundary, datetime.min + (now - retention - datetime.min) // step * step)
+    return boundary.strftime('%Y-%m-%d %H:%M:%S')
+
+def rebuild_traffic_rollups(batch_size: int = 5000):
+    """
+    Rebuild the traffic rollup tiers from the raw traffic_logs
+    Only buckets the raw logs still fully cover are rebuilt, so daily
+    history older than the traffic_logs retention is kept. Each day is
+    deleted and rolled up again in one transaction, so readers never see
+    it empty; rows logged later are rolled up by the collector itself.
+    Returns rows processed.
+    """
+    backfill_traffic_deltas(batch_size=batch_size)
+
+    with db_connection() as conn:
+        oldest, newest = conn.execute("SELECT MIN(snapshot_time), MAX(snapshot_time) FROM traffic_logs").fetchone()
+    if oldest is None:
+        return 0
+
+    now = datetime.utcnow()
+    since = {table: _rebuild_start(oldest, resolution, retention, now)
+             for table, _, resolution, _, retention in TRAFFIC_TIERS}
+    day = datetime.strptime(min(since.values())[:10], '%Y-%m-%d')
+    last_day = datetime.strptime(newest[:10], '%Y-%m-%d')
+
+    processed = 0
+    while day <= last_day:
+        day_start = day.strftime('%Y-%m-%d %H:%M:%S')
+        day_end = (day + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+        with db_connection() as conn:
+            for table, column, _, bucket_of, _ in TRAFFIC_TIERS:
+                lower = max(day_start, since[table])
+                if lower < day_end:
+                    conn.execute(f"DELETE FROM {table} WHERE {column} >= ? AND {column} < ?",
+                                 (bucket_of(lower), bucket_of(day_end)))
+            rows = conn.execute(
+                """SELECT user_id, delta_received, delta_sent, snapshot_time FROM traffic_logs
+                   WHERE snapshot_time >= ? AND snapshot_time < ?""",
+                (max(day_start, min(since.values())), day_end)
+            ).fetchall()
+            _rollup_traffic(conn, (tuple(row) for row in rows), since)
+        processed += len(rows)
+        day += timedelta(days=1)
+    return processed
+
+def get_latest_traffic_counters():
+    """
+    Get the last stored cumulative counters of every peer
+    Returns {peer_public_key: (bytes_received, bytes_sent)}
+    """
+    # Skip from one peer to the next on idx_traffic_logs_peer_id instead of
+    # grouping the whole table: one index seek per peer
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """WITH RECURSIVE peers(key) AS (
+                   SELECT MIN(peer_public_key) FROM traffic_logs
+                   UNION ALL
+                   SELECT (SELECT MIN(peer_public_key) FROM traffic_logs WHERE peer_public_key > key)
+                   FROM peers WHERE key IS NOT NULL
+               )
+               SELECT t.peer_public_key, t.bytes_received, t.bytes_sent
+               FROM peers
+               JOIN traffic_logs t ON t.id = (SELECT MAX(id) FROM traffic_logs WHERE peer_public_key = peers.key)"""
+        )
+        rows = cursor.fetchall()
+    return {row['peer_public_key']: (row['bytes_received'], row['bytes_sent']) for row in rows}
+
+def compute_counter_delta(previous, bytes_received: int, bytes_sent: int):
+    """
+    Compute traffic since the previous cumulative sample of a peer
+    previous: (bytes_received, bytes_sent) or None for a first sample
+    Returns (delta_received, delta_sent, is_reset). A counter going backwards
+    means the interface restarted, so the new value is all fresh traffic.
+    """
+    if previous is None:
+        return 0, 0, False
+    prev_received, prev_sent = previous
+    if bytes_received < prev_received or bytes_sent < prev_sent:
+        return bytes_received, bytes_sent, True
+    return bytes_received - prev_received, bytes_sent - prev_sent, False
+
+def backfill_traffic_deltas(batch_size: int = 5000):
+    """
+    Compute delta columns for traffic_logs rows stored before deltas existed
+    Walks the table in id order, batch_size rows at a time, keeping only the
+    last counters per peer in memory. Returns number of rows updated.
+    """
+    last_counters = {}
+    last_id = 0
+    updated = 0
+    while True:
+        with db_connection() as conn:
+            rows = conn.execute(
+                """SELECT id, peer_public_key, bytes_received, bytes_sent, delta_received
+                   FROM traffic_logs WHERE id > ? ORDER BY id LIMIT ?""",
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row in rows:
+                key = row['peer_public_key']
+                if row['delta_received'] is None:
+                    delta_received, delta_sent, _ = compute_counter_delta(
+                        last_counters.get(key), row['bytes_received'], row['bytes_sent'])
+                    updates.append((delta_received, delta_sent, row['id']))
+                last_counters[key] = (row['bytes_received'], row['bytes_sent'])
+            conn.executemany(
+                "UPDATE traffic_logs SET delta_received = ?, delta_sent = ? WHERE id = ?",
+                updates
+            )
+        updated += len(updates)
+        last_id = rows[-1]['id']
+    return updated
 
 def get_recent_traffic_logs(limit: int = 100):
     """Get recent traffic logs"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        """SELECT tl.*, u.username 
-           FROM traffic_logs tl 
-           JOIN users u ON tl.user_id = u.id 
-           ORDER BY tl.snapshot_time DESC 
-           LIMIT ?""",
-        (limit,)
-    )
-    rows = cursor.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """SELECT tl.*, u.username 
+               FROM traffic_logs tl 
+               JOIN users u ON tl.user_id = u.id 
+               ORDER BY tl.snapshot_time DESC 
+               LIMIT ?""",
+            (limit,)
+        )
+        rows = cursor.fetchall()
     return [dict(row) for row in rows]
 
 def get_users(page: int = 1, per_page: int = 20, search: str = None, is_active: bool = None):
     """Get users with pagination and filtering"""
-    conn = get_db_connection()
-    
-    query = "SELECT id, username, email, public_key, is_active, created_at, updated_at FROM users WHERE 1=1"
-    params = []
+    with db_connection() as conn:
+        query = "SELECT id, username, email, public_key, is_active, created_at, updated_at FROM users WHERE 1=1"
+        params = []
     
-    if search:
-        query += " AND (username LIKE ? OR email LIKE ?)"
-        params.extend([f'%{search}%', f'%{search}%'])
+        if search:
+            query += " AND (username LIKE ? OR email LIKE ?)"
+            params.extend([f'%{search}%', f'%{search}%'])
     
-    if is_active is not None:
-        query += " AND is_active = ?"
-        params.append(1 if is_active else 0)
+        if is_active is not None:
+            query += " AND is_active = ?"
+            params.append(1 if is_active else 0)
     
-    # Get total count
-    count_query = query.replace("SELECT id, username, email, public_key, is_active, created_at, updated_at", "SELECT COUNT(*) as count")
-    cursor = conn.execute(count_query, params)
-    total_count = cursor.fetchone()['count']
+        # Get total count
+        count_query = query.replace("SELECT id, username, email, public_key, is_active, created_at, updated_at", "SELECT COUNT(*) as count")
+        cursor = conn.execute(count_query, params)
+        total_count = cursor.fetchone()['count']
     
-    # Add pagination
-    query += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
-    offset = (page - 1) * per_page
-    params.extend([per_page, offset])
+        # Add pagination
+        query += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
+        offset = (page - 1) * per_page
+        params.extend([per_page, offset])
     
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    conn.close()
+        cursor = conn.execute(query, params)
+        rows = cursor.fetchall()
     
     return {
         'users': [dict(row) for row in rows],
@@ -92,317 +1041,274 @@ def get_users(page: int = 1, per_page: int = 20, search: str = None, is_active:
 
 def get_user_by_id(user_id: int):
     """Get user by ID"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        "SELECT id, username, email, password_hash, public_key, private_key, allowed_ips, is_active, created_at, updated_at FROM users WHERE id = ?",
-        (user_id,)
-    )
-    row = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute(
+            "SELECT id, username, email, password_hash, public_key, private_key, allowed_ips, is_active, created_at, updated_at FROM users WHERE id = ?",
+            (user_id,)
+        )
+        row = cursor.fetchone()
     return dict(row) if row else None
 
 def get_user_by_username(username: str):
     """Get user by username (for authentication)"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        "SELECT * FROM users WHERE username = ?",
-        (username,)
-    )
-    row = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute(
+            "SELECT * FROM users WHERE username = ?",
+            (username,)
+        )
+        row = cursor.fetchone()
     return dict(row) if row else None
 
 def create_user(username: str, email: str, password_hash: str, public_key: str = None, private_key: str = None, allowed_ips: str = None):
     """Create a new user"""
-    conn = get_db_connection()
     try:
-        cursor = conn.execute(
-            """INSERT INTO users (username, email, password_hash, public_key, private_key, allowed_ips, is_active, created_at, updated_at)
-               VALUES (?, ?, ?, ?, ?, ?, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)""",
-            (username, email, password_hash, public_key, private_key, allowed_ips or "10.0.0.2/32")
-        )
-        conn.commit()
-        user_id = cursor.lastrowid
-        
-        # Create audit log
-        conn.execute(
-            """INSERT INTO audit_logs (user_id, action, details, created_at)
-               VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
-            (user_id, 'user_created', f'User {username} created')
-        )
-        conn.commit()
-        
-        conn.close()
-        return get_user_by_id(user_id)
+        with db_connection() as conn:
+            cursor = conn.execute(
+                """INSERT INTO users (username, email, password_hash, public_key, private_key, allowed_ips, is_active, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)""",
+                (username, email, password_hash, public_key, private_key, allowed_ips or "10.0.0.2/32")
+            )
+            user_id = cursor.lastrowid
+            
+            # Create audit log
+            conn.execute(
+                """INSERT INTO audit_logs (user_id, action, details, created_at)
+                   VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
+                (user_id, 'user_created', f'User {username} created')
+            )
     except sqlite3.IntegrityError as e:
-        conn.close()
         raise ValueError(f"User already exists: {e}")
+    
+    return get_user_by_id(user_id)
 
 def update_user(user_id: int, username: str = None, email: str = None, allowed_ips: str = None):
     """Update user details"""
-    conn = get_db_connection()
-    
-    updates = []
-    params = []
-    
-    if username:
-        updates.append("username = ?")
-        params.append(username)
-    if email:
-        updates.append("email = ?")
-        params.append(email)
-    if allowed_ips:
-        updates.append("allowed_ips = ?")
-        params.append(allowed_ips)
+    with db_connection() as conn:
+        updates = []
+        params = []
     
-    updates.append("updated_at = CURRENT_TIMESTAMP")
-    params.append(user_id)
+        if username:
+            updates.append("username = ?")
+            params.append(username)
+        if email:
+            updates.append("email = ?")
+            params.append(email)
+        if allowed_ips:
+            updates.append("allowed_ips = ?")
+            params.append(allowed_ips)
+    
+        updates.append("updated_at = CURRENT_TIMESTAMP")
+        params.append(user_id)
     
-    query = f"UPDATE users SET {', '.join(updates)} WHERE id = ?"
-    conn.execute(query, params)
-    conn.commit()
+        query = f"UPDATE users SET {', '.join(updates)} WHERE id = ?"
+        conn.execute(query, params)
     
-    # Create audit log
-    conn.execute(
-        """INSERT INTO audit_logs (user_id, action, details, created_at)
-           VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
-        (user_id, 'user_updated', f'User ID {user_id} updated')
-    )
-    conn.commit()
-    conn.close()
+        # Create audit log
+        conn.execute(
+            """INSERT INTO audit_logs (user_id, action, details, created_at)
+               VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
+            (user_id, 'user_updated', f'User ID {user_id} updated')
+        )
     
     return get_user_by_id(user_id)
 
 def delete_user(user_id: int):
     """Delete a user"""
-    conn = get_db_connection()
-    
-    # Get user info before deletion
-    user = get_user_by_id(user_id)
-    if not user:
-        conn.close()
-        return False
+    with db_connection() as conn:
+        # Get user info before deletion
+        user = get_user_by_id(user_id)
+        if not user:
+            return False
     
-    # Delete user
-    conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    conn.commit()
+        # Delete user
+        conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
     
-    # Create audit log
-    conn.execute(
-        """INSERT INTO audit_logs (user_id, action, details, created_at)
-           VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
-        (user_id, 'user_deleted', f'User {user["username"]} deleted')
-    )
-    conn.commit()
-    conn.close()
+        # Create audit log
+        conn.execute(
+            """INSERT INTO audit_logs (user_id, action, details, created_at)
+               VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
+            (user_id, 'user_deleted', f'User {user["username"]} deleted')
+        )
     
     return True
 
 def toggle_user_active(user_id: int):
     """Toggle user active status"""
-    conn = get_db_connection()
-    
-    # Get current status
-    cursor = conn.execute("SELECT is_active, username FROM users WHERE id = ?", (user_id,))
-    row = cursor.fetchone()
-    if not row:
-        conn.close()
-        return None
+    with db_connection() as conn:
+        # Get current status
+        cursor = conn.execute("SELECT is_active, username FROM users WHERE id = ?", (user_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
     
-    new_status = 0 if row['is_active'] else 1
-    conn.execute("UPDATE users SET is_active = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (new_status, user_id))
-    conn.commit()
+        new_status = 0 if row['is_active'] else 1
+        conn.execute("UPDATE users SET is_active = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (new_status, user_id))
     
-    # Create audit log
-    status_text = "enabled" if new_status else "disabled"
-    conn.execute(
-        """INSERT INTO audit_logs (user_id, action, details, created_at)
-           VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
-        (user_id, 'user_toggle_active', f'User {row["username"]} {status_text}')
-    )
-    conn.commit()
-    conn.close()
+        # Create audit log
+        status_text = "enabled" if new_status else "disabled"
+        conn.execute(
+            """INSERT INTO audit_logs (user_id, action, details, created_at)
+               VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
+            (user_id, 'user_toggle_active', f'User {row["username"]} {status_text}')
+        )
     
     return get_user_by_id(user_id)
 
 def update_user_keys(user_id: int, public_key: str, private_key: str):
     """Update user's WireGuard keys"""
-    conn = get_db_connection()
-    conn.execute(
-        "UPDATE users SET public_key = ?, private_key = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-        (public_key, private_key, user_id)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE users SET public_key = ?, private_key = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (public_key, private_key, user_id)
+        )
     return get_user_by_id(user_id)
 
 def update_password(user_id: int, password_hash: str):
     """Update user's password"""
-    conn = get_db_connection()
-    conn.execute(
-        "UPDATE users SET password_hash = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-        (password_hash, user_id)
-    )
-    conn.commit()
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE users SET password_hash = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (password_hash, user_id)
+        )
     
-    # Create audit log
-    conn.execute(
-        """INSERT INTO audit_logs (user_id, action, details, created_at)
-           VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
-        (user_id, 'password_changed', 'User password changed')
-    )
-    conn.commit()
-    conn.close()
+        # Create audit log
+        conn.execute(
+            """INSERT INTO audit_logs (user_id, action, details, created_at)
+               VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
+            (user_id, 'password_changed', 'User password changed')
+        )
 
 def get_user_by_public_key(public_key: str):
     """Get user by WireGuard public key"""
-    conn = get_db_connection()
-    cursor = conn.execute("SELECT id, username, email FROM users WHERE public_key = ?", (public_key,))
-    row = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute("SELECT id, username, email FROM users WHERE public_key = ?", (public_key,))
+        row = cursor.fetchone()
     return dict(row) if row else None
 
+def get_peer_user_map():
+    """Get mapping of WireGuard public key to user (id, username)"""
+    with db_connection() as conn:
+        cursor = conn.execute("SELECT id, username, public_key FROM users WHERE public_key IS NOT NULL")
+        rows = cursor.fetchall()
+    return {row['public_key']: {'id': row['id'], 'username': row['username']} for row in rows}
+
 # ============== Traffic History Functions ==============
 
 def get_traffic_history(user_id: int = None, start_date: str = None, end_date: str = None, limit: int = 1000):
     """
     Get traffic history with optional filtering
     """
-    conn = get_db_connection()
-    
-    query = """SELECT tl.*, u.username 
-               FROM traffic_logs tl 
-               JOIN users u ON tl.user_id = u.id 
-               WHERE 1=1"""
-    params = []
-    
-    if user_id:
-        query += " AND tl.user_id = ?"
-        params.append(user_id)
+    with db_connection() as conn:
+        query = """SELECT tl.*, u.username 
+                   FROM traffic_logs tl 
+                   JOIN users u ON tl.user_id = u.id 
+                   WHERE 1=1"""
+        params = []
     
-    if start_date:
-        query += " AND DATE(tl.snapshot_time) >= ?"
-        params.append(start_date)
+        if user_id:
+            query += " AND tl.user_id = ?"
+            params.append(user_id)
     
-    if end_date:
-        query += " AND DATE(tl.snapshot_time) <= ?"
-        params.append(end_date)
+        date_sql, date_params = date_range_filter('tl.snapshot_time', start_date, end_date)
+        query += date_sql
+        params.extend(date_params)
     
-    query += " ORDER BY tl.snapshot_time DESC LIMIT ?"
-    params.append(limit)
+        query += " ORDER BY tl.snapshot_time DESC LIMIT ?"
+        params.append(limit)
     
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    conn.close()
+        cursor = conn.execute(query, params)
+        rows = cursor.fetchall()
     return [dict(row) for row in rows]
 
 def get_daily_traffic_summary(user_id: int = None, days: int = 30):
     """
     Get daily traffic summaries for the specified number of days
     """
-    conn = get_db_connection()
-    
-    query = """SELECT 
-                  DATE(snapshot_time) as date,
-                  SUM(bytes_received) as total_received,
-                  SUM(bytes_sent) as total_sent,
-                  COUNT(*) as snapshot_count
-               FROM traffic_logs
-               WHERE snapshot_time >= DATE('now', '-' || ? || ' days')"""
-    params = [days]
+    with db_connection() as conn:
+        query = """SELECT 
+                      date,
+                      SUM(bytes_received) as total_received,
+                      SUM(bytes_sent) as total_sent,
+                      SUM(samples) as snapshot_count
+                   FROM traffic_records
+                   WHERE date >= DATE('now', '-' || ? || ' days')"""
+        params = [days]
     
-    if user_id:
-        query += " AND user_id = ?"
-        params.append(user_id)
+        if user_id:
+            query += " AND user_id = ?"
+            params.append(user_id)
     
-    query += " GROUP BY DATE(snapshot_time) ORDER BY date DESC"
+        query += " GROUP BY date ORDER BY date DESC"
     
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    conn.close()
+        cursor = conn.execute(query, params)
+        rows = cursor.fetchall()
     return [dict(row) for row in rows]
 
 def get_hourly_traffic_summary(user_id: int = None, hours: int = 24):
     """
     Get hourly traffic summaries for the specified number of hours
     """
-    conn = get_db_connection()
-    
-    query = """SELECT 
-                  strftime('%Y-%m-%d %H:00', snapshot_time) as hour,
-                  SUM(bytes_received) as total_received,
-                  SUM(bytes_sent) as total_sent,
-                  COUNT(*) as snapshot_count
-               FROM traffic_logs
-               WHERE snapshot_time >= DATETIME('now', '-' || ? || ' hours')"""
-    params = [hours]
-    
-    if user_id:
-        query += " AND user_id = ?"
-        params.append(user_id)
-    
-    query += " GROUP BY strftime('%Y-%m-%d %H:00', snapshot_time) ORDER BY hour DESC"
-    
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    start = (datetime.utcnow() - timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')
+    series = get_traffic_series(start=start, bucket_seconds=3600, user_id=user_id)['series']
+    return [
+        {
+            'hour': row['bucket'][:13] + ':00',
+            'total_received': row['total_received'],
+            'total_sent': row['total_sent'],
+            'snapshot_count': row['snapshot_count']
+        }
+        for row in reversed(series)
+    ]
 
 # ============== Alert Functions ==============
 
 def create_alert(user_id: int, alert_type: str, severity: str, message: str, 
                  threshold_value: float = None, actual_value: float = None):
     """Create a new alert"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        """INSERT INTO alerts (user_id, alert_type, severity, message, threshold_value, actual_value)
-           VALUES (?, ?, ?, ?, ?, ?)""",
-        (user_id, alert_type, severity, message, threshold_value, actual_value)
-    )
-    conn.commit()
-    alert_id = cursor.lastrowid
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """INSERT INTO alerts (user_id, alert_type, severity, message, threshold_value, actual_value)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            (user_id, alert_type, severity, message, threshold_value, actual_value)
+        )
+        alert_id = cursor.lastrowid
     return alert_id
 
 def get_alerts(user_id: int = None, severity: str = None, is_resolved: bool = None, limit: int = 100):
     """Get alerts with optional filters"""
-    conn = get_db_connection()
-    
-    query = """SELECT a.*, u.username 
-               FROM alerts a 
-               LEFT JOIN users u ON a.user_id = u.id 
-               WHERE 1=1"""
-    params = []
+    with db_connection() as conn:
+        query = """SELECT a.*, u.username 
+                   FROM alerts a 
+                   LEFT JOIN users u ON a.user_id = u.id 
+                   WHERE 1=1"""
+        params = []
     
-    if user_id:
-        query += " AND a.user_id = ?"
-        params.append(user_id)
+        if user_id:
+            query += " AND a.user_id = ?"
+            params.append(user_id)
     
-    if severity:
-        query += " AND a.severity = ?"
-        params.append(severity)
+        if severity:
+            query += " AND a.severity = ?"
+            params.append(severity)
     
-    if is_resolved is not None:
-        query += " AND a.is_resolved = ?"
-        params.append(1 if is_resolved else 0)
+        if is_resolved is not None:
+            query += " AND a.is_resolved = ?"
+            params.append(1 if is_resolved else 0)
     
-    query += " ORDER BY a.created_at DESC LIMIT ?"
-    params.append(limit)
+        query += " ORDER BY a.created_at DESC LIMIT ?"
+        params.append(limit)
     
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    conn.close()
+        cursor = conn.execute(query, params)
+        rows = cursor.fetchall()
     return [dict(row) for row in rows]
 
 def resolve_alert(alert_id: int):
     """Mark an alert as resolved"""
-    conn = get_db_connection()
-    conn.execute(
-        """UPDATE alerts SET is_resolved = 1, resolved_at = CURRENT_TIMESTAMP WHERE id = ?""",
-        (alert_id,)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute(
+            """UPDATE alerts SET is_resolved = 1, resolved_at = CURRENT_TIMESTAMP WHERE id = ?""",
+            (alert_id,)
+        )
 
 def get_unresolved_alerts():
     """Get all unresolved alerts"""
@@ -415,17 +1321,16 @@ def check_traffic_anomalies():
     """
     import random
     
-    conn = get_db_connection()
-    
-    # Get recent traffic data for the last 5 minutes
-    cursor = conn.execute("""
-        SELECT user_id, peer_public_key, bytes_received, bytes_sent, snapshot_time
-        FROM traffic_logs
-        WHERE snapshot_time >= DATETIME('now', '-5 minutes')
-        ORDER BY user_id, snapshot_time
-    """)
-    recent_logs = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    with db_connection() as conn:
+        # Get recent traffic data for the last 5 minutes
+        # Compare per-sample traffic, not cumulative counters
+        cursor = conn.execute("""
+            SELECT user_id, peer_public_key, delta_received as bytes_received, delta_sent as bytes_sent, snapshot_time
+            FROM traffic_logs
+            WHERE snapshot_time >= DATETIME('now', '-5 minutes') AND delta_received IS NOT NULL
+            ORDER BY user_id, snapshot_time
+        """)
+        recent_logs = [dict(row) for row in cursor.fetchall()]
     
     if not recent_logs:
         return []
@@ -477,8 +1382,9 @@ def check_traffic_anomalies():
     
     # Also create mock alerts for demo purposes if none exist
     if len(new_alerts) == 0 and random.random() < 0.3:
-        cursor = conn.execute("SELECT id, username FROM users LIMIT 1")
-        users = cursor.fetchall()
+        with db_connection() as conn:
+            cursor = conn.execute("SELECT id, username FROM users LIMIT 1")
+            users = cursor.fetchall()
         if users:
             user = users[0]
             alert_id = create_alert(
@@ -505,38 +1411,33 @@ def format_bytes(bytes_val: int) -> str:
 
 def log_connection(user_id: int, peer_ip: str = None, public_key: str = None):
     """Log a new connection event"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        """INSERT INTO connection_logs (user_id, peer_ip, connected_at)
-           VALUES (?, ?, CURRENT_TIMESTAMP)""",
-        (user_id, peer_ip)
-    )
-    conn.commit()
-    connection_id = cursor.lastrowid
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """INSERT INTO connection_logs (user_id, peer_ip, connected_at)
+               VALUES (?, ?, CURRENT_TIMESTAMP)""",
+            (user_id, peer_ip)
+        )
+        connection_id = cursor.lastrowid
     
-    # Also create audit log
-    conn.execute(
-        """INSERT INTO audit_logs (user_id, action, details, created_at)
-           VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
-        (user_id, 'connection', f'User connected from {peer_ip or "unknown"}')
-    )
-    conn.commit()
-    conn.close()
+        # Also create audit log
+        conn.execute(
+            """INSERT INTO audit_logs (user_id, action, details, created_at)
+               VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
+            (user_id, 'connection', f'User connected from {peer_ip or "unknown"}')
+        )
     return connection_id
 
 def update_connection_disconnect(connection_id: int, bytes_received: int = 0, bytes_sent: int = 0):
     """Update connection with disconnect time and final bytes"""
-    conn = get_db_connection()
-    conn.execute(
-        """UPDATE connection_logs 
-           SET disconnected_at = CURRENT_TIMESTAMP, 
-               bytes_received = ?, 
-               bytes_sent = ?
-           WHERE id = ?""",
-        (bytes_received, bytes_sent, connection_id)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute(
+            """UPDATE connection_logs 
+               SET disconnected_at = CURRENT_TIMESTAMP, 
+                   bytes_received = ?, 
+                   bytes_sent = ?
+               WHERE id = ?""",
+            (bytes_received, bytes_sent, connection_id)
+        )
 
 def get_connection_logs(
     user_id: int = None,
@@ -544,101 +1445,225 @@ def get_connection_logs(
     end_date: str = None,
     connection_status: str = None,
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    after: str = None,
+    include_total: bool = True
 ):
     """
     Get connection logs with optional filtering
     connection_status: 'connected' (no disconnected_at) or 'disconnected'
+    after: next_cursor of the previous page (keyset paging, offset ignored)
     """
-    conn = get_db_connection()
-    
-    query = """SELECT cl.*, u.username, u.email,
-               (julianday(COALESCE(cl.disconnected_at, 'now')) - julianday(cl.connected_at)) * 86400 as duration_seconds
-               FROM connection_logs cl 
-               JOIN users u ON cl.user_id = u.id 
-               WHERE 1=1"""
+    where = ""
     params = []
-    
+
     if user_id:
-        query += " AND cl.user_id = ?"
+        where += " AND cl.user_id = ?"
         params.append(user_id)
-    
-    if start_date:
-        query += " AND DATE(cl.connected_at) >= ?"
-        params.append(start_date)
-    
-    if end_date:
-        query += " AND DATE(cl.connected_at) <= ?"
-        params.append(end_date)
-    
-    if connection_status == 'connected':
-        query += " AND cl.disconnected_at IS NULL"
-    elif connection_status == 'disconnected':
-        query += " AND cl.disconnected_at IS NOT NULL"
-    
-    query += " ORDER BY cl.connected_at DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
-    
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    
-    # Get total count for pagination
-    count_query = "SELECT COUNT(*) as count FROM connection_logs cl WHERE 1=1"
-    count_params = []
-    if user_id:
-        count_query += " AND cl.user_id = ?"
-        count_params.append(user_id)
-    if start_date:
-        count_query += " AND DATE(cl.connected_at) >= ?"
-        count_params.append(start_date)
-    if end_date:
-        count_query += " AND DATE(cl.connected_at) <= ?"
-        count_params.append(end_date)
+
+    date_sql, date_params = date_range_filter('cl.connected_at', start_date, end_date)
+    where += date_sql
+    params.extend(date_params)
+
     if connection_status == 'connected':
-        count_query += " AND cl.disconnected_at IS NULL"
+        where += " AND cl.disconnected_at IS NULL"
     elif connection_status == 'disconnected':
-        count_query += " AND cl.disconnected_at IS NOT NULL"
-    
-    count_cursor = conn.execute(count_query, count_params)
-    total_count = count_cursor.fetchone()['count']
-    
-    conn.close()
+        where += " AND cl.disconnected_at IS NOT NULL"
+
+    with db_connection() as conn:
+        logs, total, next_cursor = _fetch_log_page(
+            conn,
+            """SELECT cl.*, u.username, u.email,
+                      (julianday(COALESCE(cl.disconnected_at, 'now')) - julianday(cl.connected_at)) * 86400 as duration_seconds
+               FROM connection_logs cl
+               JOIN users u ON cl.user_id = u.id
+               WHERE 1=1""",
+            "SELECT COUNT(*) FROM connection_logs cl WHERE 1=1",
+            where, params, 'cl.connected_at', limit, offset, after, include_total
+        )
+
     return {
-        'logs': [dict(row) for row in rows],
-        'total': total_count,
+        'logs': logs,
+        'total': total,
         'limit': limit,
-        'offset': offset
+        'offset': offset,
+        'next_cursor': next_cursor
     }
 
 def get_active_connections():
     """Get all currently active connections (not disconnected)"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        """SELECT cl.*, u.username, u.email, u.public_key
-           FROM connection_logs cl 
-           JOIN users u ON cl.user_id = u.id 
-           WHERE cl.disconnected_at IS NULL
-           ORDER BY cl.connected_at DESC"""
-    )
-    rows = cursor.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """SELECT cl.*, u.username, u.email, u.public_key
+               FROM connection_logs cl 
+               JOIN users u ON cl.user_id = u.id 
+               WHERE cl.disconnected_at IS NULL
+               ORDER BY cl.connected_at DESC"""
+        )
+        rows = cursor.fetchall()
     return [dict(row) for row in rows]
 
+def count_active_connections():
+    """Number of connections without a disconnect time"""
+    with db_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM connection_logs WHERE disconnected_at IS NULL").fetchone()[0]
+
 def close_stale_connections():
     """Close connections that don't have disconnect time (cleanup)"""
-    conn = get_db_connection()
-    # Close any connections older than 24 hours that are still open
-    conn.execute(
-        """UPDATE connection_logs 
-           SET disconnected_at = CURRENT_TIMESTAMP
-           WHERE disconnected_at IS NULL 
-           AND connected_at < DATETIME('now', '-24 hours')"""
-    )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        # Close any connections older than 24 hours that are still open
+        conn.execute(
+            """UPDATE connection_logs 
+               SET disconnected_at = CURRENT_TIMESTAMP
+               WHERE disconnected_at IS NULL 
+               AND connected_at < DATETIME('now', '-24 hours')"""
+        )
 
 # ============== Search & Export Functions ==============
 
+# log_type -> (FROM clause, table alias, timestamp column, LIKE columns,
+# FTS text of a {row}); the order also breaks timestamp ties between sources
+LOG_SEARCH_SOURCES = {
+    'connection': ("connection_logs cl JOIN users u ON cl.user_id = u.id",
+                   'cl', 'connected_at', ('u.username', 'cl.peer_ip'),
+                   "COALESCE((SELECT username FROM users WHERE id = {row}.user_id), '') || ' ' || COALESCE({row}.peer_ip, '')"),
+    'traffic': ("traffic_logs tl JOIN users u ON tl.user_id = u.id",
+                'tl', 'snapshot_time', ('u.username', 'tl.peer_public_key'),
+                "COALESCE((SELECT username FROM users WHERE id = {row}.user_id), '') || ' ' || COALESCE({row}.peer_public_key, '')"),
+    'alert': ("alerts a LEFT JOIN users u ON a.user_id = u.id",
+              'a', 'created_at', ('a.message', 'a.alert_type'),
+              "COALESCE({row}.alert_type, '') || ' ' || COALESCE({row}.message, '')"),
+    'audit': ("audit_logs al LEFT JOIN users u ON al.user_id = u.id",
+              'al', 'created_at', ('al.action', 'al.details'),
+              "COALESCE({row}.action, '') || ' ' || COALESCE({row}.details, '')"),
+}
+
+# log_search_fts rowid = source row id * LOG_SEARCH_SLOTS + source rank
+LOG_SEARCH_SLOTS = 4
+
+def _fts_match_expression(keyword: str):
+    """
+    Turn a keyword into an FTS5 query: every whitespace-separated term is a
+    prefix phrase ("10.0.0"* matches 10.0.0.5) and all terms must match.
+    Returns None when no term contains a searchable character.
+    """
+    terms = [term for term in keyword.split() if any(ch.isalnum() for ch in term)]
+    if not terms:
+        return None
+    return ' '.join('"' + term.replace('"', '""') + '"*' for term in terms)
+
+def _has_log_search_index(conn) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'log_search_fts'"
+    ).fetchone() is not None
+
+def _search_filter(log_type: str, keyword: str, match: str, user_id: int, start_date: str, end_date: str):
+    """Build the WHERE conditions of one search source"""
+    _, alias, time_field, keyword_columns, _ = LOG_SEARCH_SOURCES[log_type]
+    where = ""
+    params = []
+
+    if match:
+        rank = list(LOG_SEARCH_SOURCES).index(log_type)
+        where += f""" AND {alias}.id IN (
+            SELECT rowid / {LOG_SEARCH_SLOTS} FROM log_search_fts
+            WHERE log_search_fts MATCH ? AND rowid % {LOG_SEARCH_SLOTS} = {rank})"""
+        params.append(match)
+    elif keyword:
+        where += " AND (" + " OR ".join(f"{column} LIKE ?" for column in keyword_columns) + ")"
+        params.extend([f'%{keyword}%'] * len(keyword_columns))
+    if user_id:
+        where += f" AND {alias}.user_id = ?"
+        params.append(user_id)
+    date_sql, date_params = date_range_filter(f"{alias}.{time_field}", start_date, end_date)
+    where += date_sql
+    params.extend(date_params)
+    return where, params
+
+def _search_source_query(log_type: str, rank: int, where: str, params: list, after, max_rows: int):
+    """
+    Build the newest-first query of one source; returns (sql, params)
+    `after` is the (timestamp, rank, id) key of the last row already returned
+    """
+    source, alias, time_field, _, _ = LOG_SEARCH_SOURCES[log_type]
+    time_column, id_column = f"{alias}.{time_field}", f"{alias}.id"
+    params = list(params)
+
+    # Continue strictly below the cursor key: sources ranked below the
+    # cursor's keep its timestamp, the cursor's own source also compares id
+    if after:
+        after_time, after_rank, after_id = after
+        if rank < after_rank:
+            where += f" AND {time_column} <= ?"
+            params.append(after_time)
+        elif rank == after_rank:
+            where += f" AND {time_column} <= ? AND ({time_column} < ? OR {id_column} < ?)"
+            params.extend([after_time, after_time, after_id])
+        else:
+            where += f" AND {time_column} < ?"
+            params.append(after_time)
+
+    sql = f"""SELECT {alias}.*, u.username, '{log_type}' as log_type
+              FROM {source}
+              WHERE 1=1{where}
+              ORDER BY {time_column} DESC, {id_column} DESC
+              LIMIT ?"""
+    return sql, params + [max_rows]
+
+def _search_source(conn, log_type: str, rank: int, where: str, params: list, after, max_rows: int):
+    """Stream one source newest first as ((timestamp, rank, id), row)"""
+    time_field = LOG_SEARCH_SOURCES[log_type][2]
+    for row in conn.execute(*_search_source_query(log_type, rank, where, params, after, max_rows)):
+        yield (row[time_field] or '', rank, row['id']), row
+
+def _search_ranked(conn, match: str, filters: dict, limit: int, offset: int, after):
+    """
+    Page through FTS matches best-first (bm25), newest id first on ties
+    Matches are read in chunks and joined back to their log rows, dropping
+    rows that fail the other filters, until the page is full.
+    `after` is the (score, fts rowid) key of the last row already returned.
+    Returns a list of ((score, fts rowid), row)
+    """
+    ranks = {name: rank for rank, name in enumerate(LOG_SEARCH_SOURCES)}
+    names = list(LOG_SEARCH_SOURCES)
+    query = "SELECT rowid, rank FROM log_search_fts WHERE log_search_fts MATCH ?"
+    params = [match]
+    if len(filters) < len(LOG_SEARCH_SOURCES):
+        query += f" AND rowid % {LOG_SEARCH_SLOTS} IN ({', '.join(str(ranks[name]) for name in filters)})"
+    if after:
+        after_score, after_rowid = after
+        query += " AND (rank > ? OR (rank = ? AND rowid < ?))"
+        params.extend([after_score, after_score, after_rowid])
+    query += " ORDER BY rank, rowid DESC"
+
+    page = []
+    matches = conn.execute(query, params)
+    while len(page) <= offset + limit:
+        chunk = matches.fetchmany(max(limit + 1, 200))
+        if not chunk:
+            break
+
+        ids_by_type = {}
+        for fts_rowid, _ in chunk:
+            ids_by_type.setdefault(names[fts_rowid % LOG_SEARCH_SLOTS], []).append(fts_rowid // LOG_SEARCH_SLOTS)
+        rows = {}
+        for name, ids in ids_by_type.items():
+            source, alias, _, _, _ = LOG_SEARCH_SOURCES[name]
+            where, where_params = filters[name]
+            cursor = conn.execute(
+                f"""SELECT {alias}.*, u.username, '{name}' as log_type
+                    FROM {source}
+                    WHERE {alias}.id IN ({', '.join('?' * len(ids))}){where}""",
+                ids + where_params
+            )
+            rows.update(((name, row['id']), row) for row in cursor)
+
+        for fts_rowid, score in chunk:
+            row = rows.get((names[fts_rowid % LOG_SEARCH_SLOTS], fts_rowid // LOG_SEARCH_SLOTS))
+            if row is not None:
+                page.append(((score, fts_rowid), row))
+    return page[offset:offset + limit + 1]
+
 def search_logs(
     keyword: str = None,
     log_type: str = None,  # 'connection', 'traffic', 'alert', 'audit'
@@ -646,144 +1671,78 @@ def search_logs(
     start_date: str = None,
     end_date: str = None,
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    after: str = None,
+    include_total: bool = True,
+    sort: str = 'time'  # 'time' or 'relevance'
 ):
     """
-    Full-text search across all log types
+    Search across all log types
+    Keywords use the FTS5 index (prefix terms, all must match) when the
+    database has it and fall back to LIKE otherwise.
+    sort='time' (newest first): every source streams in timestamp order and
+    heapq.merge interleaves them lazily, so a page reads at most
+    offset + limit + 1 rows overall.
+    sort='relevance': best bm25 matches first; needs a keyword and the index.
+    after: next_cursor of the previous page (keyset paging, offset ignored)
     """
-    results = []
-    
-    # Search connection logs
-    if log_type is None or log_type == 'connection':
-        conn = get_db_connection()
-        query = """SELECT cl.*, u.username, 'connection' as log_type
-                   FROM connection_logs cl 
-                   JOIN users u ON cl.user_id = u.id 
-                   WHERE 1=1"""
-        params = []
-        
-        if keyword:
-            query += " AND (u.username LIKE ? OR cl.peer_ip LIKE ?)"
-            params.extend([f'%{keyword}%', f'%{keyword}%'])
-        if user_id:
-            query += " AND cl.user_id = ?"
-            params.append(user_id)
-        if start_date:
-            query += " AND DATE(cl.connected_at) >= ?"
-            params.append(start_date)
-        if end_date:
-            query += " AND DATE(cl.connected_at) <= ?"
-            params.append(end_date)
-        
-        query += " ORDER BY cl.connected_at DESC LIMIT ?"
-        params.append(limit)
-        
-        cursor = conn.execute(query, params)
-        rows = cursor.fetchall()
-        results.extend([dict(row) for row in rows])
-        conn.close()
-    
-    # Search traffic logs
-    if log_type is None or log_type == 'traffic':
-        conn = get_db_connection()
-        query = """SELECT tl.*, u.username, 'traffic' as log_type
-                   FROM traffic_logs tl 
-                   JOIN users u ON tl.user_id = u.id 
-                   WHERE 1=1"""
-        params = []
-        
-        if keyword:
-            query += " AND (u.username LIKE ? OR tl.peer_public_key LIKE ?)"
-            params.extend([f'%{keyword}%', f'%{keyword}%'])
-        if user_id:
-            query += " AND tl.user_id = ?"
-            params.append(user_id)
-        if start_date:
-            query += " AND DATE(tl.snapshot_time) >= ?"
-            params.append(start_date)
-        if end_date:
-            query += " AND DATE(tl.snapshot_time) <= ?"
-            params.append(end_date)
-        
-        query += " ORDER BY tl.snapshot_time DESC LIMIT ?"
-        params.append(limit)
-        
-        cursor = conn.execute(query, params)
-        rows = cursor.fetchall()
-        results.extend([dict(row) for row in rows])
-        conn.close()
-    
-    # Search alerts
-    if log_type is None or log_type == 'alert':
-        conn = get_db_connection()
-        query = """SELECT a.*, u.username, 'alert' as log_type
-                   FROM alerts a 
-                   LEFT JOIN users u ON a.user_id = u.id 
-                   WHERE 1=1"""
-        params = []
-        
-        if keyword:
-            query += " AND (a.message LIKE ? OR a.alert_type LIKE ?)"
-            params.append(f'%{keyword}%')
-        if user_id:
-            query += " AND a.user_id = ?"
-            params.append(user_id)
-        if start_date:
-            query += " AND DATE(a.created_at) >= ?"
-            params.append(start_date)
-        if end_date:
-            query += " AND DATE(a.created_at) <= ?"
-            params.append(end_date)
-        
-        query += " ORDER BY a.created_at DESC LIMIT ?"
-        params.append(limit)
-        
-        cursor = conn.execute(query, params)
-        rows = cursor.fetchall()
-        results.extend([dict(row) for row in rows])
-        conn.close()
-    
-    # Search audit logs
-    if log_type is None or log_type == 'audit':
-        conn = get_db_connection()
-        query = """SELECT al.*, u.username, 'audit' as log_type
-                   FROM audit_logs al 
-                   LEFT JOIN users u ON al.user_id = u.id 
-                   WHERE 1=1"""
-        params = []
-        
-        if keyword:
-            query += " AND (al.action LIKE ? OR al.details LIKE ?)"
-            params.extend([f'%{keyword}%', f'%{keyword}%'])
-        if user_id:
-            query += " AND al.user_id = ?"
-            params.append(user_id)
-        if start_date:
-            query += " AND DATE(al.created_at) >= ?"
-            params.append(start_date)
-        if end_date:
-            query += " AND DATE(al.created_at) <= ?"
-            params.append(end_date)
-        
-        query += " ORDER BY al.created_at DESC LIMIT ?"
-        params.append(limit)
-        
-        cursor = conn.execute(query, params)
-        rows = cursor.fetchall()
-        results.extend([dict(row) for row in rows])
-        conn.close()
-    
-    # Sort all results by date
-    results.sort(key=lambda x: x.get('connected_at') or x.get('snapshot_time') or x.get('created_at', ''), reverse=True)
-    
-    # Apply offset and limit
-    paginated_results = results[offset:offset + limit]
-    
+    log_types = [name for name in LOG_SEARCH_SOURCES if log_type is None or name == log_type]
+    ranks = {name: rank for rank, name in enumerate(LOG_SEARCH_SOURCES)}
+
+    with db_connection() as conn:
+        match = _fts_match_expression(keyword) if keyword and _has_log_search_index(conn) else None
+        ranked = sort == 'relevance' and match is not None
+
+        after_key = None
+        if after:
+            if ranked:
+                after_key = decode_cursor(after, (float, int))
+            else:
+                after_time, after_type, after_id = decode_cursor(after, (str, str, int))
+                if after_type not in ranks:
+                    raise InvalidCursor(f"Invalid cursor '{after}'")
+                after_key = (after_time, ranks[after_type], after_id)
+            offset = 0
+
+        filters = {
+            name: _search_filter(name, keyword, match, user_id, start_date, end_date)
+            for name in log_types
+        }
+
+        if ranked:
+            page = _search_ranked(conn, match, filters, limit, offset, after_key)
+        else:
+            streams = [
+                _search_source(conn, name, ranks[name], where, params, after_key, offset + limit + 1)
+                for name, (where, params) in filters.items()
+            ]
+            merged = heapq.merge(*streams, key=lambda item: item[0], reverse=True)
+            page = list(islice(merged, offset, offset + limit + 1))
+
+        total = None
+        if include_total:
+            total = sum(
+                conn.execute(
+                    f"SELECT COUNT(*) FROM {LOG_SEARCH_SOURCES[name][0]} WHERE 1=1{where}", params
+                ).fetchone()[0]
+                for name, (where, params) in filters.items()
+            )
+
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        last_key, last_row = page[-1]
+        if ranked:
+            next_cursor = encode_cursor(*last_key)
+        else:
+            next_cursor = encode_cursor(last_key[0], last_row['log_type'], last_key[2])
+
     return {
-        'logs': paginated_results,
-        'total': len(results),
+        'logs': [dict(row) for _, row in page],
+        'total': total,
         'limit': limit,
-        'offset': offset
+        'offset': offset,
+        'next_cursor': next_cursor
     }
 
 def get_logs_for_export(
@@ -807,16 +1766,136 @@ def get_logs_for_export(
     )
     return logs['logs']
 
+def iter_logs_for_export(
+    keyword: str = None,
+    log_type: str = None,
+    user_id: int = None,
+    start_date: str = None,
+    end_date: str = None
+):
+    """
+    Stream every matching log row newest first, without a row cap
+    Rows come straight from SQLite cursors merged with heapq.merge, so
+    memory stays constant. A dedicated connection is closed once the rows
+    are exhausted or the iterator is closed; it may be consumed from any thread.
+    Returns (columns, rows) where rows yields tuples aligned to columns.
+    """
+    log_types = [name for name in LOG_SEARCH_SOURCES if log_type is None or name == log_type]
+    conn = get_db_connection(check_same_thread=False)
+    conn.row_factory = None
+    try:
+        match = _fts_match_expression(keyword) if keyword and _has_log_search_index(conn) else None
+        cursors = {}
+        for rank, name in enumerate(LOG_SEARCH_SOURCES):
+            if name in log_types:
+                where, params = _search_filter(name, keyword, match, user_id, start_date, end_date)
+                cursors[name] = (rank, conn.execute(*_search_source_query(name, rank, where, params, None, -1)))
+    except Exception:
+        conn.close()
+        raise
+
+    # Union of the source columns, each source mapped onto it once
+    columns = []
+    for _, cursor in cursors.values():
+        columns.extend(d[0] for d in cursor.description if d[0] not in columns)
+    layouts = {}
+    for name, (_, cursor) in cursors.items():
+        names = [d[0] for d in cursor.description]
+        layouts[name] = [names.index(column) if column in names else None for column in columns]
+
+    def source_rows(name, rank, cursor):
+        layout = layouts[name]
+        names = [d[0] for d in cursor.description]
+        time_index, id_index = names.index(LOG_SEARCH_SOURCES[name][2]), names.index('id')
+        for row in cursor:
+            yield (row[time_index] or '', rank, row[id_index]), tuple(
+                None if index is None else row[index] for index in layout
+            )
+
+    def rows():
+        try:
+            streams = [source_rows(name, rank, cursor) for name, (rank, cursor) in cursors.items()]
+            for _, row in heapq.merge(*streams, key=lambda item: item[0], reverse=True):
+                yield row
+        finally:
+            conn.close()
+
+    return columns, rows()
+
+# ============== Export Jobs ==============
+
+def create_export_job(kind: str, format: str, params: str, created_by: int = None):
+    """Create a pending export job, params is a JSON string of filters"""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """INSERT INTO export_jobs (kind, format, params, created_by, status, created_at)
+               VALUES (?, ?, ?, ?, 'pending', CURRENT_TIMESTAMP)""",
+            (kind, format, params, created_by)
+        )
+        job_id = cursor.lastrowid
+    return job_id
+
+def get_export_job(job_id: int):
+    """Get an export job by ID"""
+    with db_connection() as conn:
+        row = conn.execute("SELECT * FROM export_jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+def update_export_job(job_id: int, **kwargs):
+    """Update the status, progress or result fields of an export job"""
+    allowed_fields = ['status', 'rows_written', 'total_rows', 'file_path', 'file_size', 'error',
+                      'started_at', 'finished_at', 'expires_at']
+    updates = []
+    params = []
+    for key, value in kwargs.items():
+        if key in allowed_fields:
+            updates.append(f"{key} = ?")
+            params.append(value)
+    if not updates:
+        return
+    params.append(job_id)
+    with db_connection() as conn:
+        conn.execute(f"UPDATE export_jobs SET {', '.join(updates)} WHERE id = ?", params)
+
+def fail_interrupted_export_jobs(expires_at: str):
+    """Mark jobs left pending or running by a previous process as failed"""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """UPDATE export_jobs SET status = 'failed', error = 'Interrupted by a restart',
+                   finished_at = ?, expires_at = ?
+               WHERE status IN ('pending', 'running')""",
+            (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), expires_at)
+        )
+    return cursor.rowcount
+
+def get_expired_export_jobs(now: str = None):
+    """Get export jobs whose files are past expires_at"""
+    now = now or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with db_connection() as conn:
+        rows = conn.execute(
+            "SELECT * FROM export_jobs WHERE expires_at IS NOT NULL AND expires_at < ?", (now,)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+def get_export_job_files():
+    """Set of file paths still referenced by export jobs"""
+    with db_connection() as conn:
+        rows = conn.execute("SELECT file_path FROM export_jobs WHERE file_path IS NOT NULL").fetchall()
+    return {row['file_path'] for row in rows}
+
+def delete_export_job(job_id: int):
+    """Delete an export job record"""
+    with db_connection() as conn:
+        conn.execute("DELETE FROM export_jobs WHERE id = ?", (job_id,))
+
 def create_audit_log(user_id: int, action: str, details: str = None, ip_address: str = None):
     """Create an audit log entry"""
-    conn = get_db_connection()
-    conn.execute(
-        """INSERT INTO audit_logs (user_id, action, details, ip_address, created_at)
-           VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)""",
-        (user_id, action, details, ip_address)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute(
+            """INSERT INTO audit_logs (user_id, action, details, ip_address, created_at)
+               VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)""",
+            (user_id, action, details, ip_address)
+        )
 
 # ============== Audit Records Functions ==============
 
@@ -826,88 +1905,65 @@ def get_audit_logs(
     start_date: str = None,
     end_date: str = None,
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    after: str = None,
+    include_total: bool = True
 ):
     """
     Get audit logs with optional filtering
+    after: next_cursor of the previous page (keyset paging, offset ignored)
     """
-    conn = get_db_connection()
-    
-    query = """SELECT al.*, u.username, u.email
-               FROM audit_logs al 
-               LEFT JOIN users u ON al.user_id = u.id 
-               WHERE 1=1"""
+    where = ""
     params = []
-    
+
     if user_id:
-        query += " AND al.user_id = ?"
+        where += " AND al.user_id = ?"
         params.append(user_id)
-    
-    if action:
-        query += " AND al.action = ?"
-        params.append(action)
-    
-    if start_date:
-        query += " AND DATE(al.created_at) >= ?"
-        params.append(start_date)
-    
-    if end_date:
-        query += " AND DATE(al.created_at) <= ?"
-        params.append(end_date)
-    
-    query += " ORDER BY al.created_at DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
-    
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    
-    # Get total count
-    count_query = "SELECT COUNT(*) as count FROM audit_logs al WHERE 1=1"
-    count_params = []
-    if user_id:
-        count_query += " AND al.user_id = ?"
-        count_params.append(user_id)
+
     if action:
-        count_query += " AND al.action = ?"
-        count_params.append(action)
-    if start_date:
-        count_query += " AND DATE(al.created_at) >= ?"
-        count_params.append(start_date)
-    if end_date:
-        count_query += " AND DATE(al.created_at) <= ?"
-        count_params.append(end_date)
-    
-    count_cursor = conn.execute(count_query, count_params)
-    total_count = count_cursor.fetchone()['count']
-    
-    conn.close()
+        where += " AND al.action = ?"
+        params.append(action)
+
+    date_sql, date_params = date_range_filter('al.created_at', start_date, end_date)
+    where += date_sql
+    params.extend(date_params)
+
+    with db_connection() as conn:
+        logs, total, next_cursor = _fetch_log_page(
+            conn,
+            """SELECT al.*, u.username, u.email
+               FROM audit_logs al
+               LEFT JOIN users u ON al.user_id = u.id
+               WHERE 1=1""",
+            "SELECT COUNT(*) FROM audit_logs al WHERE 1=1",
+            where, params, 'al.created_at', limit, offset, after, include_total
+        )
+
     return {
-        'logs': [dict(row) for row in rows],
-        'total': total_count,
+        'logs': logs,
+        'total': total,
         'limit': limit,
-        'offset': offset
+        'offset': offset,
+        'next_cursor': next_cursor
     }
 
 def get_distinct_audit_actions():
     """Get list of distinct audit action types"""
-    conn = get_db_connection()
-    cursor = conn.execute("SELECT DISTINCT action FROM audit_logs ORDER BY action")
-    rows = cursor.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute("SELECT DISTINCT action FROM audit_logs ORDER BY action")
+        rows = cursor.fetchall()
     return [row['action'] for row in rows]
 
 # ============== Login History Functions ==============
 
 def log_login_attempt(user_id: int, username: str, ip_address: str, user_agent: str, success: bool, failure_reason: str = None):
     """Log a login attempt"""
-    conn = get_db_connection()
-    conn.execute(
-        """INSERT INTO login_history (user_id, username, ip_address, user_agent, success, failure_reason, created_at)
-           VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)""",
-        (user_id, username, ip_address, user_agent, 1 if success else 0, failure_reason)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute(
+            """INSERT INTO login_history (user_id, username, ip_address, user_agent, success, failure_reason, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)""",
+            (user_id, username, ip_address, user_agent, 1 if success else 0, failure_reason)
+        )
 
 def get_login_history(
     user_id: int = None,
@@ -915,80 +1971,58 @@ def get_login_history(
     start_date: str = None,
     end_date: str = None,
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    after: str = None,
+    include_total: bool = True
 ):
     """
     Get login history with optional filtering
+    after: next_cursor of the previous page (keyset paging, offset ignored)
     """
-    conn = get_db_connection()
-    
-    query = """SELECT lh.*, u.email
-               FROM login_history lh 
-               LEFT JOIN users u ON lh.user_id = u.id 
-               WHERE 1=1"""
+    where = ""
     params = []
-    
+
     if user_id:
-        query += " AND lh.user_id = ?"
+        where += " AND lh.user_id = ?"
         params.append(user_id)
-    
+
     if success is not None:
-        query += " AND lh.success = ?"
+        where += " AND lh.success = ?"
         params.append(1 if success else 0)
-    
-    if start_date:
-        query += " AND DATE(lh.created_at) >= ?"
-        params.append(start_date)
-    
-    if end_date:
-        query += " AND DATE(lh.created_at) <= ?"
-        params.append(end_date)
-    
-    query += " ORDER BY lh.created_at DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
-    
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    
-    # Get total count
-    count_query = "SELECT COUNT(*) as count FROM login_history lh WHERE 1=1"
-    count_params = []
-    if user_id:
-        count_query += " AND lh.user_id = ?"
-        count_params.append(user_id)
-    if success is not None:
-        count_query += " AND lh.success = ?"
-        count_params.append(1 if success else 0)
-    if start_date:
-        count_query += " AND DATE(lh.created_at) >= ?"
-        count_params.append(start_date)
-    if end_date:
-        count_query += " AND DATE(lh.created_at) <= ?"
-        count_params.append(end_date)
-    
-    count_cursor = conn.execute(count_query, count_params)
-    total_count = count_cursor.fetchone()['count']
-    
-    conn.close()
+
+    date_sql, date_params = date_range_filter('lh.created_at', start_date, end_date)
+    where += date_sql
+    params.extend(date_params)
+
+    with db_connection() as conn:
+        logs, total, next_cursor = _fetch_log_page(
+            conn,
+            """SELECT lh.*, u.email
+               FROM login_history lh
+               LEFT JOIN users u ON lh.user_id = u.id
+               WHERE 1=1""",
+            "SELECT COUNT(*) FROM login_history lh WHERE 1=1",
+            where, params, 'lh.created_at', limit, offset, after, include_total
+        )
+
     return {
-        'logs': [dict(row) for row in rows],
-        'total': total_count,
+        'logs': logs,
+        'total': total,
         'limit': limit,
-        'offset': offset
+        'offset': offset,
+        'next_cursor': next_cursor
     }
 
 # ============== System Events Functions ==============
 
 def log_system_event(event_type: str, severity: str, message: str, details: str = None, source: str = None):
     """Log a system event"""
-    conn = get_db_connection()
-    conn.execute(
-        """INSERT INTO system_events (event_type, severity, message, details, source, created_at)
-           VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)""",
-        (event_type, severity, message, details, source)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute(
+            """INSERT INTO system_events (event_type, severity, message, details, source, created_at)
+               VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)""",
+            (event_type, severity, message, details, source)
+        )
 
 def get_system_events(
     event_type: str = None,
@@ -996,103 +2030,78 @@ def get_system_events(
     start_date: str = None,
     end_date: str = None,
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    after: str = None,
+    include_total: bool = True
 ):
     """
     Get system events with optional filtering
+    after: next_cursor of the previous page (keyset paging, offset ignored)
     """
-    conn = get_db_connection()
-    
-    query = """SELECT * FROM system_events WHERE 1=1"""
+    where = ""
     params = []
-    
+
     if event_type:
-        query += " AND event_type = ?"
+        where += " AND event_type = ?"
         params.append(event_type)
-    
+
     if severity:
-        query += " AND severity = ?"
+        where += " AND severity = ?"
         params.append(severity)
-    
-    if start_date:
-        query += " AND DATE(created_at) >= ?"
-        params.append(start_date)
-    
-    if end_date:
-        query += " AND DATE(created_at) <= ?"
-        params.append(end_date)
-    
-    query += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
-    
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    
-    # Get total count
-    count_query = "SELECT COUNT(*) as count FROM system_events WHERE 1=1"
-    count_params = []
-    if event_type:
-        count_query += " AND event_type = ?"
-        count_params.append(event_type)
-    if severity:
-        count_query += " AND severity = ?"
-        count_params.append(severity)
-    if start_date:
-        count_query += " AND DATE(created_at) >= ?"
-        count_params.append(start_date)
-    if end_date:
-        count_query += " AND DATE(created_at) <= ?"
-        count_params.append(end_date)
-    
-    count_cursor = conn.execute(count_query, count_params)
-    total_count = count_cursor.fetchone()['count']
-    
-    conn.close()
+
+    date_sql, date_params = date_range_filter('created_at', start_date, end_date)
+    where += date_sql
+    params.extend(date_params)
+
+    with db_connection() as conn:
+        events, total, next_cursor = _fetch_log_page(
+            conn,
+            "SELECT * FROM system_events WHERE 1=1",
+            "SELECT COUNT(*) FROM system_events WHERE 1=1",
+            where, params, 'created_at', limit, offset, after, include_total
+        )
+
     return {
-        'events': [dict(row) for row in rows],
-        'total': total_count,
+        'events': events,
+        'total': total,
         'limit': limit,
-        'offset': offset
+        'offset': offset,
+        'next_cursor': next_cursor
     }
 
 def get_distinct_event_types():
     """Get list of distinct event types"""
-    conn = get_db_connection()
-    cursor = conn.execute("SELECT DISTINCT event_type FROM system_events ORDER BY event_type")
-    rows = cursor.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute("SELECT DISTINCT event_type FROM system_events ORDER BY event_type")
+        rows = cursor.fetchall()
     return [row['event_type'] for row in rows]
 
 # ============== Compliance Reports Functions ==============
 
 def create_compliance_report(report_type: str, title: str, start_date: str, end_date: str, created_by: int):
     """Create a new compliance report record"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        """INSERT INTO compliance_reports (report_type, title, start_date, end_date, created_by, status, created_at)
-           VALUES (?, ?, ?, ?, ?, 'pending', CURRENT_TIMESTAMP)""",
-        (report_type, title, start_date, end_date, created_by)
-    )
-    conn.commit()
-    report_id = cursor.lastrowid
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """INSERT INTO compliance_reports (report_type, title, start_date, end_date, created_by, status, created_at)
+               VALUES (?, ?, ?, ?, ?, 'pending', CURRENT_TIMESTAMP)""",
+            (report_type, title, start_date, end_date, created_by)
+        )
+        report_id = cursor.lastrowid
     return report_id
 
 def update_compliance_report(report_id: int, status: str = None, file_path: str = None):
     """Update compliance report status"""
-    conn = get_db_connection()
-    if status:
-        conn.execute(
-            """UPDATE compliance_reports SET status = ?, completed_at = CURRENT_TIMESTAMP WHERE id = ?""",
-            (status, report_id)
-        )
-    if file_path:
-        conn.execute(
-            """UPDATE compliance_reports SET file_path = ? WHERE id = ?""",
-            (file_path, report_id)
-        )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        if status:
+            conn.execute(
+                """UPDATE compliance_reports SET status = ?, completed_at = CURRENT_TIMESTAMP WHERE id = ?""",
+                (status, report_id)
+            )
+        if file_path:
+            conn.execute(
+                """UPDATE compliance_reports SET file_path = ? WHERE id = ?""",
+                (file_path, report_id)
+            )
 
 def get_compliance_reports(
     report_type: str = None,
@@ -1103,42 +2112,40 @@ def get_compliance_reports(
     """
     Get compliance reports with optional filtering
     """
-    conn = get_db_connection()
-    
-    query = """SELECT cr.*, u.username as created_by_username
-               FROM compliance_reports cr 
-               LEFT JOIN users u ON cr.created_by = u.id 
-               WHERE 1=1"""
-    params = []
+    with db_connection() as conn:
+        query = """SELECT cr.*, u.username as created_by_username
+                   FROM compliance_reports cr 
+                   LEFT JOIN users u ON cr.created_by = u.id 
+                   WHERE 1=1"""
+        params = []
     
-    if report_type:
-        query += " AND cr.report_type = ?"
-        params.append(report_type)
+        if report_type:
+            query += " AND cr.report_type = ?"
+            params.append(report_type)
     
-    if status:
-        query += " AND cr.status = ?"
-        params.append(status)
+        if status:
+            query += " AND cr.status = ?"
+            params.append(status)
     
-    query += " ORDER BY cr.created_at DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
+        query += " ORDER BY cr.created_at DESC LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
     
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
+        cursor = conn.execute(query, params)
+        rows = cursor.fetchall()
     
-    # Get total count
-    count_query = "SELECT COUNT(*) as count FROM compliance_reports cr WHERE 1=1"
-    count_params = []
-    if report_type:
-        count_query += " AND cr.report_type = ?"
-        count_params.append(report_type)
-    if status:
-        count_query += " AND cr.status = ?"
-        count_params.append(status)
+        # Get total count
+        count_query = "SELECT COUNT(*) as count FROM compliance_reports cr WHERE 1=1"
+        count_params = []
+        if report_type:
+            count_query += " AND cr.report_type = ?"
+            count_params.append(report_type)
+        if status:
+            count_query += " AND cr.status = ?"
+            count_params.append(status)
     
-    count_cursor = conn.execute(count_query, count_params)
-    total_count = count_cursor.fetchone()['count']
+        count_cursor = conn.execute(count_query, count_params)
+        total_count = count_cursor.fetchone()['count']
     
-    conn.close()
     return {
         'reports': [dict(row) for row in rows],
         'total': total_count,
@@ -1148,20 +2155,23 @@ def get_compliance_reports(
 
 def get_compliance_report_by_id(report_id: int):
     """Get a specific compliance report by ID"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        """SELECT cr.*, u.username as created_by_username
-           FROM compliance_reports cr 
-           LEFT JOIN users u ON cr.created_by = u.id 
-           WHERE cr.id = ?""",
-        (report_id,)
-    )
-    row = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """SELECT cr.*, u.username as created_by_username
+               FROM compliance_reports cr 
+               LEFT JOIN users u ON cr.created_by = u.id 
+               WHERE cr.id = ?""",
+            (report_id,)
+        )
+        row = cursor.fetchone()
     return dict(row) if row else None
 
-def generate_compliance_report_data(report_type: str, start_date: str, end_date: str):
-    """Generate compliance report data based on type"""
+def generate_compliance_report_data(report_type: str, start_date: str, end_date: str, progress=None):
+    """
+    Generate compliance report data based on type
+    progress: optional callable receiving the fraction done after each section;
+    sections run in separate read transactions, so the callback may write
+    """
     import json
     
     report_data = {
@@ -1171,72 +2181,84 @@ def generate_compliance_report_data(report_type: str, start_date: str, end_date:
         'sections': {}
     }
     
-    conn = get_db_connection()
+    start_bound, end_bound = date_bounds(start_date, end_date)
     
-    # 1. User Activities
-    user_activity_query = """SELECT 
-        u.id, u.username, u.email, u.is_active, u.created_at,
-        COUNT(DISTINCT cl.id) as connection_count,
-        SUM(COALESCE(cl.bytes_received, 0)) as total_received,
-        SUM(COALESCE(cl.bytes_sent, 0)) as total_sent
-    FROM users u
-    LEFT JOIN connection_logs cl ON u.id = cl.user_id 
-        AND DATE(cl.connected_at) >= ? AND DATE(cl.connected_at) <= ?
-    GROUP BY u.id"""
-    
-    cursor = conn.execute(user_activity_query, (start_date, end_date))
-    report_data['sections']['user_activities'] = [dict(row) for row in cursor.fetchall()]
-    
-    # 2. Login Attempts
-    login_query = """SELECT 
-        lh.username, lh.ip_address, lh.success, lh.failure_reason,
-        COUNT(*) as attempt_count,
-        MIN(lh.created_at) as first_attempt,
-        MAX(lh.created_at) as last_attempt
-    FROM login_history lh
-    WHERE DATE(lh.created_at) >= ? AND DATE(lh.created_at) <= ?
-    GROUP BY lh.username, lh.ip_address"""
-    
-    cursor = conn.execute(login_query, (start_date, end_date))
-    report_data['sections']['login_attempts'] = [dict(row) for row in cursor.fetchall()]
-    
-    # 3. Admin Operations
-    admin_query = """SELECT 
-        al.action, al.details, al.ip_address, al.created_at,
-        u.username as admin_username
-    FROM audit_logs al
-    LEFT JOIN users u ON al.user_id = u.id
-    WHERE DATE(al.created_at) >= ? AND DATE(al.created_at) <= ?
-    ORDER BY al.created_at DESC"""
-    
-    cursor = conn.execute(admin_query, (start_date, end_date))
-    report_data['sections']['admin_operations'] = [dict(row) for row in cursor.fetchall()]
-    
-    # 4. System Events
-    system_query = """SELECT 
-        event_type, severity, message, source, created_at,
-        COUNT(*) as event_count
-    FROM system_events
-    WHERE DATE(created_at) >= ? AND DATE(created_at) <= ?
-    GROUP BY event_type, severity
-    ORDER BY created_at DESC"""
-    
-    cursor = conn.execute(system_query, (start_date, end_date))
-    report_data['sections']['system_events'] = [dict(row) for row in cursor.fetchall()]
-    
-    # 5. Summary Statistics
-    summary_query = """SELECT 
-        (SELECT COUNT(*) FROM users WHERE DATE(created_at) >= ? AND DATE(created_at) <= ?) as new_users,
-        (SELECT COUNT(*) FROM connection_logs WHERE DATE(connected_at) >= ? AND DATE(connected_at) <= ?) as total_connections,
-        (SELECT COUNT(*) FROM login_history WHERE success = 1 AND DATE(created_at) >= ? AND DATE(created_at) <= ?) as successful_logins,
-        (SELECT COUNT(*) FROM login_history WHERE success = 0 AND DATE(created_at) >= ? AND DATE(created_at) <= ?) as failed_logins,
-        (SELECT COUNT(*) FROM alerts WHERE DATE(created_at) >= ? AND DATE(created_at) <= ?) as total_alerts"""
-    
-    cursor = conn.execute(summary_query, (start_date, end_date, start_date, end_date, start_date, end_date, start_date, end_date, start_date, end_date))
-    summary = cursor.fetchone()
-    report_data['sections']['summary'] = dict(summary)
+    with db_connection() as conn:
+        # 1. User Activities
+        user_activity_query = """SELECT 
+            u.id, u.username, u.email, u.is_active, u.created_at,
+            COUNT(DISTINCT cl.id) as connection_count,
+            SUM(COALESCE(cl.bytes_received, 0)) as total_received,
+            SUM(COALESCE(cl.bytes_sent, 0)) as total_sent
+        FROM users u
+        LEFT JOIN connection_logs cl ON u.id = cl.user_id 
+            AND cl.connected_at >= ? AND cl.connected_at < ?
+        GROUP BY u.id"""
+    
+        cursor = conn.execute(user_activity_query, (start_bound, end_bound))
+        report_data['sections']['user_activities'] = [dict(row) for row in cursor.fetchall()]
+    if progress:
+        progress(0.2)
+
+    with db_connection() as conn:
+        # 2. Login Attempts
+        login_query = """SELECT 
+            lh.username, lh.ip_address, lh.success, lh.failure_reason,
+            COUNT(*) as attempt_count,
+            MIN(lh.created_at) as first_attempt,
+            MAX(lh.created_at) as last_attempt
+        FROM login_history lh
+        WHERE lh.created_at >= ? AND lh.created_at < ?
+        GROUP BY lh.username, lh.ip_address"""
+    
+        cursor = conn.execute(login_query, (start_bound, end_bound))
+        report_data['sections']['login_attempts'] = [dict(row) for row in cursor.fetchall()]
+    if progress:
+        progress(0.4)
+
+    with db_connection() as conn:
+        # 3. Admin Operations
+        admin_query = """SELECT 
+            al.action, al.details, al.ip_address, al.created_at,
+            u.username as admin_username
+        FROM audit_logs al
+        LEFT JOIN users u ON al.user_id = u.id
+        WHERE al.created_at >= ? AND al.created_at < ?
+        ORDER BY al.created_at DESC"""
+    
+        cursor = conn.execute(admin_query, (start_bound, end_bound))
+        report_data['sections']['admin_operations'] = [dict(row) for row in cursor.fetchall()]
+    if progress:
+        progress(0.6)
+
+    with db_connection() as conn:
+        # 4. System Events
+        system_query = """SELECT 
+            event_type, severity, message, source, created_at,
+            COUNT(*) as event_count
+        FROM system_events
+        WHERE created_at >= ? AND created_at < ?
+        GROUP BY event_type, severity
+        ORDER BY created_at DESC"""
+    
+        cursor = conn.execute(system_query, (start_bound, end_bound))
+        report_data['sections']['system_events'] = [dict(row) for row in cursor.fetchall()]
+    if progress:
+        progress(0.8)
+
+    with db_connection() as conn:
+        # 5. Summary Statistics
+        summary_query = """SELECT 
+            (SELECT COUNT(*) FROM users WHERE created_at >= ? AND created_at < ?) as new_users,
+            (SELECT COUNT(*) FROM connection_logs WHERE connected_at >= ? AND connected_at < ?) as total_connections,
+            (SELECT COUNT(*) FROM login_history WHERE success = 1 AND created_at >= ? AND created_at < ?) as successful_logins,
+            (SELECT COUNT(*) FROM login_history WHERE success = 0 AND created_at >= ? AND created_at < ?) as failed_logins,
+            (SELECT COUNT(*) FROM alerts WHERE created_at >= ? AND created_at < ?) as total_alerts"""
+    
+        cursor = conn.execute(summary_query, (start_bound, end_bound) * 5)
+        summary = cursor.fetchone()
+        report_data['sections']['summary'] = dict(summary)
     
-    conn.close()
     return report_data
 
 # ============== Scheduled Reports ==============
@@ -1246,52 +2268,48 @@ def create_scheduled_report(name: str, report_type: str, schedule_type: str, sch
                             include_traffic: bool = True, include_users: bool = False,
                             include_system: bool = False, include_audit: bool = False,
                             top_users_count: int = 10, email_recipients: str = None,
-                            created_by: int = None):
+                            created_by: int = None, next_run_at: str = None):
     """Create a new scheduled report"""
     import json
-    conn = get_db_connection()
-    cursor = conn.execute(
-        """INSERT INTO scheduled_reports 
-           (name, report_type, schedule_type, schedule_time, schedule_dayOfWeek, schedule_dayOfMonth,
-            include_traffic, include_users, include_system, include_audit, top_users_count,
-            email_recipients, created_by)
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (name, report_type, schedule_type, schedule_time, schedule_dayOfWeek, schedule_dayOfMonth,
-         include_traffic, include_users, include_system, include_audit, top_users_count,
-         email_recipients, created_by)
-    )
-    conn.commit()
-    report_id = cursor.lastrowid
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """INSERT INTO scheduled_reports 
+               (name, report_type, schedule_type, schedule_time, schedule_dayOfWeek, schedule_dayOfMonth,
+                include_traffic, include_users, include_system, include_audit, top_users_count,
+                email_recipients, created_by, next_run_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (name, report_type, schedule_type, schedule_time, schedule_dayOfWeek, schedule_dayOfMonth,
+             include_traffic, include_users, include_system, include_audit, top_users_count,
+             email_recipients, created_by, next_run_at)
+        )
+        report_id = cursor.lastrowid
     return get_scheduled_report(report_id)
 
 def get_scheduled_report(report_id: int):
     """Get a scheduled report by ID"""
-    conn = get_db_connection()
-    cursor = conn.execute("SELECT * FROM scheduled_reports WHERE id = ?", (report_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute("SELECT * FROM scheduled_reports WHERE id = ?", (report_id,))
+        row = cursor.fetchone()
     return dict(row) if row else None
 
 def get_scheduled_reports(report_type: str = None, is_active: bool = None, limit: int = 50, offset: int = 0):
     """Get list of scheduled reports"""
-    conn = get_db_connection()
-    query = "SELECT * FROM scheduled_reports WHERE 1=1"
-    params = []
+    with db_connection() as conn:
+        query = "SELECT * FROM scheduled_reports WHERE 1=1"
+        params = []
     
-    if report_type:
-        query += " AND report_type = ?"
-        params.append(report_type)
-    if is_active is not None:
-        query += " AND is_active = ?"
-        params.append(1 if is_active else 0)
+        if report_type:
+            query += " AND report_type = ?"
+            params.append(report_type)
+        if is_active is not None:
+            query += " AND is_active = ?"
+            params.append(1 if is_active else 0)
     
-    query += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
+        query += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
     
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    conn.close()
+        cursor = conn.execute(query, params)
+        rows = cursor.fetchall()
     return [dict(row) for row in rows]
 
 def update_scheduled_report(report_id: int, **kwargs):
@@ -1311,29 +2329,65 @@ def update_scheduled_report(report_id: int, **kwargs):
         return get_scheduled_report(report_id)
     
     params.append(report_id)
-    conn = get_db_connection()
-    conn.execute(f"UPDATE scheduled_reports SET {', '.join(updates)} WHERE id = ?", params)
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute(f"UPDATE scheduled_reports SET {', '.join(updates)} WHERE id = ?", params)
     return get_scheduled_report(report_id)
 
 def delete_scheduled_report(report_id: int):
     """Delete a scheduled report"""
-    conn = get_db_connection()
-    conn.execute("DELETE FROM scheduled_reports WHERE id = ?", (report_id,))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute("DELETE FROM scheduled_reports WHERE id = ?", (report_id,))
     return True
 
 def update_scheduled_report_run_time(report_id: int, last_run: str, next_run: str):
     """Update last_run_at and next_run_at for a scheduled report"""
-    conn = get_db_connection()
-    conn.execute(
-        "UPDATE scheduled_reports SET last_run_at = ?, next_run_at = ? WHERE id = ?",
-        (last_run, next_run, report_id)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE scheduled_reports SET last_run_at = ?, next_run_at = ? WHERE id = ?",
+            (last_run, next_run, report_id)
+        )
+
+def advance_scheduled_report(report_id: int, expected_next_run: str, last_run: str, next_run: str) -> bool:
+    """
+    Move next_run_at forward only if it still equals expected_next_run
+    (compare-and-set), so one occurrence is claimed by exactly one runner
+    """
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """UPDATE scheduled_reports SET last_run_at = COALESCE(?, last_run_at), next_run_at = ?
+               WHERE id = ? AND next_run_at IS ?""",
+            (last_run, next_run, report_id, expected_next_run)
+        )
+    return cursor.rowcount == 1
+
+def get_active_scheduled_reports():
+    """Get every active scheduled report (for the scheduler)"""
+    with db_connection() as conn:
+        rows = conn.execute("SELECT * FROM scheduled_reports WHERE is_active = 1").fetchall()
+    return [dict(row) for row in rows]
+
+# ============== Leases ==============
+
+def acquire_lease(name: str, holder: str, ttl_seconds: float) -> bool:
+    """
+    Take or renew the named lease for ttl_seconds
+    Succeeds when the lease is free, expired or already held by holder.
+    """
+    now = time.time()
+    with db_connection() as conn:
+        conn.execute(
+            """INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+               ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+               WHERE leases.holder = excluded.holder OR leases.expires_at < ?""",
+            (name, holder, now + ttl_seconds, now)
+        )
+        row = conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+    return row['holder'] == holder
+
+def release_lease(name: str, holder: str):
+    """Give up the named lease if holder still has it"""
+    with db_connection() as conn:
+        conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
 
 # ============== Report Templates ==============
 
@@ -1341,48 +2395,44 @@ def create_report_template(name: str, description: str, data_sources: str, date_
                            custom_start_date: str = None, custom_end_date: str = None,
                            format: str = 'json', filters: str = None, created_by: int = None):
     """Create a new report template"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        """INSERT INTO report_templates 
-           (name, description, data_sources, date_range, custom_start_date, custom_end_date, format, filters, created_by)
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (name, description, data_sources, date_range, custom_start_date, custom_end_date, format, filters, created_by)
-    )
-    conn.commit()
-    template_id = cursor.lastrowid
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """INSERT INTO report_templates 
+               (name, description, data_sources, date_range, custom_start_date, custom_end_date, format, filters, created_by)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (name, description, data_sources, date_range, custom_start_date, custom_end_date, format, filters, created_by)
+        )
+        template_id = cursor.lastrowid
     return get_report_template(template_id)
 
 def get_report_template(template_id: int):
     """Get a report template by ID"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        """SELECT rt.*, u.username as created_by_username
-           FROM report_templates rt 
-           LEFT JOIN users u ON rt.created_by = u.id 
-           WHERE rt.id = ?""",
-        (template_id,)
-    )
-    row = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """SELECT rt.*, u.username as created_by_username
+               FROM report_templates rt 
+               LEFT JOIN users u ON rt.created_by = u.id 
+               WHERE rt.id = ?""",
+            (template_id,)
+        )
+        row = cursor.fetchone()
     return dict(row) if row else None
 
 def get_report_templates(created_by: int = None, limit: int = 50, offset: int = 0):
     """Get list of report templates"""
-    conn = get_db_connection()
-    query = "SELECT rt.*, u.username as created_by_username FROM report_templates rt LEFT JOIN users u ON rt.created_by = u.id"
-    params = []
+    with db_connection() as conn:
+        query = "SELECT rt.*, u.username as created_by_username FROM report_templates rt LEFT JOIN users u ON rt.created_by = u.id"
+        params = []
     
-    if created_by:
-        query += " WHERE rt.created_by = ?"
-        params.append(created_by)
+        if created_by:
+            query += " WHERE rt.created_by = ?"
+            params.append(created_by)
     
-    query += " ORDER BY rt.created_at DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
+        query += " ORDER BY rt.created_at DESC LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
     
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    conn.close()
+        cursor = conn.execute(query, params)
+        rows = cursor.fetchall()
     return [dict(row) for row in rows]
 
 def update_report_template(template_id: int, **kwargs):
@@ -1403,18 +2453,14 @@ def update_report_template(template_id: int, **kwargs):
     
     updates.append("updated_at = CURRENT_TIMESTAMP")
     params.append(template_id)
-    conn = get_db_connection()
-    conn.execute(f"UPDATE report_templates SET {', '.join(updates)} WHERE id = ?", params)
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute(f"UPDATE report_templates SET {', '.join(updates)} WHERE id = ?", params)
     return get_report_template(template_id)
 
 def delete_report_template(template_id: int):
     """Delete a report template"""
-    conn = get_db_connection()
-    conn.execute("DELETE FROM report_templates WHERE id = ?", (template_id,))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute("DELETE FROM report_templates WHERE id = ?", (template_id,))
     return True
 
 # ============== Generated Reports ==============
@@ -1422,59 +2468,150 @@ def delete_report_template(template_id: int):
 def create_generated_report(name: str, report_type: str, start_date: str, end_date: str,
                             data: str = None, file_path: str = None, format: str = 'json',
                             template_id: int = None, scheduled_report_id: int = None,
-                            generated_by: int = None):
-    """Create a generated report record"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        """INSERT INTO generated_reports 
-           (name, report_type, start_date, end_date, data, file_path, format, template_id, scheduled_report_id, generated_by)
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (name, report_type, start_date, end_date, data, file_path, format, template_id, scheduled_report_id, generated_by)
-    )
-    conn.commit()
-    report_id = cursor.lastrowid
-    conn.close()
+                            generated_by: int = None, status: str = 'completed'):
+    """Create a generated report record (status='pending' for a queued report)"""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """INSERT INTO generated_reports 
+               (name, report_type, start_date, end_date, data, file_path, format, template_id, scheduled_report_id,
+                generated_by, status, progress, completed_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CASE WHEN ? = 'completed' THEN CURRENT_TIMESTAMP END)""",
+            (name, report_type, start_date, end_date, data, file_path, format, template_id, scheduled_report_id,
+             generated_by, status, 100 if status == 'completed' else 0, status)
+        )
+        report_id = cursor.lastrowid
     return get_generated_report(report_id)
 
 def get_generated_report(report_id: int):
     """Get a generated report by ID"""
-    conn = get_db_connection()
-    cursor = conn.execute(
-        """SELECT gr.*, u.username as generated_by_username
-           FROM generated_reports gr 
-           LEFT JOIN users u ON gr.generated_by = u.id 
-           WHERE gr.id = ?""",
-        (report_id,)
-    )
-    row = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute(
+            """SELECT gr.*, u.username as generated_by_username
+               FROM generated_reports gr 
+               LEFT JOIN users u ON gr.generated_by = u.id 
+               WHERE gr.id = ?""",
+            (report_id,)
+        )
+        row = cursor.fetchone()
     return dict(row) if row else None
 
 def get_generated_reports(template_id: int = None, scheduled_report_id: int = None,
                           report_type: str = None, limit: int = 50, offset: int = 0):
     """Get list of generated reports"""
-    conn = get_db_connection()
-    query = "SELECT gr.*, u.username as generated_by_username FROM generated_reports gr LEFT JOIN users u ON gr.generated_by = u.id WHERE 1=1"
-    params = []
+    with db_connection() as conn:
+        query = "SELECT gr.*, u.username as generated_by_username FROM generated_reports gr LEFT JOIN users u ON gr.generated_by = u.id WHERE 1=1"
+        params = []
     
-    if template_id:
-        query += " AND gr.template_id = ?"
-        params.append(template_id)
-    if scheduled_report_id:
-        query += " AND gr.scheduled_report_id = ?"
-        params.append(scheduled_report_id)
-    if report_type:
-        query += " AND gr.report_type = ?"
-        params.append(report_type)
-    
-    query += " ORDER BY gr.generated_at DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
-    
-    cursor = conn.execute(query, params)
-    rows = cursor.fetchall()
-    conn.close()
+        if template_id:
+            query += " AND gr.template_id = ?"
+            params.append(template_id)
+        if scheduled_report_id:
+            query += " AND gr.scheduled_report_id = ?"
+            params.append(scheduled_report_id)
+        if report_type:
+            query += " AND gr.report_type = ?"
+            params.append(report_type)
+    
+        query += " ORDER BY gr.generated_at DESC LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+    
+        cursor = conn.execute(query, params)
+        rows = cursor.fetchall()
     return [dict(row) for row in rows]
 
+def update_generated_report(report_id: int, **kwargs):
+    """Update the data or file of a generated report"""
+    allowed_fields = ['data', 'file_path', 'format']
+    updates = []
+    params = []
+    for key, value in kwargs.items():
+        if key in allowed_fields:
+            updates.append(f"{key} = ?")
+            params.append(value)
+    if not updates:
+        return
+    params.append(report_id)
+    with db_connection() as conn:
+        conn.execute(f"UPDATE generated_reports SET {', '.join(updates)} WHERE id = ?", params)
+
+# ============== Report Jobs ==============
+# compliance_reports and generated_reports rows double as job records:
+# status goes pending -> running -> completed / failed / cancelled. Every
+# transition is a conditional UPDATE, so a cancel from any process wins
+# over a worker that is still running.
+
+REPORT_JOB_TABLES = ('compliance_reports', 'generated_reports')
+
+def _report_job_table(table: str) -> str:
+    if table not in REPORT_JOB_TABLES:
+        raise ValueError(f"Unknown report table '{table}'")
+    return table
+
+def claim_report_job(table: str, report_id: int) -> bool:
+    """Move a pending report to running; False if it was cancelled meanwhile"""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            f"""UPDATE {_report_job_table(table)} SET status = 'running', progress = 0, started_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'pending'""",
+            (report_id,)
+        )
+    return cursor.rowcount == 1
+
+def update_report_progress(table: str, report_id: int, progress: float) -> bool:
+    """Record progress (percent) of a running report; False once it is no longer running"""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            f"UPDATE {_report_job_table(table)} SET progress = ? WHERE id = ? AND status = 'running'",
+            (round(progress, 1), report_id)
+        )
+    return cursor.rowcount == 1
+
+def finish_report_job(table: str, report_id: int, status: str, error: str = None) -> bool:
+    """Move a running report to completed or failed; False if it was cancelled"""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            f"""UPDATE {_report_job_table(table)}
+                SET status = ?, error = ?, completed_at = CURRENT_TIMESTAMP,
+                    progress = CASE WHEN ? = 'completed' THEN 100 ELSE progress END
+                WHERE id = ? AND status = 'running'""",
+            (status, error, status, report_id)
+        )
+    return cursor.rowcount == 1
+
+def cancel_report_job(table: str, report_id: int) -> bool:
+    """Cancel a pending or running report; False if it already finished"""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            f"""UPDATE {_report_job_table(table)} SET status = 'cancelled', completed_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status IN ('pending', 'running')""",
+            (report_id,)
+        )
+    return cursor.rowcount == 1
+
+def requeue_report_job(table: str, report_id: int) -> bool:
+    """Reset a finished, failed or cancelled report to pending for a rebuild"""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            f"""UPDATE {_report_job_table(table)}
+                SET status = 'pending', progress = 0, error = NULL, file_path = NULL,
+                    started_at = NULL, completed_at = NULL
+                WHERE id = ? AND status NOT IN ('pending', 'running')""",
+            (report_id,)
+        )
+    return cursor.rowcount == 1
+
+def fail_interrupted_report_jobs() -> int:
+    """Mark reports left pending or running by a previous process as failed"""
+    failed = 0
+    with db_connection() as conn:
+        for table in REPORT_JOB_TABLES:
+            failed += conn.execute(
+                f"""UPDATE {table} SET status = 'failed', error = 'Interrupted by a restart',
+                        completed_at = CURRENT_TIMESTAMP
+                    WHERE status IN ('pending', 'running')"""
+            ).rowcount
+    return failed
+
 # ============== Traffic Report Data Generation ==============
 
 def generate_traffic_report_data(start_date: str, end_date: str, include_users: bool = True,
@@ -1488,73 +2625,71 @@ def generate_traffic_report_data(start_date: str, end_date: str, include_users:
         'traffic': {}
     }
     
-    conn = get_db_connection()
-    
-    # 1. Total traffic summary
-    total_query = """SELECT 
-        COALESCE(SUM(bytes_received), 0) as total_received,
-        COALESCE(SUM(bytes_sent), 0) as total_sent,
-        COUNT(DISTINCT user_id) as active_users
-    FROM traffic_records
-    WHERE date >= ? AND date <= ?"""
-    
-    cursor = conn.execute(total_query, (start_date, end_date))
-    total = cursor.fetchone()
-    report_data['traffic']['total_received'] = total['total_received']
-    report_data['traffic']['total_sent'] = total['total_sent']
-    report_data['traffic']['total_transfer'] = total['total_received'] + total['total_sent']
-    report_data['traffic']['active_users'] = total['active_users']
-    
-    # 2. Top users by traffic
-    if include_users:
-        top_users_query = """SELECT 
-            u.id, u.username,
-            COALESCE(SUM(tr.bytes_received), 0) as total_received,
-            COALESCE(SUM(tr.bytes_sent), 0) as total_sent,
-            COALESCE(SUM(tr.bytes_received) + SUM(tr.bytes_sent), 0) as total_transfer
-        FROM users u
-        LEFT JOIN traffic_records tr ON u.id = tr.user_id AND tr.date >= ? AND tr.date <= ?
-        GROUP BY u.id
-        ORDER BY total_transfer DESC
-        LIMIT ?"""
+    with db_connection() as conn:
+        # 1. Total traffic summary
+        total_query = """SELECT 
+            COALESCE(SUM(bytes_received), 0) as total_received,
+            COALESCE(SUM(bytes_sent), 0) as total_sent,
+            COUNT(DISTINCT user_id) as active_users
+        FROM traffic_records
+        WHERE date >= ? AND date <= ?"""
+    
+        cursor = conn.execute(total_query, (start_date, end_date))
+        total = cursor.fetchone()
+        report_data['traffic']['total_received'] = total['total_received']
+        report_data['traffic']['total_sent'] = total['total_sent']
+        report_data['traffic']['total_transfer'] = total['total_received'] + total['total_sent']
+        report_data['traffic']['active_users'] = total['active_users']
+    
+        # 2. Top users by traffic
+        if include_users:
+            top_users_query = """SELECT 
+                u.id, u.username,
+                COALESCE(SUM(tr.bytes_received), 0) as total_received,
+                COALESCE(SUM(tr.bytes_sent), 0) as total_sent,
+                COALESCE(SUM(tr.bytes_received) + SUM(tr.bytes_sent), 0) as total_transfer
+            FROM users u
+            LEFT JOIN traffic_records tr ON u.id = tr.user_id AND tr.date >= ? AND tr.date <= ?
+            GROUP BY u.id
+            ORDER BY total_transfer DESC
+            LIMIT ?"""
         
-        cursor = conn.execute(top_users_query, (start_date, end_date, top_users_count))
-        report_data['traffic']['top_users'] = [dict(row) for row in cursor.fetchall()]
-    
-    # 3. Daily traffic trends
-    daily_query = """SELECT 
-        date,
-        COALESCE(SUM(bytes_received), 0) as total_received,
-        COALESCE(SUM(bytes_sent), 0) as total_sent
-    FROM traffic_records
-    WHERE date >= ? AND date <= ?
-    GROUP BY date
-    ORDER BY date"""
-    
-    cursor = conn.execute(daily_query, (start_date, end_date))
-    report_data['traffic']['daily_trends'] = [dict(row) for row in cursor.fetchall()]
-    
-    # 4. Peak hours analysis
-    hourly_query = """SELECT 
-        strftime('%H', snapshot_time) as hour,
-        COUNT(*) as connection_count,
-        COALESCE(SUM(bytes_received), 0) as total_received,
-        COALESCE(SUM(bytes_sent), 0) as total_sent
-    FROM traffic_logs
-    WHERE DATE(snapshot_time) >= ? AND DATE(snapshot_time) <= ?
-    GROUP BY hour
-    ORDER BY hour"""
-    
-    cursor = conn.execute(hourly_query, (start_date, end_date))
-    report_data['traffic']['hourly_distribution'] = [dict(row) for row in cursor.fetchall()]
-    
-    # Find peak hour
-    if report_data['traffic']['hourly_distribution']:
-        peak = max(report_data['traffic']['hourly_distribution'], 
-                   key=lambda x: x['total_received'] + x['total_sent'])
-        report_data['traffic']['peak_hour'] = peak['hour']
+            cursor = conn.execute(top_users_query, (start_date, end_date, top_users_count))
+            report_data['traffic']['top_users'] = [dict(row) for row in cursor.fetchall()]
+    
+        # 3. Daily traffic trends
+        daily_query = """SELECT 
+            date,
+            COALESCE(SUM(bytes_received), 0) as total_received,
+            COALESCE(SUM(bytes_sent), 0) as total_sent
+        FROM traffic_records
+        WHERE date >= ? AND date <= ?
+        GROUP BY date
+        ORDER BY date"""
+    
+        cursor = conn.execute(daily_query, (start_date, end_date))
+        report_data['traffic']['daily_trends'] = [dict(row) for row in cursor.fetchall()]
+    
+        # 4. Peak hours analysis (hourly rollup tier)
+        hourly_query = """SELECT 
+            substr(bucket, 12, 2) as hour,
+            COALESCE(SUM(samples), 0) as connection_count,
+            COALESCE(SUM(bytes_received), 0) as total_received,
+            COALESCE(SUM(bytes_sent), 0) as total_sent
+        FROM traffic_rollup_hour
+        WHERE bucket >= ? AND bucket < ?
+        GROUP BY hour
+        ORDER BY hour"""
+    
+        cursor = conn.execute(hourly_query, date_bounds(start_date, end_date))
+        report_data['traffic']['hourly_distribution'] = [dict(row) for row in cursor.fetchall()]
+    
+        # Find peak hour
+        if report_data['traffic']['hourly_distribution']:
+            peak = max(report_data['traffic']['hourly_distribution'], 
+                       key=lambda x: x['total_received'] + x['total_sent'])
+            report_data['traffic']['peak_hour'] = peak['hour']
     
-    conn.close()
     return report_data
 
 # ============== User Statistics ==============
@@ -1573,60 +2708,75 @@ def get_user_statistics(start_date: str = None, end_date: str = None):
         'users': []
     }
     
-    conn = get_db_connection()
-    
-    # Get all users with their stats
-    users_query = """SELECT 
-        u.id, u.username, u.email, u.is_active, u.created_at,
-        COALESCE(SUM(tr.bytes_received), 0) as total_received,
-        COALESCE(SUM(tr.bytes_sent), 0) as total_sent,
-        COALESCE(SUM(tr.bytes_received) + SUM(tr.bytes_sent), 0) as total_transfer,
-        COUNT(DISTINCT tr.date) as active_days,
-        (SELECT COUNT(*) FROM connection_logs cl WHERE cl.user_id = u.id AND DATE(cl.connected_at) >= ? AND DATE(cl.connected_at) <= ?) as connection_count,
-        (SELECT MAX(cl.connected_at) FROM connection_logs cl WHERE cl.user_id = u.id) as last_connection
-    FROM users u
-    LEFT JOIN traffic_records tr ON u.id = tr.user_id AND tr.date >= ? AND tr.date <= ?
-    GROUP BY u.id
-    ORDER BY total_transfer DESC"""
-    
-    cursor = conn.execute(users_query, (start_date, end_date, start_date, end_date))
-    users = [dict(row) for row in cursor.fetchall()]
-    
-    # Calculate average daily usage
-    for user in users:
-        if user['active_days'] and user['active_days'] > 0:
-            user['avg_daily_transfer'] = user['total_transfer'] / user['active_days']
-        else:
-            user['avg_daily_transfer'] = 0
-    
-    stats['users'] = users
-    
-    # Summary
-    summary_query = """SELECT 
-        COUNT(*) as total_users,
-        SUM(total_received) as total_received,
-        SUM(total_sent) as total_sent,
-        AVG(total_transfer) as avg_transfer
-    FROM (
-        SELECT 
-            u.id,
+    with db_connection() as conn:
+        # Get all users with their stats
+        users_query = """SELECT 
+            u.id, u.username, u.email, u.is_active, u.created_at,
             COALESCE(SUM(tr.bytes_received), 0) as total_received,
             COALESCE(SUM(tr.bytes_sent), 0) as total_sent,
-            COALESCE(SUM(tr.bytes_received) + SUM(tr.bytes_sent), 0) as total_transfer
+            COALESCE(SUM(tr.bytes_received) + SUM(tr.bytes_sent), 0) as total_transfer,
+            COUNT(DISTINCT tr.date) as active_days,
+            (SELECT COUNT(*) FROM connection_logs cl WHERE cl.user_id = u.id AND cl.connected_at >= ? AND cl.connected_at < ?) as connection_count,
+            (SELECT MAX(cl.connected_at) FROM connection_logs cl WHERE cl.user_id = u.id) as last_connection
         FROM users u
         LEFT JOIN traffic_records tr ON u.id = tr.user_id AND tr.date >= ? AND tr.date <= ?
         GROUP BY u.id
-    )"""
-    
-    cursor = conn.execute(summary_query, (start_date, end_date))
-    summary = cursor.fetchone()
-    stats['summary'] = dict(summary)
+        ORDER BY total_transfer DESC"""
+    
+        cursor = conn.execute(users_query, (*date_bounds(start_date, end_date), start_date, end_date))
+        users = [dict(row) for row in cursor.fetchall()]
+    
+        # Calculate average daily usage
+        for user in users:
+            if user['active_days'] and user['active_days'] > 0:
+                user['avg_daily_transfer'] = user['total_transfer'] / user['active_days']
+            else:
+                user['avg_daily_transfer'] = 0
+    
+        stats['users'] = users
+    
+        # Summary
+        summary_query = """SELECT 
+            COUNT(*) as total_users,
+            SUM(total_received) as total_received,
+            SUM(total_sent) as total_sent,
+            AVG(total_transfer) as avg_transfer
+        FROM (
+            SELECT 
+                u.id,
+                COALESCE(SUM(tr.bytes_received), 0) as total_received,
+                COALESCE(SUM(tr.bytes_sent), 0) as total_sent,
+                COALESCE(SUM(tr.bytes_received) + SUM(tr.bytes_sent), 0) as total_transfer
+            FROM users u
+            LEFT JOIN traffic_records tr ON u.id = tr.user_id AND tr.date >= ? AND tr.date <= ?
+            GROUP BY u.id
+        )"""
+    
+        cursor = conn.execute(summary_query, (start_date, end_date))
+        summary = cursor.fetchone()
+        stats['summary'] = dict(summary)
     
-    conn.close()
     return stats
 
 # ============== System Health ==============
 
+def cpu_usage_percent(before, after) -> float:
+    """CPU usage between two psutil.cpu_times() readings"""
+    total = sum(after) - sum(before)
+    idle = (after.idle + getattr(after, 'iowait', 0)) - (before.idle + getattr(before, 'iowait', 0))
+    return round(max(0.0, min(100.0, (total - idle) / total * 100)), 1) if total > 0 else 0.0
+
+def measure_cpu_percent(interval: float = 0.5) -> float:
+    """
+    CPU usage over the next `interval` seconds (blocking)
+    Uses its own cpu_times() baseline; psutil.cpu_percent(interval=None)
+    shares one baseline across the process, so concurrent callers reset it.
+    """
+    import psutil
+    before = psutil.cpu_times()
+    time.sleep(interval)
+    return cpu_usage_percent(before, psutil.cpu_times())
+
 def get_system_health():
     """Get system health metrics"""
     import psutil
@@ -1641,8 +2791,8 @@ def get_system_health():
         'wireguard': {}
     }
     
-    # CPU usage
-    health['cpu']['usage_percent'] = psutil.cpu_percent(interval=1)
+    # CPU
+    health['cpu']['usage_percent'] = measure_cpu_percent()
     health['cpu']['count'] = psutil.cpu_count()
     
     # Memory
@@ -1661,13 +2811,12 @@ def get_system_health():
     
     # Active connections
     try:
-        conn = get_db_connection()
-        cursor = conn.execute(
-            "SELECT COUNT(*) as count FROM connection_logs WHERE disconnected_at IS NULL"
-        )
-        row = cursor.fetchone()
-        health['network']['active_connections'] = row['count'] if row else 0
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.execute(
+                "SELECT COUNT(*) as count FROM connection_logs WHERE disconnected_at IS NULL"
+            )
+            row = cursor.fetchone()
+            health['network']['active_connections'] = row['count'] if row else 0
     except:
         health['network']['active_connections'] = 0
     
@@ -1684,43 +2833,59 @@ def get_system_health():
     
     return health
 
+def health_alerts(health: dict):
+    """Alerts for the CPU, memory and disk usage of a health snapshot"""
+    alerts = []
+    checks = [
+        ('cpu', 'CPU', health['cpu']['usage_percent']),
+        ('memory', 'Memory', health['memory']['percent']),
+        ('disk', 'Disk', health['disk']['percent']),
+    ]
+    for alert_type, label, value in checks:
+        if value is not None and value > 80:
+            alerts.append({
+                'type': alert_type,
+                'severity': 'warning' if value < 90 else 'critical',
+                'message': f'{label} usage is at {value:.1f}%',
+                'value': value
+            })
+    return alerts
+
 def get_health_alerts():
     """Get health alerts"""
     import psutil
     
-    alerts = []
-    
-    # Check CPU
-    cpu = psutil.cpu_percent(interval=1)
-    if cpu > 80:
-        alerts.append({
-            'type': 'cpu',
-            'severity': 'warning' if cpu < 90 else 'critical',
-            'message': f'CPU usage is at {cpu:.1f}%',
-            'value': cpu
-        })
-    
-    # Check Memory
-    mem = psutil.virtual_memory()
-    if mem.percent > 80:
-        alerts.append({
-            'type': 'memory',
-            'severity': 'warning' if mem.percent < 90 else 'critical',
-            'message': f'Memory usage is at {mem.percent:.1f}%',
-            'value': mem.percent
-        })
-    
-    # Check Disk
-    disk = psutil.disk_usage('/')
-    if disk.percent > 80:
-        alerts.append({
-            'type': 'disk',
-            'severity': 'warning' if disk.percent < 90 else 'critical',
-            'message': f'Disk usage is at {disk.percent:.1f}%',
-            'value': disk.percent
-        })
-    
-    return alerts
+    return health_alerts({
+        'cpu': {'usage_percent': measure_cpu_percent()},
+        'memory': {'percent': psutil.virtual_memory().percent},
+        'disk': {'percent': psutil.disk_usage('/').percent}
+    })
+
+def save_health_sample(data: str):
+    """Persist one health sample (JSON)"""
+    with db_connection() as conn:
+        conn.execute("INSERT INTO health_samples (data) VALUES (?)", (data,))
+
+def get_health_samples(limit: int):
+    """Most recent persisted health samples (JSON strings), oldest first"""
+    with db_connection() as conn:
+        rows = conn.execute(
+            "SELECT data FROM (SELECT id, data FROM health_samples ORDER BY id DESC LIMIT ?) ORDER BY id",
+            (limit,)
+        ).fetchall()
+    return [row['data'] for row in rows]
 
 if __name__ == "__main__":
+    import sys
+    
     init_db()
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill-deltas":
+        print(f"Backfilled deltas for {backfill_traffic_deltas()} traffic log rows")
+    elif len(sys.argv) > 1 and sys.argv[1] == "backfill-rollups":
+        print(f"Rebuilt daily rollups from {rebuild_traffic_rollups()} traffic log rows")
+    elif len(sys.argv) > 1 and sys.argv[1] == "retention":
+        print(run_retention())
+    elif len(sys.argv) > 1 and sys.argv[1] == "rebuild-search-index":
+        print(f"Indexed {rebuild_log_search_index()} log rows for search")
+    elif len(sys.argv) > 1 and sys.argv[1] == "enable-incremental-vacuum":
+        print(f"auto_vacuum mode: {enable_incremental_vacuum()}")
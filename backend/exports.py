@@ -0,0 +1,339 @@
+"""
+Streaming exports for WireGuard VPN Admin
+
+Encoders turn an iterator of row tuples into an iterator of byte chunks,
+so exports of any size are written incrementally in constant memory.
+Export jobs run the same encoders on a worker pool and write gzip files
+to disk, which clients download (and resume) with HTTP Range requests.
+"""
+
+import csv
+import io
+import json
+import os
+import re
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import database
+
+# Bytes buffered before a chunk is handed to the response
+CHUNK_SIZE = 64 * 1024
+
+# Directory holding finished export job files
+EXPORT_DIR = Path(os.environ.get("WGVPN_EXPORT_DIR", Path(__file__).parent / "export_files"))
+
+# Export jobs running at the same time; more jobs wait in the queue
+EXPORT_WORKERS = int(os.environ.get("WGVPN_EXPORT_WORKERS", "2"))
+
+# Hours a finished export file is kept before garbage collection
+EXPORT_RETENTION_HOURS = float(os.environ.get("WGVPN_EXPORT_RETENTION_HOURS", "24"))
+
+# Rows written between two progress updates of a job
+PROGRESS_EVERY = 10000
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return str(value)
+
+
+def encode_csv(columns: Sequence[str], rows: Iterable[Sequence]) -> Iterator[bytes]:
+    """Encode rows as CSV with a header line"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def encode_ndjson(columns: Sequence[str], rows: Iterable[Sequence]) -> Iterator[bytes]:
+    """Encode rows as newline-delimited JSON objects"""
+    parts: List[str] = []
+    size = 0
+    for row in rows:
+        line = json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=_json_default) + '\n'
+        parts.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(parts).encode('utf-8')
+            parts, size = [], 0
+    yield ''.join(parts).encode('utf-8')
+
+
+def encode_json(columns: Sequence[str], rows: Iterable[Sequence]) -> Iterator[bytes]:
+    """Encode rows as one JSON array, written element by element"""
+    yield b'['
+    separator = b''
+    for chunk in encode_ndjson(columns, rows):
+        if chunk:
+            lines = chunk.rstrip(b'\n').split(b'\n')
+            yield separator + b',\n'.join(lines)
+            separator = b',\n'
+    yield b']\n'
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """Compress a stream of chunks into one gzip member on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# format -> (encoder, media type, file extension)
+EXPORT_FORMATS = {
+    'csv': (encode_csv, 'text/csv', 'csv'),
+    'ndjson': (encode_ndjson, 'application/x-ndjson', 'ndjson'),
+    'json': (encode_json, 'application/json', 'json'),
+}
+
+
+def open_log_export(format: str = 'csv', compress: bool = False, **filters):
+    """
+    Start a streaming log export (blocking until the queries are running)
+    filters are passed to database.iter_logs_for_export
+    Returns (chunks, media_type, filename)
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format '{format}', expected one of {', '.join(EXPORT_FORMATS)}")
+    encoder, media_type, extension = EXPORT_FORMATS[format]
+
+    columns, rows = database.iter_logs_for_export(**filters)
+    chunks = encoder(columns, rows)
+    filename = f"logs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+    if compress:
+        chunks = gzip_chunks(chunks)
+        media_type = 'application/gzip'
+        filename += '.gz'
+    return chunks, media_type, filename
+
+
+# ============== Export Jobs ==============
+
+USER_STATS_COLUMNS = ['id', 'username', 'email', 'is_active', 'total_received', 'total_sent',
+                      'total_transfer', 'active_days', 'connection_count', 'avg_daily_transfer']
+
+
+def _log_rows(keyword=None, log_type=None, user_id=None, start_date=None, end_date=None):
+    total = database.search_logs(
+        keyword=keyword, log_type=log_type, user_id=user_id,
+        start_date=start_date, end_date=end_date, limit=1
+    )['total']
+    columns, rows = database.iter_logs_for_export(
+        keyword=keyword, log_type=log_type, user_id=user_id,
+        start_date=start_date, end_date=end_date
+    )
+    return columns, rows, total
+
+
+def _user_stats_rows(start_date=None, end_date=None):
+    users = database.get_user_statistics(start_date=start_date, end_date=end_date)['users']
+    rows = (tuple(user.get(column) for column in USER_STATS_COLUMNS) for user in users)
+    return USER_STATS_COLUMNS, rows, len(users)
+
+
+# kind -> (row source returning (columns, rows, total), accepted filters)
+EXPORT_SOURCES = {
+    'logs': (_log_rows, ('keyword', 'log_type', 'user_id', 'start_date', 'end_date')),
+    'user-stats': (_user_stats_rows, ('start_date', 'end_date')),
+}
+
+
+def _timestamp(value: datetime) -> str:
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def job_status(job: Dict) -> Dict:
+    """Public view of an export job with its progress percentage"""
+    if job['status'] == 'completed':
+        progress = 100.0
+    elif job['total_rows']:
+        progress = round(min(job['rows_written'] / job['total_rows'], 1.0) * 100, 1)
+    else:
+        progress = 0.0
+    status = {key: value for key, value in job.items() if key != 'file_path'}
+    status['params'] = json.loads(job['params']) if job['params'] else {}
+    status['progress'] = progress
+    status['download_url'] = f"/api/exports/{job['id']}/download" if job['status'] == 'completed' else None
+    return status
+
+
+class ExportJobManager:
+    """Runs export jobs on a bounded worker pool and writes gzip files to disk"""
+
+    def __init__(self, workers: int = EXPORT_WORKERS, export_dir: Path = EXPORT_DIR,
+                 retention_hours: float = EXPORT_RETENTION_HOURS):
+        self.export_dir = Path(export_dir)
+        self.retention = timedelta(hours=retention_hours)
+        self.workers = workers
+        # Submitted jobs that have not finished yet (queued + running)
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='export')
+
+    def submit(self, kind: str, format: str = 'csv', created_by: int = None, **filters) -> Dict:
+        """
+        Validate and queue an export job (blocking); returns its status
+        Raises ValueError for an unknown kind or format
+        """
+        if kind not in EXPORT_SOURCES:
+            raise ValueError(f"Unsupported export kind '{kind}'")
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format '{format}', expected one of {', '.join(EXPORT_FORMATS)}")
+        accepted = EXPORT_SOURCES[kind][1]
+        params = {key: value for key, value in filters.items() if key in accepted and value is not None}
+        # Reject bad dates now rather than in the worker
+        database.date_bounds(params.get('start_date'), params.get('end_date'))
+
+        job_id = database.create_export_job(kind, format, json.dumps(params), created_by)
+        with self._lock:
+            self.pending += 1
+        self._executor.submit(self._run, job_id)
+        return job_status(database.get_export_job(job_id))
+
+    def _run(self, job_id: int):
+        job = database.get_export_job(job_id)
+        source, _ = EXPORT_SOURCES[job['kind']]
+        encoder, _, extension = EXPORT_FORMATS[job['format']]
+        path = self.export_dir / f"{job['kind']}_{job_id}.{extension}.gz"
+        partial = path.with_name(path.name + '.part')
+        database.update_export_job(job_id, status='running', started_at=_timestamp(datetime.now()))
+
+        written = 0
+        try:
+            columns, rows, total = source(**json.loads(job['params'] or '{}'))
+            database.update_export_job(job_id, total_rows=total)
+
+            def counted(rows):
+                nonlocal written
+                for row in rows:
+                    yield row
+                    written += 1
+                    if written % PROGRESS_EVERY == 0:
+                        database.update_export_job(job_id, rows_written=written)
+
+            self.export_dir.mkdir(parents=True, exist_ok=True)
+            with open(partial, 'wb') as f:
+                for chunk in gzip_chunks(encoder(columns, counted(rows))):
+                    f.write(chunk)
+            partial.replace(path)
+
+            finished = datetime.now()
+            database.update_export_job(
+                job_id, status='completed', rows_written=written, file_path=str(path),
+                file_size=path.stat().st_size, finished_at=_timestamp(finished),
+                expires_at=_timestamp(finished + self.retention)
+            )
+        except Exception as e:
+            partial.unlink(missing_ok=True)
+            finished = datetime.now()
+            database.update_export_job(
+                job_id, status='failed', error=str(e), rows_written=written,
+                finished_at=_timestamp(finished), expires_at=_timestamp(finished + self.retention)
+            )
+            print(f"Export job {job_id} failed: {e}")
+        finally:
+            # Worker threads are pooled; don't keep their connections open between jobs
+            database.close_thread_connection()
+            with self._lock:
+                self.pending -= 1
+
+    def recover(self) -> int:
+        """Fail the jobs a previous process left unfinished (blocking)"""
+        return database.fail_interrupted_export_jobs(_timestamp(datetime.now() + self.retention))
+
+    def collect_garbage(self) -> Dict:
+        """Delete expired jobs with their files, and files no job refers to (blocking)"""
+        removed_jobs = 0
+        removed_files = 0
+        for job in database.get_expired_export_jobs(_timestamp(datetime.now())):
+            if job['file_path']:
+                try:
+                    os.remove(job['file_path'])
+                    removed_files += 1
+                except FileNotFoundError:
+                    pass
+            database.delete_export_job(job['id'])
+            removed_jobs += 1
+
+        # Leftovers of crashed workers or deleted rows, older than the retention
+        if self.export_dir.is_dir():
+            referenced = database.get_export_job_files()
+            cutoff = (datetime.now() - self.retention).timestamp()
+            for path in self.export_dir.iterdir():
+                if path.is_file() and str(path) not in referenced and path.stat().st_mtime < cutoff:
+                    path.unlink(missing_ok=True)
+                    removed_files += 1
+        return {'jobs': removed_jobs, 'files': removed_files}
+
+    def stats(self) -> Dict:
+        """Worker count and jobs queued or running"""
+        with self._lock:
+            return {'workers': self.workers, 'pending': self.pending}
+
+    def shutdown(self):
+        """Stop accepting jobs; running jobs are failed by recover() on next start"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ============== Range Downloads ==============
+
+class RangeNotSatisfiable(ValueError):
+    """A Range header that does not overlap the file"""
+
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single-range 'Range: bytes=...' header into inclusive (start, end)
+    Returns None to send the whole file (no header, an invalid range such as
+    bytes=5-3, or a form we don't serve such as multiple ranges).
+    Raises RangeNotSatisfiable when a valid range starts past the end.
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None  # invalid, so ignored (RFC 7233 section 3.1)
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def iter_file(path: str, start: int = 0, end: int = None) -> Iterator[bytes]:
+    """Read bytes start..end (inclusive) of a file in CHUNK_SIZE pieces"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = None if end is None else end - start + 1
+        while remaining is None or remaining > 0:
+            chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,163 @@
+"""
+Background system-health sampler for WireGuard VPN Admin
+
+A single sampler task measures CPU, memory, disk, network and WireGuard
+state on a fixed interval into an in-memory ring buffer. HTTP handlers
+only read the buffer.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import psutil
+
+import database
+
+# Seconds between two health samples
+HEALTH_INTERVAL = float(os.environ.get("WGVPN_HEALTH_INTERVAL", "15"))
+
+# Samples kept in memory (240 x 15s = 1 hour)
+HEALTH_HISTORY_SIZE = int(os.environ.get("WGVPN_HEALTH_HISTORY_SIZE", "240"))
+
+# Also write every sample to health_samples (pruned by retention)
+HEALTH_PERSIST = os.environ.get("WGVPN_HEALTH_PERSIST", "false").lower() in ("1", "true", "yes")
+
+
+class HealthSampler:
+    """
+    Periodically samples system health and keeps the last samples in a ring buffer
+    `wireguard` returns the traffic collector's latest snapshot, so the
+    sampler never runs wg itself.
+    """
+
+    def __init__(self, wireguard: Optional[Callable[[], Dict]] = None, interval: float = HEALTH_INTERVAL,
+                 history_size: int = HEALTH_HISTORY_SIZE, persist: bool = HEALTH_PERSIST):
+        self.wireguard = wireguard
+        self.interval = interval
+        self.persist = persist
+        self._samples = deque(maxlen=history_size)
+        self._lock = threading.Lock()
+        # Previous counters for CPU usage and network rates: (cpu_times, net_io, monotonic time)
+        self._previous = (psutil.cpu_times(), psutil.net_io_counters(), time.monotonic())
+        self._task: Optional[asyncio.Task] = None
+
+    def sample_once(self) -> Dict:
+        """Measure once and append the sample to the buffer (blocking)"""
+        now = time.monotonic()
+        cpu_times = psutil.cpu_times()
+        net_io = psutil.net_io_counters()
+        mem = psutil.virtual_memory()
+        disk = psutil.disk_usage('/')
+        previous = self._previous
+        self._previous = (cpu_times, net_io, now)
+
+        # Own cpu_times delta instead of psutil.cpu_percent(), whose baseline is process-global
+        cpu_percent = database.cpu_usage_percent(previous[0], cpu_times)
+
+        network = {'bytes_sent': net_io.bytes_sent, 'bytes_recv': net_io.bytes_recv,
+                   'sent_rate': None, 'recv_rate': None}
+        if now > previous[2]:
+            elapsed = now - previous[2]
+            network['sent_rate'] = round(max(net_io.bytes_sent - previous[1].bytes_sent, 0) / elapsed, 1)
+            network['recv_rate'] = round(max(net_io.bytes_recv - previous[1].bytes_recv, 0) / elapsed, 1)
+        try:
+            network['active_connections'] = database.count_active_connections()
+        except Exception:
+            network['active_connections'] = 0
+
+        sample = {
+            'timestamp': datetime.now().isoformat(),
+            'cpu': {'usage_percent': cpu_percent, 'count': psutil.cpu_count()},
+            'memory': {'total': mem.total, 'used': mem.used, 'free': mem.free, 'percent': mem.percent},
+            'disk': {'total': disk.total, 'used': disk.used, 'free': disk.free, 'percent': disk.percent},
+            'network': network,
+            'wireguard': self._wireguard_status()
+        }
+        with self._lock:
+            self._samples.append(sample)
+        if self.persist:
+            database.save_health_sample(json.dumps(sample))
+        return sample
+
+    def _wireguard_status(self) -> Dict:
+        snapshot = self.wireguard() if self.wireguard else None
+        if not snapshot or snapshot.get('timestamp') is None:
+            return {'status': 'inactive', 'interface_count': 0, 'peer_count': 0}
+        peers = snapshot['peers']
+        # A snapshot older than a few collector intervals means wg stopped answering
+        stale = snapshot['age_seconds'] > 3 * snapshot['interval']
+        return {
+            'status': 'inactive' if stale else 'active',
+            'interface_count': len({peer.get('interface') for peer in peers if peer.get('interface')}),
+            'peer_count': len(peers),
+            'total_received': snapshot['total_received'],
+            'total_sent': snapshot['total_sent'],
+            'age_seconds': snapshot['age_seconds']
+        }
+
+    def load_persisted(self) -> int:
+        """Seed the buffer from health_samples after a restart (blocking)"""
+        rows = database.get_health_samples(self._samples.maxlen)
+        with self._lock:
+            for data in rows:
+                self._samples.append(json.loads(data))
+        return len(rows)
+
+    def latest(self) -> Optional[Dict]:
+        """Most recent sample, or None before the first one"""
+        with self._lock:
+            return self._samples[-1] if self._samples else None
+
+    def history(self, limit: int = None) -> List[Dict]:
+        """Buffered samples oldest first, flattened for charts"""
+        with self._lock:
+            samples = list(self._samples)
+        if limit:
+            samples = samples[-limit:]
+        return [
+            {
+                'timestamp': sample['timestamp'],
+                'cpu_percent': sample['cpu']['usage_percent'],
+                'memory_percent': sample['memory']['percent'],
+                'disk_percent': sample['disk']['percent'],
+                'active_connections': sample['network'].get('active_connections'),
+                'recv_rate': sample['network'].get('recv_rate'),
+                'sent_rate': sample['network'].get('sent_rate'),
+                'peer_count': sample['wireguard'].get('peer_count'),
+            }
+            for sample in samples
+        ]
+
+    async def _run(self):
+        if self.persist:
+            try:
+                await asyncio.to_thread(self.load_persisted)
+            except Exception as e:
+                print(f"Loading health history failed: {e}")
+        while True:
+            try:
+                await asyncio.to_thread(self.sample_once)
+            except Exception as e:
+                print(f"Health sampling failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Start the sampler task on the running event loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Cancel the sampler task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -2,14 +2,25 @@
 WireGuard VPN Admin - FastAPI Backend
 """
 
+import os
 import subprocess
-import re
 import json
+import time
 from datetime import datetime, timedelta
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Dict, List, Optional
 import database
+from async_db import get_lane_stats, run_read, run_write
+from collector import TrafficCollector, read_wg_dump
+from health import HealthSampler
+from exports import ExportJobManager, RangeNotSatisfiable, iter_file, job_status, open_log_export, parse_range
+from maintenance import MaintenanceJob
+import metrics
+import reports
+from report_jobs import ReportJobQueue
+from scheduler import ReportScheduler, next_run_after, utc_now
 
 app = FastAPI(title="WireGuard VPN Admin API")
 
@@ -22,6 +33,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Bearer token required by /metrics; unset disables the endpoint
+METRICS_TOKEN = os.environ.get("WGVPN_METRICS_TOKEN")
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Labelled by route template so /api/users/1 and /api/users/2 share a series
+        metrics.observe_request(request.method, metrics.request_route(request.scope),
+                                status, time.perf_counter() - started)
+
+@app.exception_handler(database.InvalidFilter)
+async def invalid_filter_handler(request: Request, exc: database.InvalidFilter):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
 @app.get("/")
 async def root():
     return {"message": "WireGuard VPN Admin API", "status": "running"}
@@ -32,66 +63,19 @@ async def health():
 
 def parse_wg_show() -> List[Dict]:
     """
-    Parse output of 'wg show' to get peer statistics
-    Returns list of dicts with public_key, bytes_received, bytes_sent
+    Read peer statistics from 'wg show all dump'
+    Returns list of dicts with public_key, exact bytes_received/bytes_sent,
+    interface, endpoint, allowed_ips and latest_handshake
     """
     try:
-        result = subprocess.run(
-            ["wg", "show"],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        
-        if result.returncode != 0:
-            # If wg show fails (no WireGuard interface), return mock data for demo
-            return get_mock_traffic_data()
-        
-        output = result.stdout
-        peers = []
-        
-        # Parse peer sections
-        peer_pattern = r'peer: (.+?)(?=\npeer:|\Z)'
-        public_key_pattern = r'  public key: (.+)'
-        transfer_pattern = r'  transfer: ([\d.]+) (KiB|MiB|GiB|B) received, ([\d.]+) (KiB|MiB|GiB|B) sent'
-        
-        import re
-        peer_blocks = re.split(r'peer:', output)
-        
-        for block in peer_blocks[1:]:  # Skip first empty block
-            peer_info = {}
-            
-            # Get public key
-            pk_match = re.search(public_key_pattern, block)
-            if pk_match:
-                peer_info['public_key'] = pk_match.group(1).strip()
-            
-            # Get transfer
-            tr_match = re.search(transfer_pattern, block)
-            if tr_match:
-                recv_val = float(tr_match.group(1))
-                recv_unit = tr_match.group(2)
-                sent_val = float(tr_match.group(3))
-                sent_unit = tr_match.group(4)
-                
-                # Convert to bytes
-                def to_bytes(val, unit):
-                    multiplier = {'B': 1, 'KiB': 1024, 'MiB': 1024**2, 'GiB': 1024**3}
-                    return int(val * multiplier.get(unit, 1))
-                
-                peer_info['bytes_received'] = to_bytes(recv_val, recv_unit)
-                peer_info['bytes_sent'] = to_bytes(sent_val, sent_unit)
-            
-            if 'public_key' in peer_info:
-                peers.append(peer_info)
-        
+        peers = read_wg_dump()
         return peers if peers else get_mock_traffic_data()
-        
     except FileNotFoundError:
         # wg command not found (not running WireGuard)
         return get_mock_traffic_data()
     except Exception as e:
-        print(f"Error parsing wg show: {e}")
+        # If wg show fails (no WireGuard interface), return mock data for demo
+        print(f"Error reading wg show dump: {e}")
         return get_mock_traffic_data()
 
 def get_mock_traffic_data() -> List[Dict]:
@@ -126,55 +110,55 @@ def format_bytes(bytes_val: int) -> str:
         bytes_val /= 1024.0
     return f"{bytes_val:.2f} PB"
 
+# Single background sampler shared by every /api/traffic client
+traffic_collector = TrafficCollector(reader=parse_wg_show)
+
+# System health ring buffer behind /api/reports/health
+health_sampler = HealthSampler(wireguard=traffic_collector.latest)
+
+@app.on_event("startup")
+async def init_database():
+    # Creates missing tables and upgrades existing databases in place
+    database.init_db()
+    export_jobs.recover()
+    report_queue.recover()
+
+# Background export jobs writing gzip files to disk
+export_jobs = ExportJobManager()
+
+# Compliance and template reports generated off the request path
+report_queue = ReportJobQueue(health=health_sampler.latest)
+
+# Runs scheduled_reports; one process at a time holds the scheduler lease
+report_scheduler = ReportScheduler(report_queue)
+
+# Stale connection cleanup, log retention and expired export files
+maintenance_job = MaintenanceJob(export_jobs=export_jobs)
+
+@app.on_event("startup")
+async def start_background_jobs():
+    traffic_collector.start()
+    health_sampler.start()
+    maintenance_job.start()
+    report_scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    await traffic_collector.stop()
+    await health_sampler.stop()
+    await maintenance_job.stop()
+    await report_scheduler.stop()
+    export_jobs.shutdown()
+    report_queue.shutdown()
+
 @app.get("/api/traffic")
 async def get_traffic():
     """
     Get real-time traffic statistics from WireGuard
-    Returns list of peers with their upload/download bytes
+    Returns the latest snapshot taken by the background collector;
+    age_seconds tells how old it is
     """
-    peers = parse_wg_show()
-    
-    # Get users for mapping public_key to username
-    users_result = database.get_users()
-    users_list = users_result.get('users', []) if isinstance(users_result, dict) else users_result
-    user_map = {u.get('public_key', ''): u for u in users_list if u.get('public_key')}
-    
-    result = []
-    for peer in peers:
-        # Find user by public key
-        user = user_map.get(peer.get('public_key'))
-        
-        traffic_entry = {
-            'public_key': peer.get('public_key', 'unknown'),
-            'bytes_received': peer.get('bytes_received', 0),
-            'bytes_sent': peer.get('bytes_sent', 0),
-            'formatted_received': format_bytes(peer.get('bytes_received', 0)),
-            'formatted_sent': format_bytes(peer.get('bytes_sent', 0)),
-        }
-        
-        if user:
-            traffic_entry['user_id'] = user['id']
-            traffic_entry['username'] = user['username']
-            
-            # Log traffic snapshot to database
-            try:
-                database.log_traffic(
-                    user_id=user['id'],
-                    peer_public_key=peer.get('public_key', ''),
-                    bytes_received=peer.get('bytes_received', 0),
-                    bytes_sent=peer.get('bytes_sent', 0)
-                )
-            except Exception as e:
-                print(f"Failed to log traffic: {e}")
-        
-        result.append(traffic_entry)
-    
-    return {
-        'timestamp': datetime.now().isoformat(),
-        'peers': result,
-        'total_received': sum(p.get('bytes_received', 0) for p in peers),
-        'total_sent': sum(p.get('bytes_sent', 0) for p in peers)
-    }
+    return traffic_collector.latest()
 
 @app.get("/api/traffic/history")
 async def get_traffic_history(
@@ -186,7 +170,8 @@ async def get_traffic_history(
     """
     Get historical traffic logs with optional date range filtering
     """
-    logs = database.get_traffic_history(
+    logs = await run_read(
+        database.get_traffic_history,
         user_id=user_id,
         start_date=start_date,
         end_date=end_date,
@@ -207,7 +192,7 @@ async def get_daily_traffic(days: int = 30, user_id: int = None):
     """
     Get daily traffic summaries
     """
-    summary = database.get_daily_traffic_summary(user_id=user_id, days=days)
+    summary = await run_read(database.get_daily_traffic_summary, user_id=user_id, days=days)
     return {
         'daily': summary,
         'count': len(summary),
@@ -219,13 +204,36 @@ async def get_hourly_traffic(hours: int = 24, user_id: int = None):
     """
     Get hourly traffic summaries
     """
-    summary = database.get_hourly_traffic_summary(user_id=user_id, hours=hours)
+    summary = await run_read(database.get_hourly_traffic_summary, user_id=user_id, hours=hours)
     return {
         'hourly': summary,
         'count': len(summary),
         'hours': hours
     }
 
+@app.get("/api/traffic/series")
+async def get_traffic_series(
+    start: str,
+    end: str = None,
+    bucket_seconds: int = 3600,
+    user_id: int = None
+):
+    """
+    Get traffic totals per time bucket
+    - start / end: UTC 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' (end exclusive, defaults to now)
+    - bucket_seconds: bucket size; served from the coarsest rollup tier that fits
+    """
+    try:
+        return await run_read(
+            database.get_traffic_series,
+            start=start,
+            end=end,
+            bucket_seconds=bucket_seconds,
+            user_id=user_id
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # ============== Alert Endpoints ==============
 
 @app.get("/api/alerts")
@@ -238,7 +246,8 @@ async def get_alerts(
     """
     Get alerts with optional filtering
     """
-    alerts = database.get_alerts(
+    alerts = await run_read(
+        database.get_alerts,
         user_id=user_id,
         severity=severity,
         is_resolved=is_resolved,
@@ -254,7 +263,7 @@ async def resolve_alert(alert_id: int):
     """
     Mark an alert as resolved
     """
-    database.resolve_alert(alert_id)
+    await run_write(database.resolve_alert, alert_id)
     return {'status': 'resolved', 'alert_id': alert_id}
 
 @app.get("/api/alerts/unresolved")
@@ -262,7 +271,7 @@ async def get_unresolved_alerts():
     """
     Get all unresolved alerts
     """
-    alerts = database.get_unresolved_alerts()
+    alerts = await run_read(database.get_unresolved_alerts)
     return {
         'alerts': alerts,
         'count': len(alerts)
@@ -273,7 +282,7 @@ async def check_anomalies():
     """
     Trigger anomaly detection check
     """
-    new_alerts = database.check_traffic_anomalies()
+    new_alerts = await run_write(database.check_traffic_anomalies)
     return {
         'checked': True,
         'new_alerts': len(new_alerts),
@@ -289,7 +298,9 @@ async def get_connection_logs(
     end_date: str = None,
     connection_status: str = None,
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    after: str = None,
+    include_total: bool = True
 ):
     """
     Get connection logs with optional filtering
@@ -299,14 +310,19 @@ async def get_connection_logs(
     - connection_status: 'connected' or 'disconnected'
     - limit: Number of records to return
     - offset: Offset for pagination
+    - after: next_cursor from the previous page (keyset paging, replaces offset)
+    - include_total: set false to skip the COUNT(*) on deep pages
     """
-    result = database.get_connection_logs(
+    result = await run_read(
+        database.get_connection_logs,
         user_id=user_id,
         start_date=start_date,
         end_date=end_date,
         connection_status=connection_status,
         limit=limit,
-        offset=offset
+        offset=offset,
+        after=after,
+        include_total=include_total
     )
     return result
 
@@ -315,7 +331,7 @@ async def get_active_connections():
     """
     Get all currently active connections
     """
-    connections = database.get_active_connections()
+    connections = await run_read(database.get_active_connections)
     return {
         'connections': connections,
         'count': len(connections)
@@ -326,7 +342,7 @@ async def create_connection_log(user_id: int, peer_ip: str = None):
     """
     Log a new connection event
     """
-    connection_id = database.log_connection(user_id=user_id, peer_ip=peer_ip)
+    connection_id = await run_write(database.log_connection, user_id=user_id, peer_ip=peer_ip)
     return {
         'status': 'connected',
         'connection_id': connection_id
@@ -337,7 +353,7 @@ async def disconnect_connection(connection_id: int, bytes_received: int = 0, byt
     """
     Update connection with disconnect time and final bytes
     """
-    database.update_connection_disconnect(connection_id, bytes_received, bytes_sent)
+    await run_write(database.update_connection_disconnect, connection_id, bytes_received, bytes_sent)
     return {
         'status': 'disconnected',
         'connection_id': connection_id
@@ -353,10 +369,13 @@ async def search_logs(
     start_date: str = None,
     end_date: str = None,
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    after: str = None,
+    include_total: bool = True,
+    sort: str = 'time'
 ):
     """
-    Full-text search across all log types
+    Full-text search across all log types (FTS5 index, prefix matching)
     - keyword: Search keyword
     - log_type: Filter by log type ('connection', 'traffic', 'alert', 'audit')
     - user_id: Filter by user ID
@@ -364,15 +383,22 @@ async def search_logs(
     - end_date: Filter by end date (YYYY-MM-DD)
     - limit: Number of records to return
     - offset: Offset for pagination
+    - after: next_cursor from the previous page (keyset paging, replaces offset)
+    - include_total: set false to skip counting every match
+    - sort: 'time' (newest first) or 'relevance' (best keyword matches first)
     """
-    result = database.search_logs(
+    result = await run_read(
+        database.search_logs,
         keyword=keyword,
         log_type=log_type,
         user_id=user_id,
         start_date=start_date,
         end_date=end_date,
         limit=limit,
-        offset=offset
+        offset=offset,
+        after=after,
+        include_total=include_total,
+        sort=sort
     )
     return result
 
@@ -384,7 +410,10 @@ async def export_logs(
     user_id: int = None,
     start_date: str = None,
     end_date: str = None,
-    format: str = 'csv'
+    format: str = 'csv',
+    keyword: str = None,
+    stream: bool = False,
+    compress: bool = False
 ):
     """
     Export logs as CSV or JSON
@@ -392,9 +421,35 @@ async def export_logs(
     - user_id: Filter by user ID
     - start_date: Filter by start date (YYYY-MM-DD)
     - end_date: Filter by end date (YYYY-MM-DD)
-    - format: 'csv' or 'json'
+    - format: 'csv' or 'json' ('ndjson' too when streaming)
+    - keyword: Search keyword (streaming only)
+    - stream: send the file itself, written incrementally with no row cap
+    - compress: gzip the streamed file on the fly
     """
-    logs = database.get_logs_for_export(
+    if stream:
+        try:
+            chunks, media_type, filename = await run_read(
+                open_log_export,
+                format=format,
+                compress=compress,
+                keyword=keyword,
+                log_type=log_type,
+                user_id=user_id,
+                start_date=start_date,
+                end_date=end_date
+            )
+        except database.InvalidFilter:
+            raise
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return StreamingResponse(
+            chunks,
+            media_type=media_type,
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+        )
+
+    logs = await run_read(
+        database.get_logs_for_export,
         log_type=log_type,
         user_id=user_id,
         start_date=start_date,
@@ -463,7 +518,7 @@ async def log_stream(websocket: WebSocket):
             await asyncio.sleep(5)  # Send log every 5 seconds
             
             # Generate mock log entry for demo
-            users = database.get_users()
+            users = await run_read(database.get_users)
             log_types = ['connection', 'traffic', 'alert', 'audit']
             
             if users:
@@ -607,14 +662,24 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     return payload
 
+# Usernames allowed on admin-only endpoints (there are no roles in the users table)
+ADMIN_USERS = {name.strip() for name in os.environ.get("WGVPN_ADMIN_USERS", "admin").split(",") if name.strip()}
+
+async def require_admin(current_user: dict = Depends(get_current_user)):
+    """Allow only the administrator accounts listed in WGVPN_ADMIN_USERS"""
+    if current_user.get('username') not in ADMIN_USERS:
+        raise HTTPException(status_code=403, detail="Administrator access required")
+    return current_user
+
 @app.post("/api/auth/login")
 async def login(request: LoginRequest, ip_address: str = None, user_agent: str = None):
     """Admin login endpoint"""
-    user = database.get_user_by_username(request.username)
+    user = await run_read(database.get_user_by_username, request.username)
     
     # Log the login attempt
     if user:
-        database.log_login_attempt(
+        await run_write(
+            database.log_login_attempt,
             user_id=user['id'],
             username=request.username,
             ip_address=ip_address or 'unknown',
@@ -624,7 +689,8 @@ async def login(request: LoginRequest, ip_address: str = None, user_agent: str =
         )
     
     if not user:
-        database.log_login_attempt(
+        await run_write(
+            database.log_login_attempt,
             user_id=None,
             username=request.username,
             ip_address=ip_address or 'unknown',
@@ -635,7 +701,8 @@ async def login(request: LoginRequest, ip_address: str = None, user_agent: str =
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
     if not verify_password(request.password, user['password_hash']):
-        database.log_login_attempt(
+        await run_write(
+            database.log_login_attempt,
             user_id=user['id'],
             username=request.username,
             ip_address=ip_address or 'unknown',
@@ -646,7 +713,8 @@ async def login(request: LoginRequest, ip_address: str = None, user_agent: str =
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
     if not user['is_active']:
-        database.log_login_attempt(
+        await run_write(
+            database.log_login_attempt,
             user_id=user['id'],
             username=request.username,
             ip_address=ip_address or 'unknown',
@@ -657,7 +725,8 @@ async def login(request: LoginRequest, ip_address: str = None, user_agent: str =
         raise HTTPException(status_code=403, detail="Account is disabled")
     
     # Successful login - log it
-    database.log_login_attempt(
+    await run_write(
+        database.log_login_attempt,
         user_id=user['id'],
         username=request.username,
         ip_address=ip_address or 'unknown',
@@ -666,7 +735,8 @@ async def login(request: LoginRequest, ip_address: str = None, user_agent: str =
     )
     
     # Create audit log for login
-    database.create_audit_log(
+    await run_write(
+        database.create_audit_log,
         user_id=user['id'],
         action='LOGIN',
         details=f'User logged in',
@@ -692,7 +762,7 @@ async def logout(current_user: dict = Depends(get_current_user)):
 @app.get("/api/auth/me")
 async def get_me(current_user: dict = Depends(get_current_user)):
     """Get current user info"""
-    user = database.get_user_by_id(current_user['user_id'])
+    user = await run_read(database.get_user_by_id, current_user['user_id'])
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return {
@@ -768,13 +838,13 @@ async def get_users(
     current_user: dict = Depends(get_current_user)
 ):
     """Get all users with pagination"""
-    result = database.get_users(page=page, per_page=per_page, search=search, is_active=is_active)
+    result = await run_read(database.get_users, page=page, per_page=per_page, search=search, is_active=is_active)
     return result
 
 @app.get("/api/users/{user_id}")
 async def get_user(user_id: int, current_user: dict = Depends(get_current_user)):
     """Get a specific user"""
-    user = database.get_user_by_id(user_id)
+    user = await run_read(database.get_user_by_id, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     # Don't expose private key
@@ -790,7 +860,8 @@ async def create_user(request: UserCreateRequest, current_user: dict = Depends(g
         # Generate WireGuard keys
         private_key, public_key = generate_wireguard_keys()
         
-        user = database.create_user(
+        user = await run_write(
+            database.create_user,
             username=request.username,
             email=request.email,
             password_hash=password_hash,
@@ -808,11 +879,12 @@ async def create_user(request: UserCreateRequest, current_user: dict = Depends(g
 @app.put("/api/users/{user_id}")
 async def update_user(user_id: int, request: UserUpdateRequest, current_user: dict = Depends(get_current_user)):
     """Update user details"""
-    user = database.get_user_by_id(user_id)
+    user = await run_read(database.get_user_by_id, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user = database.update_user(
+    user = await run_write(
+        database.update_user,
         user_id=user_id,
         username=request.username,
         email=request.email,
@@ -825,7 +897,7 @@ async def update_user(user_id: int, request: UserUpdateRequest, current_user: di
 @app.delete("/api/users/{user_id}")
 async def delete_user(user_id: int, current_user: dict = Depends(get_current_user)):
     """Delete a user"""
-    user = database.get_user_by_id(user_id)
+    user = await run_read(database.get_user_by_id, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -833,7 +905,7 @@ async def delete_user(user_id: int, current_user: dict = Depends(get_current_use
     if user_id == current_user['user_id']:
         raise HTTPException(status_code=400, detail="Cannot delete your own account")
     
-    database.delete_user(user_id)
+    await run_write(database.delete_user, user_id)
     return {'status': 'deleted', 'user_id': user_id}
 
 # ============== VPN Config Generation ==============
@@ -841,7 +913,7 @@ async def delete_user(user_id: int, current_user: dict = Depends(get_current_use
 @app.post("/api/users/{user_id}/generate-config")
 async def generate_config(user_id: int, current_user: dict = Depends(get_current_user)):
     """Generate WireGuard configuration for a user"""
-    user = database.get_user_by_id(user_id)
+    user = await run_read(database.get_user_by_id, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -849,7 +921,7 @@ async def generate_config(user_id: int, current_user: dict = Depends(get_current
     private_key, public_key = generate_wireguard_keys()
     
     # Update user with new keys
-    user = database.update_user_keys(user_id, public_key, private_key)
+    user = await run_write(database.update_user_keys, user_id, public_key, private_key)
     
     # Generate config content
     config = generate_wireguard_config(
@@ -860,7 +932,8 @@ async def generate_config(user_id: int, current_user: dict = Depends(get_current
     )
     
     # Audit log for config generation
-    database.create_audit_log(
+    await run_write(
+        database.create_audit_log,
         user_id=current_user['user_id'],
         action='GENERATE_CONFIG',
         details=f'Generated new WireGuard config for user {user["username"]} (ID: {user_id})',
@@ -876,7 +949,7 @@ async def generate_config(user_id: int, current_user: dict = Depends(get_current
 @app.get("/api/users/{user_id}/config")
 async def get_config(user_id: int, current_user: dict = Depends(get_current_user)):
     """Get WireGuard configuration for a user"""
-    user = database.get_user_by_id(user_id)
+    user = await run_read(database.get_user_by_id, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -906,7 +979,7 @@ async def get_qr_code(user_id: int, current_user: dict = Depends(get_current_use
     import io
     import base64
     
-    user = database.get_user_by_id(user_id)
+    user = await run_read(database.get_user_by_id, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -943,7 +1016,7 @@ async def get_qr_code(user_id: int, current_user: dict = Depends(get_current_use
 @app.post("/api/users/{user_id}/toggle-active")
 async def toggle_user_active(user_id: int, current_user: dict = Depends(get_current_user)):
     """Toggle user active status"""
-    user = database.get_user_by_id(user_id)
+    user = await run_read(database.get_user_by_id, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -951,7 +1024,7 @@ async def toggle_user_active(user_id: int, current_user: dict = Depends(get_curr
     if user_id == current_user['user_id']:
         raise HTTPException(status_code=400, detail="Cannot toggle your own account status")
     
-    user = database.toggle_user_active(user_id)
+    user = await run_write(database.toggle_user_active, user_id)
     
     # In a real deployment, you would also add/remove peer from WireGuard
     # For now, we just update the database
@@ -971,7 +1044,7 @@ async def change_password(user_id: int, request: ChangePasswordRequest, current_
     if user_id != current_user['user_id']:
         raise HTTPException(status_code=403, detail="Cannot change other user's password")
     
-    user = database.get_user_by_id(user_id)
+    user = await run_read(database.get_user_by_id, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -981,7 +1054,7 @@ async def change_password(user_id: int, request: ChangePasswordRequest, current_
     
     # Update password
     new_hash = hash_password(request.new_password)
-    database.update_password(user_id, new_hash)
+    await run_write(database.update_password, user_id, new_hash)
     
     return {'status': 'password_changed'}
 
@@ -998,25 +1071,30 @@ async def get_audit_operations(
     end_date: str = None,
     limit: int = 100,
     offset: int = 0,
+    after: str = None,
+    include_total: bool = True,
     current_user: dict = Depends(get_current_user)
 ):
     """
     Get admin operation logs with filtering
     """
-    result = database.get_audit_logs(
+    result = await run_read(
+        database.get_audit_logs,
         user_id=user_id,
         action=action,
         start_date=start_date,
         end_date=end_date,
         limit=limit,
-        offset=offset
+        offset=offset,
+        after=after,
+        include_total=include_total
     )
     return result
 
 @app.get("/api/audit/operations/actions")
 async def get_audit_actions(current_user: dict = Depends(get_current_user)):
     """Get list of distinct audit action types"""
-    actions = database.get_distinct_audit_actions()
+    actions = await run_read(database.get_distinct_audit_actions)
     return {'actions': actions}
 
 @app.get("/api/audit/login-history")
@@ -1027,18 +1105,23 @@ async def get_login_history(
     end_date: str = None,
     limit: int = 100,
     offset: int = 0,
+    after: str = None,
+    include_total: bool = True,
     current_user: dict = Depends(get_current_user)
 ):
     """
     Get login history with filtering
     """
-    result = database.get_login_history(
+    result = await run_read(
+        database.get_login_history,
         user_id=user_id,
         success=success,
         start_date=start_date,
         end_date=end_date,
         limit=limit,
-        offset=offset
+        offset=offset,
+        after=after,
+        include_total=include_total
     )
     return result
 
@@ -1050,25 +1133,30 @@ async def get_system_events(
     end_date: str = None,
     limit: int = 100,
     offset: int = 0,
+    after: str = None,
+    include_total: bool = True,
     current_user: dict = Depends(get_current_user)
 ):
     """
     Get system events with filtering
     """
-    result = database.get_system_events(
+    result = await run_read(
+        database.get_system_events,
         event_type=event_type,
         severity=severity,
         start_date=start_date,
         end_date=end_date,
         limit=limit,
-        offset=offset
+        offset=offset,
+        after=after,
+        include_total=include_total
     )
     return result
 
 @app.get("/api/audit/system-events/types")
 async def get_system_event_types(current_user: dict = Depends(get_current_user)):
     """Get list of distinct system event types"""
-    event_types = database.get_distinct_event_types()
+    event_types = await run_read(database.get_distinct_event_types)
     return {'event_types': event_types}
 
 # ============== Compliance Reports Endpoints ==============
@@ -1084,48 +1172,59 @@ async def generate_compliance_report(
     current_user: dict = Depends(get_current_user)
 ):
     """
-    Generate a compliance report
+    Queue a compliance report
+    Returns at once; poll GET /api/audit/reports/{report_id} for status and
+    progress, then download it.
     """
     # Validate report type
     valid_types = ['daily', 'weekly', 'monthly', 'custom']
     if request.report_type not in valid_types:
         raise HTTPException(status_code=400, detail=f"Invalid report type. Must be one of: {', '.join(valid_types)}")
+    database.date_bounds(request.start_date, request.end_date)
     
     # Create report record
-    report_id = database.create_compliance_report(
+    report_id = await run_write(
+        database.create_compliance_report,
         report_type=request.report_type,
         title=f"Compliance Report - {request.report_type.title()} ({request.start_date} to {request.end_date})",
         start_date=request.start_date,
         end_date=request.end_date,
         created_by=current_user['user_id']
     )
-    
-    # Generate report data
-    report_data = database.generate_compliance_report_data(
-        report_type=request.report_type,
-        start_date=request.start_date,
-        end_date=request.end_date
-    )
-    
-    # Update report status
-    import json
-    database.update_compliance_report(report_id, status='completed')
-    
-    # Log system event
-    database.log_system_event(
-        event_type='report_generated',
-        severity='info',
-        message=f"Compliance report generated: {request.report_type}",
-        details=f"Report ID: {report_id}, Period: {request.start_date} to {request.end_date}",
-        source='api'
-    )
+    report_queue.submit_compliance(report_id)
     
     return {
         'report_id': report_id,
-        'status': 'completed',
-        'data': report_data
+        'status': 'pending',
+        'progress': 0
     }
 
+@app.post("/api/audit/reports/{report_id}/cancel")
+async def cancel_compliance_report(
+    report_id: int,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Cancel a pending or running compliance report
+    """
+    if not await run_write(database.cancel_report_job, 'compliance_reports', report_id):
+        raise HTTPException(status_code=409, detail="Report is not pending or running")
+    return {'report_id': report_id, 'status': 'cancelled'}
+
+@app.post("/api/audit/reports/{report_id}/regenerate")
+async def regenerate_compliance_report(
+    report_id: int,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Queue a rebuild of a finished report (e.g. one whose file is missing)
+    The report is generated again from the current data for its period.
+    """
+    if not await run_write(database.requeue_report_job, 'compliance_reports', report_id):
+        raise HTTPException(status_code=409, detail="Report is not finished or does not exist")
+    report_queue.submit_compliance(report_id)
+    return {'report_id': report_id, 'status': 'pending'}
+
 @app.get("/api/audit/reports")
 async def get_compliance_reports(
     report_type: str = None,
@@ -1137,7 +1236,8 @@ async def get_compliance_reports(
     """
     Get list of generated compliance reports
     """
-    result = database.get_compliance_reports(
+    result = await run_read(
+        database.get_compliance_reports,
         report_type=report_type,
         status=status,
         limit=limit,
@@ -1153,7 +1253,7 @@ async def get_compliance_report(
     """
     Get a specific compliance report
     """
-    report = database.get_compliance_report_by_id(report_id)
+    report = await run_read(database.get_compliance_report_by_id, report_id)
     if not report:
         raise HTTPException(status_code=404, detail="Report not found")
     return report
@@ -1161,76 +1261,54 @@ async def get_compliance_report(
 @app.get("/api/audit/reports/{report_id}/download")
 async def download_compliance_report(
     report_id: int,
+    request: Request,
     format: str = 'json',
     current_user: dict = Depends(get_current_user)
 ):
     """
     Download a compliance report in specified format
+    Streams the file saved at generation time; gzip-capable clients get it
+    as stored (Content-Encoding: gzip). If-None-Match with the ETag gives 304.
     """
-    report = database.get_compliance_report_by_id(report_id)
+    if format not in reports.REPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format. Must be one of: {', '.join(reports.REPORT_FORMATS)}")
+
+    report = await run_read(database.get_compliance_report_by_id, report_id)
     if not report:
         raise HTTPException(status_code=404, detail="Report not found")
     
     if report['status'] != 'completed':
         raise HTTPException(status_code=400, detail="Report is not ready for download")
     
-    # Regenerate data for download
-    report_data = database.generate_compliance_report_data(
-        report_type=report['report_type'],
-        start_date=report['start_date'],
-        end_date=report['end_date']
-    )
-    
-    if format == 'json':
-        import json
-        return {
-            'report': report_data,
-            'filename': f"compliance_report_{report_id}.json"
-        }
-    else:
-        # CSV format - flatten the data
-        import csv
-        import io
-        
-        output = io.StringIO()
-        
-        if report_data.get('sections', {}).get('user_activities'):
-            output.write("=== User Activities ===\n")
-            writer = csv.DictWriter(output, fieldnames=report_data['sections']['user_activities'][0].keys() if report_data['sections']['user_activities'] else [])
-            writer.writeheader()
-            writer.writerows(report_data['sections']['user_activities'])
-            output.write("\n")
-        
-        if report_data.get('sections', {}).get('login_attempts'):
-            output.write("=== Login Attempts ===\n")
-            writer = csv.DictWriter(output, fieldnames=report_data['sections']['login_attempts'][0].keys() if report_data['sections']['login_attempts'] else [])
-            writer.writeheader()
-            writer.writerows(report_data['sections']['login_attempts'])
-            output.write("\n")
-        
-        if report_data.get('sections', {}).get('admin_operations'):
-            output.write("=== Admin Operations ===\n")
-            writer = csv.DictWriter(output, fieldnames=report_data['sections']['admin_operations'][0].keys() if report_data['sections']['admin_operations'] else [])
-            writer.writeheader()
-            writer.writerows(report_data['sections']['admin_operations'])
-            output.write("\n")
-        
-        if report_data.get('sections', {}).get('system_events'):
-            output.write("=== System Events ===\n")
-            writer = csv.DictWriter(output, fieldnames=report_data['sections']['system_events'][0].keys() if report_data['sections']['system_events'] else [])
-            writer.writeheader()
-            writer.writerows(report_data['sections']['system_events'])
-            output.write("\n")
-        
-        if report_data.get('sections', {}).get('summary'):
-            output.write("=== Summary ===\n")
-            for key, value in report_data['sections']['summary'].items():
-                output.write(f"{key}: {value}\n")
-        
-        return {
-            'data': output.getvalue(),
-            'filename': f"compliance_report_{report_id}.csv"
-        }
+    path = reports.open_compliance_artifact(report, format)
+    if path is None:
+        # Never rebuilt here: that would block the write lane and change the report's data
+        raise HTTPException(
+            status_code=409,
+            detail=f"Report file is missing; regenerate it with POST /api/audit/reports/{report_id}/regenerate"
+        )
+    gzip_ok = 'gzip' in request.headers.get('accept-encoding', '')
+    etag = reports.file_etag(path)
+    if not gzip_ok:
+        # A different representation needs its own validator
+        etag = etag[:-1] + '-identity"'
+    headers = {
+        'ETag': etag,
+        'Vary': 'Accept-Encoding',
+        'Cache-Control': 'private, no-cache',
+        'Content-Disposition': f'attachment; filename="compliance_report_{report_id}.{format}"'
+    }
+
+    if_none_match = request.headers.get('if-none-match', '')
+    if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+        return Response(status_code=304, headers=headers)
+
+    media_type = reports.REPORT_FORMATS[format]
+    if gzip_ok:
+        headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(path.stat().st_size)
+        return StreamingResponse(iter_file(str(path)), media_type=media_type, headers=headers)
+    return StreamingResponse(reports.iter_gunzip(path), media_type=media_type, headers=headers)
 
 # ============== Automated Reports Endpoints ==============
 
@@ -1250,7 +1328,8 @@ async def get_traffic_report(
     if not end_date:
         end_date = datetime.now().strftime('%Y-%m-%d')
     
-    data = database.generate_traffic_report_data(
+    data = await run_read(
+        database.generate_traffic_report_data,
         start_date=start_date,
         end_date=end_date,
         include_users=True,
@@ -1268,7 +1347,13 @@ async def schedule_traffic_report(
     """
     import json
     
-    report = database.create_scheduled_report(
+    try:
+        next_run = next_run_after(request, utc_now())
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    report = await run_write(
+        database.create_scheduled_report,
         name=request.get('name'),
         report_type='traffic',
         schedule_type=request.get('schedule_type'),
@@ -1279,11 +1364,14 @@ async def schedule_traffic_report(
         include_users=request.get('include_users', True),
         top_users_count=request.get('top_users_count', 10),
         email_recipients=json.dumps(request.get('email_recipients', [])),
-        created_by=current_user['user_id']
+        created_by=current_user['user_id'],
+        next_run_at=next_run.strftime('%Y-%m-%d %H:%M:%S')
     )
+    report_scheduler.refresh()
     
     # Log system event
-    database.log_system_event(
+    await run_write(
+        database.log_system_event,
         event_type='report_scheduled',
         severity='info',
         message=f"Traffic report scheduled: {request.get('name')}",
@@ -1300,7 +1388,7 @@ async def get_scheduled_traffic_reports(
     current_user: dict = Depends(get_current_user)
 ):
     """Get list of scheduled traffic reports"""
-    return database.get_scheduled_reports(report_type='traffic', limit=limit, offset=offset)
+    return await run_read(database.get_scheduled_reports, report_type='traffic', limit=limit, offset=offset)
 
 @app.delete("/api/reports/traffic/schedule/{schedule_id}")
 async def delete_scheduled_report(
@@ -1308,7 +1396,8 @@ async def delete_scheduled_report(
     current_user: dict = Depends(get_current_user)
 ):
     """Delete a scheduled report"""
-    database.delete_scheduled_report(schedule_id)
+    await run_write(database.delete_scheduled_report, schedule_id)
+    report_scheduler.refresh()
     return {'status': 'deleted', 'schedule_id': schedule_id}
 
 @app.get("/api/reports/generated")
@@ -1321,7 +1410,8 @@ async def get_generated_reports(
     current_user: dict = Depends(get_current_user)
 ):
     """Get list of generated reports"""
-    return database.get_generated_reports(
+    return await run_read(
+        database.get_generated_reports,
         template_id=template_id,
         scheduled_report_id=scheduled_report_id,
         report_type=report_type,
@@ -1335,7 +1425,7 @@ async def get_generated_report(
     current_user: dict = Depends(get_current_user)
 ):
     """Get a specific generated report"""
-    report = database.get_generated_report(report_id)
+    report = await run_read(database.get_generated_report, report_id)
     if not report:
         raise HTTPException(status_code=404, detail="Report not found")
     return report
@@ -1351,7 +1441,7 @@ async def get_user_statistics(
     """
     Get user usage statistics
     """
-    return database.get_user_statistics(start_date=start_date, end_date=end_date)
+    return await run_read(database.get_user_statistics, start_date=start_date, end_date=end_date)
 
 @app.get("/api/reports/user-stats/export")
 async def export_user_stats(
@@ -1363,7 +1453,7 @@ async def export_user_stats(
     """
     Export user statistics to CSV or JSON
     """
-    stats = database.get_user_statistics(start_date=start_date, end_date=end_date)
+    stats = await run_read(database.get_user_statistics, start_date=start_date, end_date=end_date)
     
     if format == 'json':
         return {
@@ -1389,16 +1479,132 @@ async def export_user_stats(
             'filename': f"user_statistics_{datetime.now().strftime('%Y%m%d')}.csv"
         }
 
+# --- Export Jobs ---
+
+class LogExportJobRequest(BaseModel):
+    format: str = 'csv'
+    keyword: Optional[str] = None
+    log_type: Optional[str] = None
+    user_id: Optional[int] = None
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+
+class UserStatsExportJobRequest(BaseModel):
+    format: str = 'csv'
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+
+async def submit_export_job(kind: str, request: BaseModel, current_user: dict):
+    try:
+        return await run_write(
+            export_jobs.submit, kind, created_by=current_user['user_id'], **request.model_dump()
+        )
+    except database.InvalidFilter:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/logs/export/jobs")
+async def create_log_export_job(
+    request: LogExportJobRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Export logs in the background to a gzip file (no row cap)
+    Poll GET /api/exports/{job_id} and download from its download_url
+    """
+    return await submit_export_job('logs', request, current_user)
+
+@app.post("/api/reports/user-stats/export/jobs")
+async def create_user_stats_export_job(
+    request: UserStatsExportJobRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Export user statistics in the background to a gzip file
+    """
+    return await submit_export_job('user-stats', request, current_user)
+
+async def get_visible_export_job(job_id: int, current_user: dict) -> dict:
+    """Load an export job for its creator or an administrator; 404 for anyone else"""
+    job = await run_read(database.get_export_job, job_id)
+    if not job or (job['created_by'] != current_user['user_id']
+                   and current_user.get('username') not in ADMIN_USERS):
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return job
+
+@app.get("/api/exports/{job_id}")
+async def get_export_job(
+    job_id: int,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Get the status and progress of an export job
+    """
+    return job_status(await get_visible_export_job(job_id, current_user))
+
+@app.get("/api/exports/{job_id}/download")
+async def download_export_job(
+    job_id: int,
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Download the gzip file of a completed export job
+    Supports 'Range: bytes=start-end' (206 Partial Content) so interrupted
+    downloads can resume; If-Range falls back to the whole file when the
+    file changed.
+    """
+    job = await get_visible_export_job(job_id, current_user)
+    if job['status'] != 'completed' or not job['file_path'] or not os.path.exists(job['file_path']):
+        raise HTTPException(status_code=409, detail="Export is not ready for download")
+
+    size = job['file_size']
+    etag = f'"export-{job_id}-{size}"'
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Content-Disposition': f'attachment; filename="{os.path.basename(job["file_path"])}"'
+    }
+
+    if_range = request.headers.get('if-range')
+    try:
+        byte_range = None if if_range and if_range != etag else parse_range(request.headers.get('range'), size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{size}'})
+
+    if byte_range is None:
+        headers['Content-Length'] = str(size)
+        return StreamingResponse(iter_file(job['file_path']), media_type='application/gzip', headers=headers)
+
+    start, end = byte_range
+    headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    headers['Content-Length'] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file(job['file_path'], start, end),
+        status_code=206,
+        media_type='application/gzip',
+        headers=headers
+    )
+
 # --- System Health ---
 
+def latest_health_sample():
+    sample = health_sampler.latest()
+    if sample is None:
+        # Only before the sampler's first run
+        raise HTTPException(status_code=503, detail="No health sample yet",
+                            headers={'Retry-After': '1'})
+    return sample
+
 @app.get("/api/reports/health")
 async def get_system_health(
     current_user: dict = Depends(get_current_user)
 ):
     """
-    Get system health report
+    Get system health report (latest background sample)
     """
-    return database.get_system_health()
+    return latest_health_sample()
 
 @app.get("/api/reports/health/alerts")
 async def get_health_alerts(
@@ -1407,7 +1613,21 @@ async def get_health_alerts(
     """
     Get health alerts
     """
-    return database.get_health_alerts()
+    return database.health_alerts(latest_health_sample())
+
+@app.get("/api/reports/health/history")
+async def get_health_history(
+    limit: int = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Get buffered health samples (oldest first) for charts
+    - limit: only the most recent samples
+    """
+    return {
+        'interval': health_sampler.interval,
+        'samples': health_sampler.history(limit)
+    }
 
 # --- Report Templates ---
 
@@ -1418,7 +1638,7 @@ async def get_report_templates(
     current_user: dict = Depends(get_current_user)
 ):
     """Get list of report templates"""
-    return database.get_report_templates(limit=limit, offset=offset)
+    return await run_read(database.get_report_templates, limit=limit, offset=offset)
 
 @app.get("/api/reports/templates/{template_id}")
 async def get_report_template(
@@ -1426,7 +1646,7 @@ async def get_report_template(
     current_user: dict = Depends(get_current_user)
 ):
     """Get a specific report template"""
-    template = database.get_report_template(template_id)
+    template = await run_read(database.get_report_template, template_id)
     if not template:
         raise HTTPException(status_code=404, detail="Template not found")
     return template
@@ -1447,7 +1667,8 @@ async def create_report_template(
     current_user: dict = Depends(get_current_user)
 ):
     """Create a new report template"""
-    template = database.create_report_template(
+    template = await run_write(
+        database.create_report_template,
         name=request.name,
         description=request.description,
         data_sources=request.data_sources,
@@ -1460,7 +1681,8 @@ async def create_report_template(
     )
     
     # Log system event
-    database.log_system_event(
+    await run_write(
+        database.log_system_event,
         event_type='template_created',
         severity='info',
         message=f"Report template created: {request.name}",
@@ -1476,11 +1698,12 @@ async def update_report_template(
     current_user: dict = Depends(get_current_user)
 ):
     """Update a report template"""
-    template = database.get_report_template(template_id)
+    template = await run_read(database.get_report_template, template_id)
     if not template:
         raise HTTPException(status_code=404, detail="Template not found")
     
-    return database.update_report_template(
+    return await run_write(
+        database.update_report_template,
         template_id,
         name=request.name,
         description=request.description,
@@ -1498,11 +1721,11 @@ async def delete_report_template(
     current_user: dict = Depends(get_current_user)
 ):
     """Delete a report template"""
-    template = database.get_report_template(template_id)
+    template = await run_read(database.get_report_template, template_id)
     if not template:
         raise HTTPException(status_code=404, detail="Template not found")
     
-    database.delete_report_template(template_id)
+    await run_write(database.delete_report_template, template_id)
     return {'status': 'deleted', 'template_id': template_id}
 
 class GenerateFromTemplateRequest(BaseModel):
@@ -1515,60 +1738,111 @@ async def generate_from_template(
     request: GenerateFromTemplateRequest,
     current_user: dict = Depends(get_current_user)
 ):
-    """Generate a report from a template"""
-    import json
-    
-    template = database.get_report_template(template_id)
+    """
+    Queue a report from a template
+    Returns the pending report at once; poll GET /api/reports/generated/{id}
+    until its status is 'completed'.
+    """
+    template = await run_read(database.get_report_template, template_id)
     if not template:
         raise HTTPException(status_code=404, detail="Template not found")
+    database.date_bounds(request.start_date, request.end_date)
     
-    # Parse data sources
-    data_sources = json.loads(template['data_sources'])
-    
-    report_data = {
-        'template_name': template['name'],
-        'period': {'start_date': request.start_date, 'end_date': request.end_date},
-        'generated_at': datetime.now().isoformat(),
-        'sections': {}
-    }
-    
-    # Generate data based on data sources
-    if 'traffic' in data_sources:
-        report_data['sections']['traffic'] = database.generate_traffic_report_data(
-            start_date=request.start_date,
-            end_date=request.end_date
-        )
-    
-    if 'users' in data_sources:
-        report_data['sections']['users'] = database.get_user_statistics(
-            start_date=request.start_date,
-            end_date=request.end_date
-        )
-    
-    if 'system' in data_sources:
-        report_data['sections']['system'] = database.get_system_health()
-        report_data['sections']['system_alerts'] = database.get_health_alerts()
-    
-    if 'audit' in data_sources:
-        report_data['sections']['audit'] = database.generate_compliance_report_data(
-            report_type='custom',
-            start_date=request.start_date,
-            end_date=request.end_date
-        )
-    
-    # Save generated report
-    generated = database.create_generated_report(
+    generated = await run_write(
+        database.create_generated_report,
         name=f"{template['name']} - {datetime.now().strftime('%Y-%m-%d')}",
         report_type=template['name'],
         start_date=request.start_date,
         end_date=request.end_date,
-        data=json.dumps(report_data),
         format=template['format'],
         template_id=template_id,
-        generated_by=current_user['user_id']
+        generated_by=current_user['user_id'],
+        status='pending'
     )
+    report_queue.submit_template(generated['id'])
     
     return {
-        'report': generated,
-        'data': report_data
+        'report': generated
+    }
+
+@app.post("/api/reports/generated/{report_id}/cancel")
+async def cancel_generated_report(
+    report_id: int,
+    current_user: dict = Depends(get_current_user)
+):
+    """Cancel a pending or running template report"""
+    if not await run_write(database.cancel_report_job, 'generated_reports', report_id):
+        raise HTTPException(status_code=409, detail="Report is not pending or running")
+    return {'report_id': report_id, 'status': 'cancelled'}
+
+# ============== Prometheus Metrics ==============
+
+@app.get("/metrics")
+async def prometheus_metrics(request: Request):
+    """
+    Prometheus text exposition
+    Built from in-memory state only (collector snapshot, request registry,
+    pool and queue counters), so a scrape never queries SQLite.
+    """
+    # Peer keys, usernames and internal state are not served to anonymous callers
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Metrics are disabled; set WGVPN_METRICS_TOKEN")
+    if request.headers.get('authorization') != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+    pool = database.get_pool_stats()
+    lanes = get_lane_stats()
+    queues = {'export': export_jobs.stats(), 'report': report_queue.stats()}
+    sample = health_sampler.latest()
+
+    body = metrics.render(
+        metrics.peer_metrics(traffic_collector.latest(), time.time()),
+        metrics.gauge('wgvpn_db_connections_open', 'Open SQLite connections', [({}, pool['open'])]),
+        metrics.gauge('wgvpn_db_connections_opened_total', 'SQLite connections opened',
+                      [({}, pool['opened'])], kind='counter'),
+        metrics.gauge('wgvpn_db_connection_checkouts_total', 'db_connection() blocks entered',
+                      [({}, pool['checkouts'])], kind='counter'),
+        metrics.gauge('wgvpn_db_lane_workers', 'Worker threads per database lane',
+                      [({'lane': name}, lane['workers']) for name, lane in lanes.items()]),
+        metrics.gauge('wgvpn_db_lane_pending', 'Database calls queued or running per lane',
+                      [({'lane': name}, lane['pending']) for name, lane in lanes.items()]),
+        metrics.gauge('wgvpn_db_lane_completed_total', 'Database calls completed per lane',
+                      [({'lane': name}, lane['completed']) for name, lane in lanes.items()], kind='counter'),
+        metrics.gauge('wgvpn_queue_workers', 'Worker threads per background queue',
+                      [({'queue': name}, queue['workers']) for name, queue in queues.items()]),
+        metrics.gauge('wgvpn_queue_pending', 'Jobs queued or running per background queue',
+                      [({'queue': name}, queue['pending']) for name, queue in queues.items()]),
+        metrics.gauge('wgvpn_websocket_clients', 'Connected log stream WebSocket clients',
+                      [({}, len(active_websockets))]),
+        metrics.gauge('wgvpn_system_cpu_percent', 'CPU usage from the latest health sample',
+                      [({}, sample['cpu']['usage_percent'] if sample else None)]),
+        metrics.gauge('wgvpn_system_memory_percent', 'Memory usage from the latest health sample',
+                      [({}, sample['memory']['percent'] if sample else None)]),
+        metrics.gauge('wgvpn_system_disk_percent', 'Disk usage from the latest health sample',
+                      [({}, sample['disk']['percent'] if sample else None)]),
+    )
+    return Response(content=body, media_type=metrics.CONTENT_TYPE)
+
+# ============== Diagnostics ==============
+
+@app.get("/api/diagnostics")
+async def get_diagnostics(limit: int = 50, current_user: dict = Depends(require_admin)):
+    """
+    Where time goes: per-route latency, per-statement SQLite totals and the
+    slow query log with parameter shapes and query plans (admin only)
+    """
+    limit = max(1, min(limit, 500))
+    return {
+        'routes': metrics.route_latency_summary()[:limit],
+        'statements': database.get_statement_stats(limit),
+        'slow_queries': database.get_slow_queries(),
+        'slow_query_ms': database.SLOW_QUERY_MS,
+        'pool': database.get_pool_stats(),
+        'lanes': get_lane_stats()
     }
+
+@app.post("/api/diagnostics/reset")
+async def reset_diagnostics(current_user: dict = Depends(require_admin)):
+    """Clear the statement totals and the slow query log (admin only)"""
+    database.reset_statement_timing()
+    return {'status': 'reset'}
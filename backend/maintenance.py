@@ -0,0 +1,70 @@
+"""
+Background maintenance jobs for WireGuard VPN Admin
+
+Closes stale connections, enforces log retention and removes expired
+export files on a fixed interval.
+"""
+
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import Dict, Optional
+
+import database
+
+# Seconds between two maintenance runs
+MAINTENANCE_INTERVAL = float(os.environ.get("WGVPN_MAINTENANCE_INTERVAL", "3600"))
+
+
+class MaintenanceJob:
+    """Runs database housekeeping periodically off the event loop"""
+
+    def __init__(self, interval: float = MAINTENANCE_INTERVAL, export_jobs=None):
+        self.interval = interval
+        # ExportJobManager whose expired files are garbage-collected
+        self.export_jobs = export_jobs
+        self.last_report: Optional[Dict] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def run_once(self) -> Dict:
+        """Run every maintenance step once (blocking)"""
+        database.close_stale_connections()
+        report = database.run_retention()
+        if self.export_jobs is not None:
+            report['exports_removed'] = self.export_jobs.collect_garbage()
+        report['finished_at'] = datetime.now().isoformat()
+        self.last_report = report
+
+        print(f"Retention removed {report['total_removed']} rows in {report['elapsed_seconds']}s")
+        database.log_system_event(
+            event_type='retention_completed',
+            severity='info',
+            message=f"Retention removed {report['total_removed']} rows in {report['elapsed_seconds']}s",
+            details=json.dumps(report['removed']),
+            source='maintenance'
+        )
+        return report
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as e:
+                print(f"Maintenance run failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Start the maintenance task on the running event loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Cancel the maintenance task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,220 @@
+"""
+Prometheus metrics for WireGuard VPN Admin
+
+Request counters and latency histograms are kept in memory and updated by
+the HTTP middleware. Everything else (peers, pools, queues) is read from
+the in-memory state of the background jobs at scrape time, so a scrape
+never touches SQLite. render() produces the Prometheus text format.
+"""
+
+import math
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: Tuple[str, str] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _header(name: str, help: str, kind: str) -> List[str]:
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+
+
+# ============== Registry Metrics ==============
+
+class Counter:
+    """Monotonic counter per label set"""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = _header(self.name, self.help, 'counter')
+        for labels, value in values:
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set"""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> [bucket counts..., sum]
+        self._values: Dict[Tuple, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-1] += value
+
+    def snapshot(self) -> Dict[Tuple, Dict]:
+        """Per label set: count, sum and cumulative bucket counts"""
+        with self._lock:
+            values = {labels: list(series) for labels, series in self._values.items()}
+        result = {}
+        for labels, series in values.items():
+            cumulative, buckets = 0, []
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                buckets.append((bound, cumulative))
+            result[labels] = {'count': cumulative, 'sum': series[-1], 'buckets': buckets}
+        return result
+
+    def render(self) -> List[str]:
+        lines = _header(self.name, self.help, 'histogram')
+        for labels, series in sorted(self.snapshot().items()):
+            for bound, count in series['buckets']:
+                le = ('le', _format_value(float(bound)))
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {round(series['sum'], 6)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {series['count']}")
+        return lines
+
+
+REQUESTS = Counter(
+    'wgvpn_http_requests_total', 'HTTP requests by route template, method and status',
+    ('method', 'route', 'status')
+)
+REQUEST_LATENCY = Histogram(
+    'wgvpn_http_request_duration_seconds', 'HTTP request latency by route template',
+    ('method', 'route')
+)
+
+
+def observe_request(method: str, route: str, status: int, seconds: float):
+    """Record one finished HTTP request"""
+    REQUESTS.inc(method, route, str(status))
+    REQUEST_LATENCY.observe(seconds, method, route)
+
+
+def request_route(scope: Dict) -> str:
+    """Route template of a request ('/api/users/{user_id}'), so labels stay bounded"""
+    route = scope.get('route')
+    path = getattr(route, 'path', None)
+    return path if path else 'unmatched'
+
+
+def histogram_quantile(q: float, buckets: Sequence[Tuple[float, int]]) -> Optional[float]:
+    """Estimate a quantile from cumulative buckets, interpolating inside a bucket like Prometheus"""
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == math.inf:
+                return lower  # beyond the last finite bucket
+            inside = count - below
+            return lower + (bound - lower) * ((rank - below) / inside if inside else 0)
+        lower, below = bound, count
+    return lower
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def route_latency_summary() -> List[Dict]:
+    """Per-route request count, mean and estimated p50/p95/p99 in ms, slowest total first"""
+    routes = []
+    for (method, route), series in REQUEST_LATENCY.snapshot().items():
+        routes.append({
+            'method': method,
+            'route': route,
+            'count': series['count'],
+            'total_ms': _ms(series['sum']),
+            'avg_ms': _ms(series['sum'] / series['count']),
+            'p50_ms': _ms(histogram_quantile(0.5, series['buckets'])),
+            'p95_ms': _ms(histogram_quantile(0.95, series['buckets'])),
+            'p99_ms': _ms(histogram_quantile(0.99, series['buckets'])),
+        })
+    routes.sort(key=lambda route: route['total_ms'], reverse=True)
+    return routes
+
+
+# ============== Scrape-time Gauges ==============
+
+def gauge(name: str, help: str, samples: Iterable[Tuple[Dict, Optional[float]]], kind: str = 'gauge') -> List[str]:
+    """Render one metric from (labels, value) pairs; None values are skipped"""
+    lines = _header(name, help, kind)
+    for labels, value in samples:
+        if value is not None:
+            lines.append(f"{name}{_labels(list(labels), list(labels.values()))} {_format_value(value)}")
+    return lines
+
+
+def peer_metrics(snapshot: Dict, now: float) -> List[str]:
+    """Per-peer counters and handshake age from a TrafficCollector snapshot"""
+    peers = []
+    for peer in snapshot['peers']:
+        labels = {
+            'public_key': peer['public_key'],
+            'interface': peer.get('interface') or '',
+            'username': peer.get('username') or '',
+        }
+        handshake = peer.get('latest_handshake')
+        # 0 means the peer never completed a handshake
+        age = max(now - handshake, 0) if handshake else None
+        peers.append((labels, peer['bytes_received'], peer['bytes_sent'], age))
+
+    lines = []
+    lines += gauge('wgvpn_peer_receive_bytes_total', 'Bytes received from the peer (WireGuard counter)',
+                   [(labels, rx) for labels, rx, _, _ in peers], kind='counter')
+    lines += gauge('wgvpn_peer_transmit_bytes_total', 'Bytes sent to the peer (WireGuard counter)',
+                   [(labels, tx) for labels, _, tx, _ in peers], kind='counter')
+    lines += gauge('wgvpn_peer_handshake_age_seconds', 'Seconds since the latest handshake',
+                   [(labels, round(age, 3)) for labels, _, _, age in peers if age is not None])
+    lines += gauge('wgvpn_peers', 'Peers in the latest collector snapshot', [({}, len(peers))])
+    lines += gauge('wgvpn_collector_snapshot_age_seconds', 'Age of the latest collector snapshot',
+                   [({}, snapshot['age_seconds'])])
+    return lines
+
+
+def render(*sections: List[str]) -> str:
+    """Join the registry metrics and the given scrape-time sections"""
+    lines = REQUESTS.render() + REQUEST_LATENCY.render()
+    for section in sections:
+        lines += section
+    return '\n'.join(lines) + '\n'
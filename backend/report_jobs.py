@@ -0,0 +1,261 @@
+"""
+Report generation queue for WireGuard VPN Admin
+
+Compliance, template and scheduled reports are generated on a bounded
+worker pool.
+The report rows carry the job state (status, progress, error), so the
+generate endpoints return at once and clients poll the row.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+import database
+import reports
+
+# Reports generated at the same time; more reports wait in the queue
+REPORT_WORKERS = int(os.environ.get("WGVPN_REPORT_WORKERS", "2"))
+
+# Report sections built at the same time, shared by all running reports
+SECTION_WORKERS = int(os.environ.get("WGVPN_REPORT_SECTION_WORKERS", "4"))
+
+
+class ReportCancelled(Exception):
+    """Raised in a worker once its report was cancelled"""
+
+
+# ============== Template Reports ==============
+
+def _health_sample(sample: Optional[Dict]) -> Dict:
+    if sample is None:
+        raise ValueError("No health sample yet; generate the report again shortly")
+    return sample
+
+
+# template data source -> [(section name, section builder(start_date, end_date, health sample))]
+# The system sections read the HealthSampler sample taken when the report
+# started; measuring live would block every report on a CPU interval.
+TEMPLATE_SECTIONS = {
+    'traffic': [
+        ('traffic', lambda start, end, health: database.generate_traffic_report_data(start_date=start, end_date=end)),
+    ],
+    'users': [
+        ('users', lambda start, end, health: database.get_user_statistics(start_date=start, end_date=end)),
+    ],
+    'system': [
+        ('system', lambda start, end, health: _health_sample(health)),
+        ('system_alerts', lambda start, end, health: database.health_alerts(_health_sample(health))),
+    ],
+    'audit': [
+        ('audit', lambda start, end, health: database.generate_compliance_report_data(
+            report_type='custom', start_date=start, end_date=end)),
+    ],
+}
+
+
+_section_executor = ThreadPoolExecutor(max_workers=SECTION_WORKERS, thread_name_prefix='report-section')
+
+
+def _timed(build, start_date: str, end_date: str, health: Optional[Dict]):
+    started = time.perf_counter()
+    result = build(start_date, end_date, health)
+    return result, time.perf_counter() - started
+
+
+def _build_sections(report_data: Dict, sections, start_date: str, end_date: str,
+                    progress: Optional[Callable[[float], None]], health: Optional[Dict]) -> Dict:
+    """
+    Build independent sections concurrently on the shared section pool, so a
+    report takes about as long as its slowest section. Per-section timings
+    go to report_data['metadata']. If a section fails or the report is
+    cancelled, sections that have not started yet are dropped.
+    """
+    started = time.perf_counter()
+    futures = {
+        _section_executor.submit(_timed, build, start_date, end_date, health): name
+        for name, build in sections
+    }
+    results = {}
+    pending = set(futures)
+    try:
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results[futures[future]] = future.result()
+            if progress:
+                progress(len(results) / len(sections))
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        raise
+
+    # Keep the declared section order
+    for name, _ in sections:
+        report_data['sections'][name] = results[name][0]
+    report_data['metadata'] = {
+        'elapsed_seconds': round(time.perf_counter() - started, 3),
+        'section_seconds': {name: round(results[name][1], 3) for name, _ in sections},
+        'section_workers': SECTION_WORKERS
+    }
+    return report_data
+
+
+def build_template_report(template: Dict, start_date: str, end_date: str,
+                          progress: Optional[Callable[[float], None]] = None,
+                          health: Optional[Dict] = None) -> Dict:
+    """
+    Build the data of a template report section by section (blocking)
+    health: the latest HealthSampler sample, used by the system sections
+    """
+    data_sources = json.loads(template['data_sources'])
+    sections = [
+        section
+        for source, source_sections in TEMPLATE_SECTIONS.items() if source in data_sources
+        for section in source_sections
+    ]
+
+    report_data = {
+        'template_name': template['name'],
+        'period': {'start_date': start_date, 'end_date': end_date},
+        'generated_at': datetime.now().isoformat(),
+        'sections': {}
+    }
+    return _build_sections(report_data, sections, start_date, end_date, progress, health)
+
+
+def build_scheduled_report(schedule: Dict, start_date: str, end_date: str,
+                           progress: Optional[Callable[[float], None]] = None,
+                           health: Optional[Dict] = None) -> Dict:
+    """Build the data of one run of a scheduled report from its include_* flags (blocking)"""
+    sections = []
+    if schedule['include_traffic']:
+        sections.append(('traffic', lambda start, end, health: database.generate_traffic_report_data(
+            start_date=start, end_date=end,
+            include_users=bool(schedule['include_users']),
+            top_users_count=schedule['top_users_count'] or 10
+        )))
+    for source in ('users', 'system', 'audit'):
+        if schedule[f'include_{source}']:
+            sections.extend(TEMPLATE_SECTIONS[source])
+
+    report_data = {
+        'schedule_name': schedule['name'],
+        'period': {'start_date': start_date, 'end_date': end_date},
+        'generated_at': datetime.now().isoformat(),
+        'sections': {}
+    }
+    return _build_sections(report_data, sections, start_date, end_date, progress, health)
+
+
+# ============== Queue ==============
+
+class ReportJobQueue:
+    """
+    Generates queued reports on a bounded worker pool
+    `health` returns the HealthSampler's latest sample for the system sections.
+    """
+
+    def __init__(self, workers: int = REPORT_WORKERS, health: Optional[Callable[[], Optional[Dict]]] = None):
+        self.workers = workers
+        self.health = health
+        # Submitted reports that have not finished yet (queued + running)
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='report')
+
+    def _submit(self, table: str, report_id: int, build: Callable):
+        with self._lock:
+            self.pending += 1
+        self._executor.submit(self._run, table, report_id, build)
+
+    def submit_compliance(self, report_id: int):
+        """Queue a pending compliance_reports row"""
+        self._submit('compliance_reports', report_id, self._build_compliance)
+
+    def submit_template(self, report_id: int):
+        """Queue a pending generated_reports row created from a template"""
+        self._submit('generated_reports', report_id, self._build_template)
+
+    def submit_scheduled(self, report_id: int):
+        """Queue a pending generated_reports row for a scheduled report run"""
+        self._submit('generated_reports', report_id, self._build_scheduled)
+
+    def _run(self, table: str, report_id: int, build: Callable):
+        try:
+            if not database.claim_report_job(table, report_id):
+                return  # cancelled while queued
+
+            def progress(fraction: float):
+                # The conditional update doubles as the cancellation check
+                if not database.update_report_progress(table, report_id, fraction * 100):
+                    raise ReportCancelled()
+
+            build(report_id, progress)
+            database.finish_report_job(table, report_id, 'completed')
+        except ReportCancelled:
+            print(f"Report {table}/{report_id} cancelled")
+        except Exception as e:
+            database.finish_report_job(table, report_id, 'failed', error=str(e))
+            print(f"Report {table}/{report_id} failed: {e}")
+        finally:
+            # Worker threads are pooled; don't keep their connections open between jobs
+            database.close_thread_connection()
+            with self._lock:
+                self.pending -= 1
+
+    def _build_compliance(self, report_id: int, progress: Callable[[float], None]):
+        report = database.get_compliance_report_by_id(report_id)
+        report_data = database.generate_compliance_report_data(
+            report_type=report['report_type'],
+            start_date=report['start_date'],
+            end_date=report['end_date'],
+            progress=lambda fraction: progress(fraction * 0.9)
+        )
+        progress(0.9)
+        reports.save_compliance_report(report_id, report_data)
+        database.log_system_event(
+            event_type='report_generated',
+            severity='info',
+            message=f"Compliance report generated: {report['report_type']}",
+            details=f"Report ID: {report_id}, Period: {report['start_date']} to {report['end_date']}",
+            source='api'
+        )
+
+    def _build_template(self, report_id: int, progress: Callable[[float], None]):
+        report = database.get_generated_report(report_id)
+        template = database.get_report_template(report['template_id'])
+        if not template:
+            raise ValueError(f"Template {report['template_id']} no longer exists")
+        report_data = build_template_report(template, report['start_date'], report['end_date'], progress,
+                                            self._health_sample())
+        database.update_generated_report(report_id, data=json.dumps(report_data))
+
+    def _build_scheduled(self, report_id: int, progress: Callable[[float], None]):
+        report = database.get_generated_report(report_id)
+        schedule = database.get_scheduled_report(report['scheduled_report_id'])
+        if not schedule:
+            raise ValueError(f"Scheduled report {report['scheduled_report_id']} no longer exists")
+        report_data = build_scheduled_report(schedule, report['start_date'], report['end_date'], progress,
+                                             self._health_sample())
+        database.update_generated_report(report_id, data=json.dumps(report_data))
+
+    def _health_sample(self) -> Optional[Dict]:
+        return self.health() if self.health else None
+
+    def recover(self) -> int:
+        """Fail the reports a previous process left unfinished (blocking)"""
+        return database.fail_interrupted_report_jobs()
+
+    def stats(self) -> Dict:
+        """Worker count and reports queued or running"""
+        with self._lock:
+            return {'workers': self.workers, 'pending': self.pending}
+
+    def shutdown(self):
+        """Stop accepting reports; unfinished ones are failed by recover() on next start"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,116 @@
+"""
+Report artifacts for WireGuard VPN Admin
+
+A generated compliance report is rendered once to JSON and CSV, gzipped
+and kept on disk; downloads stream those files instead of re-running the
+report queries.
+"""
+
+import csv
+import io
+import json
+import os
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+import database
+from exports import CHUNK_SIZE, iter_file
+
+# Directory holding rendered report files
+REPORT_DIR = Path(os.environ.get("WGVPN_REPORT_DIR", Path(__file__).parent / "report_files"))
+
+# format -> media type
+REPORT_FORMATS = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+}
+
+# Compliance report sections written to CSV, in order
+COMPLIANCE_CSV_SECTIONS = [
+    ('user_activities', 'User Activities'),
+    ('login_attempts', 'Login Attempts'),
+    ('admin_operations', 'Admin Operations'),
+    ('system_events', 'System Events'),
+]
+
+
+def render_compliance_csv(report_data: Dict) -> str:
+    """Flatten compliance report sections into one CSV document"""
+    output = io.StringIO()
+    sections = report_data.get('sections', {})
+
+    for key, title in COMPLIANCE_CSV_SECTIONS:
+        rows = sections.get(key)
+        if rows:
+            output.write(f"=== {title} ===\n")
+            writer = csv.DictWriter(output, fieldnames=rows[0].keys())
+            writer.writeheader()
+            writer.writerows(rows)
+            output.write("\n")
+
+    if sections.get('summary'):
+        output.write("=== Summary ===\n")
+        for key, value in sections['summary'].items():
+            output.write(f"{key}: {value}\n")
+
+    return output.getvalue()
+
+
+def _write_gzip(path: Path, text: str):
+    """Write text gzip-compressed, replacing path atomically"""
+    partial = path.with_name(path.name + '.part')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    with open(partial, 'wb') as f:
+        f.write(compressor.compress(text.encode('utf-8')))
+        f.write(compressor.flush())
+    partial.replace(path)
+
+
+def artifact_path(file_path: str, format: str) -> Path:
+    """Path of the `format` rendering next to the JSON artifact in file_path"""
+    return Path(file_path).with_name(Path(file_path).name.replace('.json.gz', f'.{format}.gz'))
+
+
+def save_compliance_report(report_id: int, report_data: Dict) -> str:
+    """
+    Render a compliance report to gzip JSON and CSV files and record the
+    JSON path in compliance_reports.file_path (blocking)
+    """
+    REPORT_DIR.mkdir(parents=True, exist_ok=True)
+    json_path = REPORT_DIR / f"compliance_report_{report_id}.json.gz"
+    _write_gzip(json_path, json.dumps(report_data, ensure_ascii=False, indent=2, default=str))
+    _write_gzip(artifact_path(json_path, 'csv'), render_compliance_csv(report_data))
+    database.update_compliance_report(report_id, file_path=str(json_path))
+    return str(json_path)
+
+
+def open_compliance_artifact(report: Dict, format: str) -> Optional[Path]:
+    """Path of a report's saved gzip artifact, or None if it has none on disk"""
+    if report.get('file_path'):
+        path = artifact_path(report['file_path'], format)
+        if path.exists():
+            return path
+    return None
+
+
+def file_etag(path: Path) -> str:
+    """ETag from the file's size and modification time"""
+    stat = path.stat()
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def iter_gunzip(path: Path) -> Iterator[bytes]:
+    """Stream a gzip file decompressed, for clients without gzip support"""
+    decompressor = zlib.decompressobj(31)
+    for chunk in iter_file(str(path)):
+        data = decompressor.decompress(chunk, CHUNK_SIZE)
+        while True:
+            if data:
+                yield data
+            if not decompressor.unconsumed_tail:
+                break
+            data = decompressor.decompress(decompressor.unconsumed_tail, CHUNK_SIZE)
+    tail = decompressor.flush()
+    if tail:
+        yield tail
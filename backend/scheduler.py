@@ -0,0 +1,283 @@
+"""
+Scheduled report runner for WireGuard VPN Admin
+
+One process at a time holds the scheduler lease and runs scheduled_reports.
+Due schedules sit in a min-heap keyed on next_run_at; each run is claimed by
+a compare-and-set on next_run_at and queued as a generated_reports row.
+Schedule rules are in server local time; next_run_at and last_run_at are
+stored in UTC like every CURRENT_TIMESTAMP column.
+"""
+
+import asyncio
+import calendar
+import heapq
+import os
+import socket
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import database
+
+# Seconds between two scheduler ticks (lease renewal and due check)
+SCHEDULER_INTERVAL = float(os.environ.get("WGVPN_SCHEDULER_INTERVAL", "30"))
+
+# Seconds between overdue schedules started after downtime
+SCHEDULER_CATCHUP_SPACING = float(os.environ.get("WGVPN_SCHEDULER_CATCHUP_SPACING", "30"))
+
+# Seconds between two reloads of the schedule table into the heap
+SCHEDULER_REFRESH = 60
+
+LEASE_NAME = 'report-scheduler'
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# ============== Clock ==============
+
+def utc_now() -> datetime:
+    """Current time as naive UTC, the form stored in the database"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def to_local(utc: datetime) -> datetime:
+    """Naive UTC to naive server local time"""
+    return utc.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+
+def to_utc(local: datetime) -> datetime:
+    """Naive server local time to naive UTC"""
+    return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+# ============== Schedule Rules ==============
+
+def _schedule_time(schedule: Dict) -> Tuple[int, int]:
+    value = schedule.get('schedule_time') or '00:00'
+    try:
+        parts = [int(part) for part in str(value).split(':')]
+        hour, minute = parts[0], parts[1] if len(parts) > 1 else 0
+    except ValueError:
+        raise ValueError(f"Invalid schedule_time '{value}', expected HH:MM")
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"Invalid schedule_time '{value}', expected HH:MM")
+    return hour, minute
+
+
+def _schedule_day(schedule: Dict, field: str, low: int, high: int) -> int:
+    value = schedule.get(field)
+    if value is None or not low <= int(value) <= high:
+        raise ValueError(f"{field} must be between {low} and {high}")
+    return int(value)
+
+
+def compute_next_run(schedule: Dict, after: datetime) -> datetime:
+    """
+    First occurrence of a schedule strictly after `after` (local time)
+    daily: every day at schedule_time
+    weekly: schedule_dayOfWeek (0-6, Sunday=0) at schedule_time
+    monthly: schedule_dayOfMonth (1-31, clamped to the month's last day)
+    Raises ValueError for an invalid rule.
+    """
+    hour, minute = _schedule_time(schedule)
+    schedule_type = schedule.get('schedule_type')
+    at_time = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+    if schedule_type == 'daily':
+        return at_time if at_time > after else at_time + timedelta(days=1)
+
+    if schedule_type == 'weekly':
+        # Sunday=0 in the schedule, Monday=0 in Python
+        weekday = (_schedule_day(schedule, 'schedule_dayOfWeek', 0, 6) + 6) % 7
+        candidate = at_time + timedelta(days=(weekday - after.weekday()) % 7)
+        return candidate if candidate > after else candidate + timedelta(days=7)
+
+    if schedule_type == 'monthly':
+        day_of_month = _schedule_day(schedule, 'schedule_dayOfMonth', 1, 31)
+        year, month = after.year, after.month
+        while True:
+            day = min(day_of_month, calendar.monthrange(year, month)[1])
+            candidate = datetime(year, month, day, hour, minute)
+            if candidate > after:
+                return candidate
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    raise ValueError(f"Invalid schedule_type '{schedule_type}', expected daily, weekly or monthly")
+
+
+def next_run_after(schedule: Dict, after: datetime) -> datetime:
+    """compute_next_run for a UTC time; the result is UTC too"""
+    local = compute_next_run(schedule, to_local(after))
+    # The repeated hour when DST ends can map back to or before `after`
+    while to_utc(local) <= after:
+        local = compute_next_run(schedule, local)
+    return to_utc(local)
+
+
+def report_period(schedule: Dict, run_at: datetime) -> Tuple[str, str]:
+    """Inclusive (start_date, end_date) a run covers: the day, week or month before it"""
+    end = run_at.date() - timedelta(days=1)
+    if schedule['schedule_type'] == 'daily':
+        start = end
+    elif schedule['schedule_type'] == 'weekly':
+        start = end - timedelta(days=6)
+    else:
+        year, month = (run_at.year - 1, 12) if run_at.month == 1 else (run_at.year, run_at.month - 1)
+        start = date(year, month, min(run_at.day, calendar.monthrange(year, month)[1]))
+    return start.isoformat(), end.isoformat()
+
+# ============== Scheduler ==============
+
+
+class ReportScheduler:
+    """
+    Runs scheduled reports through a ReportJobQueue
+    Every process ticks, but only the lease holder keeps a heap and starts
+    runs. Missed occurrences after downtime collapse into one run per
+    schedule, and overdue schedules are started SCHEDULER_CATCHUP_SPACING
+    apart instead of all at once.
+    """
+
+    def __init__(self, report_queue, interval: float = SCHEDULER_INTERVAL,
+                 catchup_spacing: float = SCHEDULER_CATCHUP_SPACING):
+        self.report_queue = report_queue
+        self.interval = interval
+        self.catchup_spacing = catchup_spacing
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        # (run at in UTC, schedule id)
+        self._heap: List[Tuple[datetime, int]] = []
+        self._loaded_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    def _load(self, now: datetime):
+        """Rebuild the heap from the active schedules (now is UTC)"""
+        heap = []
+        overdue = 0
+        for schedule in sorted(database.get_active_scheduled_reports(), key=lambda s: s['next_run_at'] or ''):
+            try:
+                if schedule['next_run_at'] is None:
+                    next_run = next_run_after(schedule, now)
+                    database.advance_scheduled_report(schedule['id'], None, None, next_run.strftime(TIME_FORMAT))
+                else:
+                    next_run = datetime.strptime(schedule['next_run_at'], TIME_FORMAT)
+            except ValueError as e:
+                print(f"Skipping scheduled report {schedule['id']}: {e}")
+                continue
+            if next_run <= now:
+                # Stagger catch-up runs, oldest first
+                next_run = now + timedelta(seconds=overdue * self.catchup_spacing)
+                overdue += 1
+            heap.append((next_run, schedule['id']))
+        heapq.heapify(heap)
+        self._heap = heap
+        self._loaded_at = time.monotonic()
+
+    def _fire(self, schedule_id: int, now: datetime) -> Optional[int]:
+        """Claim and queue the due occurrence of one schedule; returns the generated report id"""
+        schedule = database.get_scheduled_report(schedule_id)
+        if not schedule or not schedule['is_active'] or not schedule['next_run_at']:
+            return None
+        expected = schedule['next_run_at']
+        try:
+            occurrence = datetime.strptime(expected, TIME_FORMAT)
+            if occurrence > now:
+                # Edited or already run elsewhere; wait for the stored time
+                heapq.heappush(self._heap, (occurrence, schedule_id))
+                return None
+            # Occurrences missed while nothing was running collapse into the latest one
+            upcoming = next_run_after(schedule, occurrence)
+            while upcoming <= now:
+                occurrence, upcoming = upcoming, next_run_after(schedule, upcoming)
+        except ValueError as e:
+            print(f"Skipping scheduled report {schedule_id}: {e}")
+            return None
+
+        if not database.advance_scheduled_report(
+            schedule_id, expected, now.strftime(TIME_FORMAT), upcoming.strftime(TIME_FORMAT)
+        ):
+            return None  # claimed by another runner
+        heapq.heappush(self._heap, (upcoming, schedule_id))
+
+        # The covered period and the name follow the schedule's local calendar
+        local_occurrence = to_local(occurrence)
+        start_date, end_date = report_period(schedule, local_occurrence)
+        report = database.create_generated_report(
+            name=f"{schedule['name']} - {local_occurrence.strftime('%Y-%m-%d')}",
+            report_type=schedule['report_type'],
+            start_date=start_date,
+            end_date=end_date,
+            scheduled_report_id=schedule_id,
+            status='pending'
+        )
+        self.report_queue.submit_scheduled(report['id'])
+        print(f"Scheduled report {schedule_id} queued as generated report {report['id']}")
+        return report['id']
+
+    def run_once(self) -> Dict:
+        """Renew the lease and start every due run (blocking)"""
+        now = utc_now()
+        self.is_leader = database.acquire_lease(LEASE_NAME, self.holder, self.interval * 3)
+        if not self.is_leader:
+            self._heap = []
+            self._loaded_at = None
+            return {'leader': False, 'started': []}
+
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= SCHEDULER_REFRESH:
+            self._load(now)
+
+        started = []
+        while self._heap and self._heap[0][0] <= now:
+            _, schedule_id = heapq.heappop(self._heap)
+            report_id = self._fire(schedule_id, now)
+            if report_id is not None:
+                started.append(report_id)
+        return {'leader': True, 'started': started}
+
+    def seconds_until_next(self) -> Optional[float]:
+        """Seconds until the earliest run in the heap, if any"""
+        if not self._heap:
+            return None
+        return max((self._heap[0][0] - utc_now()).total_seconds(), 0)
+
+    def refresh(self):
+        """Reload the schedules on the next tick (call after creating or changing one)"""
+        self._loaded_at = None
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as e:
+                print(f"Scheduler tick failed: {e}")
+            delay = self.interval
+            if self.is_leader:
+                next_run = self.seconds_until_next()
+                if next_run is not None:
+                    delay = min(delay, next_run)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        """Start the scheduler task on the running event loop"""
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Cancel the scheduler task and hand the lease over"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            await asyncio.to_thread(database.release_lease, LEASE_NAME, self.holder)
+            self.is_leader = False
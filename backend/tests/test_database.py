@@ -0,0 +1,115 @@
+"""
+Database tests for WireGuard VPN Admin
+
+Each test runs against a fresh SQLite file.
+
+Usage:
+    python -m pytest backend/tests
+"""
+
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE_PATH', tmp_path / 'test.db')
+    database.init_db()
+    yield database
+    database.close_thread_connection()
+
+
+def daily_rows(db):
+    with db.db_connection() as conn:
+        rows = conn.execute("SELECT date, bytes_received, bytes_sent, samples FROM traffic_records ORDER BY date")
+        return {row['date']: tuple(row)[1:] for row in rows}
+
+
+# ============== Traffic Rollups ==============
+
+def test_rebuild_rollups_keeps_daily_history_older_than_raw_logs(db):
+    user = db.create_user('alice', 'alice@example.com', 'hash', public_key='PK1')
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    for days_ago in range(40, 0, -1):
+        for hour in (1, 13):
+            snapshot_time = (today - timedelta(days=days_ago, hours=-hour)).strftime('%Y-%m-%d %H:%M:%S')
+            db.log_traffic_batch([(user['id'], 'PK1', 0, 0, 100, 10)], snapshot_time)
+    before = daily_rows(db)
+    assert len(before) == 40
+
+    # Retention drops the raw logs of the oldest days, one of them only partly
+    cutoff = (today - timedelta(days=20, hours=-6)).strftime('%Y-%m-%d %H:%M:%S')
+    with db.db_connection() as conn:
+        conn.execute("DELETE FROM traffic_logs WHERE snapshot_time < ?", (cutoff,))
+
+    assert db.rebuild_traffic_rollups() == 39
+    assert daily_rows(db) == before
+
+
+def test_latest_traffic_counters_are_the_last_sample_per_peer(db):
+    db.log_traffic_batch([(1, 'PK1', 100, 10, 100, 10), (2, 'PK2', 5, 5, 5, 5)], '2026-01-01 00:00:00')
+    db.log_traffic_batch([(1, 'PK1', 150, 20, 50, 10)], '2026-01-01 00:01:00')
+    assert db.get_latest_traffic_counters() == {'PK1': (150, 20), 'PK2': (5, 5)}
+    with db.db_connection() as conn:
+        plan = ' '.join(row[3] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT MAX(id) FROM traffic_logs WHERE peer_public_key = 'PK1'"))
+    assert 'idx_traffic_logs_peer_id' in plan
+
+
+# ============== Storage ==============
+
+def test_new_database_uses_incremental_auto_vacuum(db):
+    with db.db_connection() as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+# ============== Statement Timing ==============
+
+def test_executemany_streams_generators_and_counts_rows(db, monkeypatch):
+    monkeypatch.setattr(db, 'SLOW_QUERY_MS', 0.000001)
+    events = []
+
+    def rows():
+        for i in range(3):
+            events.append(('pull', i))
+            yield ('test', 'info', f'event {i}', i)
+
+    with db.db_connection() as conn:
+        conn.create_function('mark', 1, lambda value: events.append(('insert', value)) or 'api')
+        conn.executemany(
+            "INSERT INTO system_events (event_type, severity, message, source) VALUES (?, ?, ?, mark(?))", rows()
+        )
+        assert conn.execute("SELECT COUNT(*) FROM system_events").fetchone()[0] == 3
+    # Each row is inserted before the next one is pulled
+    assert events == [('pull', 0), ('insert', 0), ('pull', 1), ('insert', 1), ('pull', 2), ('insert', 2)]
+    slow = next(entry for entry in db.get_slow_queries() if entry['sql'].startswith('INSERT INTO system_events'))
+    assert slow['rows'] == 3 and slow['params'] == '(str, str, str, int)'
+
+
+# ============== Log Search ==============
+
+def search_ids(db, keyword, log_type):
+    return [log['id'] for log in db.search_logs(keyword=keyword, log_type=log_type)['logs']]
+
+
+def test_log_search_index_follows_updated_rows(db):
+    alert_id = db.create_alert(None, 'bandwidth', 'warning', 'quota nearly reached')
+    with db.db_connection() as conn:
+        conn.execute("UPDATE alerts SET message = 'quota exceeded' WHERE id = ?", (alert_id,))
+    assert search_ids(db, 'exceeded', 'alert') == [alert_id]
+    assert search_ids(db, 'nearly', 'alert') == []
+
+
+def test_log_search_index_follows_renamed_users(db):
+    user = db.create_user('carol', 'carol@example.com', 'hash', public_key='PKC')
+    connection_id = db.log_connection(user['id'], peer_ip='10.0.0.7')
+    db.update_user(user['id'], username='dave')
+    assert search_ids(db, 'dave', 'connection') == [connection_id]
+    assert search_ids(db, 'carol', 'connection') == []
@@ -0,0 +1,37 @@
+"""
+Export helper tests for WireGuard VPN Admin
+
+Usage:
+    python -m pytest backend/tests
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from exports import RangeNotSatisfiable, parse_range
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None),
+    ('bytes=0-9', (0, 9)),
+    ('bytes=90-', (90, 99)),
+    ('bytes=90-500', (90, 99)),
+    ('bytes=-10', (90, 99)),
+    ('bytes=-500', (0, 99)),
+    # Invalid ranges are ignored and the whole file is sent
+    ('bytes=5-3', None),
+    ('bytes=0-9,20-29', None),
+    ('items=0-9', None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize('header', ['bytes=100-', 'bytes=100-200', 'bytes=-0'])
+def test_parse_range_not_satisfiable(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, 100)
@@ -1,4 +1,5 @@
 -- WireGuard VPN Admin Database Schema
+-- Indexes and in-place upgrades live in the migrations of backend/database.py
 
 -- Users table
 CREATE TABLE IF NOT EXISTS users (
@@ -37,23 +38,49 @@ CREATE TABLE IF NOT EXISTS audit_logs (
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
 
--- Traffic records (daily aggregates)
+-- Traffic records (daily aggregates, accumulated per user and day as
+-- traffic samples are ingested; the day tier of the traffic rollups)
 CREATE TABLE IF NOT EXISTS traffic_records (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
     date DATE NOT NULL,
     bytes_received INTEGER DEFAULT 0,
     bytes_sent INTEGER DEFAULT 0,
+    samples INTEGER DEFAULT 0,
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
 
+-- Traffic rollups per minute (bucket 'YYYY-MM-DD HH:MM', kept ~48 hours)
+CREATE TABLE IF NOT EXISTS traffic_rollup_minute (
+    bucket TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    bytes_received INTEGER DEFAULT 0,
+    bytes_sent INTEGER DEFAULT 0,
+    samples INTEGER DEFAULT 0,
+    PRIMARY KEY (bucket, user_id)
+) WITHOUT ROWID;
+
+-- Traffic rollups per hour (bucket 'YYYY-MM-DD HH:00', kept ~90 days)
+CREATE TABLE IF NOT EXISTS traffic_rollup_hour (
+    bucket TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    bytes_received INTEGER DEFAULT 0,
+    bytes_sent INTEGER DEFAULT 0,
+    samples INTEGER DEFAULT 0,
+    PRIMARY KEY (bucket, user_id)
+) WITHOUT ROWID;
+
 -- Traffic logs (real-time snapshots)
+-- bytes_* are cumulative WireGuard counters, delta_* the traffic since the
+-- previous sample of the same peer (NULL until computed)
 CREATE TABLE IF NOT EXISTS traffic_logs (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
     peer_public_key TEXT,
     bytes_received INTEGER DEFAULT 0,
     bytes_sent INTEGER DEFAULT 0,
+    delta_received INTEGER,
+    delta_sent INTEGER,
     snapshot_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
@@ -105,9 +132,12 @@ CREATE TABLE IF NOT EXISTS compliance_reports (
     start_date DATE NOT NULL,
     end_date DATE NOT NULL,
     file_path TEXT,
-    status TEXT DEFAULT 'pending',
+    status TEXT DEFAULT 'pending',  -- pending, running, completed, failed, cancelled
+    progress REAL DEFAULT 0,  -- percent done while running
+    error TEXT,
     created_by INTEGER,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
     completed_at TIMESTAMP,
     FOREIGN KEY (created_by) REFERENCES users(id)
 );
@@ -164,9 +194,48 @@ CREATE TABLE IF NOT EXISTS generated_reports (
     data TEXT,  -- JSON report data
     file_path TEXT,
     format TEXT DEFAULT 'json',
+    status TEXT DEFAULT 'completed',  -- pending, running, completed, failed, cancelled
+    progress REAL DEFAULT 0,
+    error TEXT,
     generated_by INTEGER,
     generated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    completed_at TIMESTAMP,
     FOREIGN KEY (template_id) REFERENCES report_templates(id),
     FOREIGN KEY (scheduled_report_id) REFERENCES scheduled_reports(id),
     FOREIGN KEY (generated_by) REFERENCES users(id)
 );
+
+-- Background export jobs; finished files live on disk until expires_at
+CREATE TABLE IF NOT EXISTS export_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,  -- 'logs' or 'user-stats'
+    format TEXT NOT NULL DEFAULT 'csv',
+    params TEXT,  -- JSON filters
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending, running, completed, failed
+    rows_written INTEGER DEFAULT 0,
+    total_rows INTEGER,
+    file_path TEXT,
+    file_size INTEGER,
+    error TEXT,
+    created_by INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    expires_at TIMESTAMP,
+    FOREIGN KEY (created_by) REFERENCES users(id)
+);
+
+-- Cross-process leases electing a single runner for background jobs
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL  -- unix time
+);
+
+-- System health samples, written only with WGVPN_HEALTH_PERSIST
+CREATE TABLE IF NOT EXISTS health_samples (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sampled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    data TEXT NOT NULL  -- JSON sample
+);